@@ -0,0 +1,481 @@
+"""Usage analytics: an append-only binary event log plus per-day rollups.
+
+Handlers call ``analytics.record(GENERATE, user_id, size)``. Events are packed
+into fixed-size records, buffered, and appended to one segment file per UTC
+day (a new segment once ANALYTICS_SEGMENT_BYTES is reached). Every event also
+updates that day's rollup: distinct users, counts, payload bytes and a latency
+histogram per kind, so the admin stats view never reads the log.
+
+Finished days are saved to rollups-<writer>.json and their segments merged
+into one; raw segments older than ANALYTICS_RAW_DAYS are deleted. On startup
+only the days missing from the rollups (normally just today) are replayed.
+
+Every process writes only its own files (ANALYTICS_WRITER; sharding.py names
+one per worker). Reports merge the other writers' saved rollups, cached until
+their file changes, with the tail of their still-open segments; users are
+routed to one shard, so daily active users simply add up. All-time totals are
+kept running, so the stats view only merges today and yesterday.
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import struct
+import time
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+from metrics import LATENCY_BUCKETS, Histogram, metrics
+
+ANALYTICS_DIR = Path(os.getenv("ANALYTICS_DIR", "analytics"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 5))
+ANALYTICS_FLUSH_BYTES = int(os.getenv("ANALYTICS_FLUSH_BYTES", 64 * 1024))
+ANALYTICS_SEGMENT_BYTES = int(os.getenv("ANALYTICS_SEGMENT_BYTES", 16 * 1024 * 1024))
+# Rollups are kept forever; the raw events only this long
+ANALYTICS_RAW_DAYS = int(os.getenv("ANALYTICS_RAW_DAYS", 30))
+# Owner of this process's segments and rollups
+ANALYTICS_WRITER = os.getenv("ANALYTICS_WRITER", "main")
+
+START, GENERATE, SCAN_HIT, SCAN_MISS, INLINE, WIFI, BATCH, BULK_SCAN = range(1, 9)
+EVENT_NAMES = {
+    START: "start", GENERATE: "generate", SCAN_HIT: "scan_hit", SCAN_MISS: "scan_miss",
+    INLINE: "inline", WIFI: "wifi", BATCH: "batch", BULK_SCAN: "bulk_scan",
+}
+
+MAGIC = b"QRBEV1\0\0"
+# unix time, kind, user id, payload size in bytes, latency in microseconds
+RECORD = struct.Struct("<IBqII")
+
+
+def _day(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).date()
+
+
+def _totals(rollups):
+    totals = {}
+    for rollup in rollups:
+        for name, count in rollup.counts.items():
+            totals[name] = totals.get(name, 0) + count
+    return totals
+
+
+def read_segment(path):
+    """Yields ``(timestamp, kind, user_id, size, latency_us)``; a torn last record is skipped."""
+    data = Path(path).read_bytes()
+    if not data.startswith(MAGIC):
+        logging.error(f"Not an analytics segment: {path}")
+        return
+    body = memoryview(data)[len(MAGIC):]
+    yield from RECORD.iter_unpack(body[:len(body) - len(body) % RECORD.size])
+
+
+class DayRollup:
+    """Aggregates of one day; ``users`` is only kept while the day is still open."""
+
+    def __init__(self):
+        self.users = set()
+        self.dau = 0
+        self.counts = {}
+        self.payload_bytes = {}
+        self.latency = {}
+
+    def add(self, kind, user_id, size, latency_us):
+        if self.users is not None and user_id not in self.users:
+            self.users.add(user_id)
+            self.dau += 1
+        name = EVENT_NAMES.get(kind, str(kind))
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.payload_bytes[name] = self.payload_bytes.get(name, 0) + size
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(latency_us / 1e6)
+
+    def close(self):
+        self.users = None
+
+    def merge(self, other):
+        """Adds ``other`` (another writer's rollup of the same day) into this one."""
+        self.dau += other.dau
+        for name, count in other.counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+        for name, size in other.payload_bytes.items():
+            self.payload_bytes[name] = self.payload_bytes.get(name, 0) + size
+        for name, histogram in other.latency.items():
+            mine = self.latency.get(name)
+            if mine is None:
+                mine = self.latency[name] = Histogram(LATENCY_BUCKETS)
+            mine.counts = [a + b for a, b in zip(mine.counts, histogram.counts)]
+            mine.count += histogram.count
+            mine.sum += histogram.sum
+
+    def to_dict(self):
+        return {
+            "dau": self.dau, "counts": self.counts, "payload_bytes": self.payload_bytes,
+            "latency": {name: {"counts": h.counts, "sum": h.sum} for name, h in self.latency.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        rollup = cls()
+        rollup.users = None
+        rollup.dau = data["dau"]
+        rollup.counts = data["counts"]
+        rollup.payload_bytes = data["payload_bytes"]
+        for name, saved in data["latency"].items():
+            histogram = rollup.latency[name] = Histogram(LATENCY_BUCKETS)
+            histogram.counts = saved["counts"]
+            histogram.count = sum(saved["counts"])
+            histogram.sum = saved["sum"]
+        return rollup
+
+
+class Analytics:
+    def __init__(self, directory=ANALYTICS_DIR, flush_interval=ANALYTICS_FLUSH_INTERVAL,
+                 flush_bytes=ANALYTICS_FLUSH_BYTES, segment_bytes=ANALYTICS_SEGMENT_BYTES,
+                 raw_days=ANALYTICS_RAW_DAYS, writer=ANALYTICS_WRITER):
+        self.directory = Path(directory)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.segment_bytes = segment_bytes
+        self.raw_days = raw_days
+        self.writer = writer
+        self.days = {}
+        self.totals = {}  # all-time counts of this writer
+        self.today = _day(time.time())
+        self.written = 0
+        self._buffer = {}
+        self._buffered = 0
+        self._flushed_at = time.monotonic()
+        self._loaded = False
+        self._flush_task = None
+        # Other writers: saved rollups by file, and segments read so far
+        self._saved = {}  # writer -> (mtime, {day: DayRollup}, {name: count})
+        self._open = {}  # (writer, day) -> DayRollup built from their segments
+        self._offsets = {}  # segment path -> bytes already read
+
+    # --- files ---
+
+    def _rollups_path(self, writer=None):
+        return self.directory / f"rollups-{writer or self.writer}.json"
+
+    def _segments(self, day=None, writer=None):
+        """Segments sorted by name, optionally of one day and/or one writer."""
+        pattern = f"events-{day:%Y%m%d}-*.bin" if day else "events-*.bin"
+        paths = sorted(self.directory.glob(pattern))
+        return [path for path in paths if writer is None or self._segment_writer(path) == writer]
+
+    @staticmethod
+    def _segment_day(path):
+        return datetime.strptime(path.name.split("-")[1], "%Y%m%d").date()
+
+    @staticmethod
+    def _segment_writer(path):
+        parts = path.stem.split("-")
+        # events-YYYYMMDD-NNNN.bin predates writers: the single process was "main"
+        return "-".join(parts[2:-1]) or "main"
+
+    def _active_segment(self, day):
+        segments = self._segments(day, self.writer)
+        if segments and segments[-1].stat().st_size < self.segment_bytes:
+            return segments[-1]
+        seq = int(segments[-1].stem.rsplit("-", 1)[1]) + 1 if segments else 1
+        path = self.directory / f"events-{day:%Y%m%d}-{self.writer}-{seq:04d}.bin"
+        path.write_bytes(MAGIC)
+        return path
+
+    def _read_rollups(self, path):
+        saved = json.loads(path.read_text(encoding="utf-8"))
+        return {date.fromisoformat(day): DayRollup.from_dict(data) for day, data in saved.items()}
+
+    def load(self):
+        """Reads this writer's rollups and replays the days they don't cover yet (once)."""
+        if self._loaded:
+            return
+        self._loaded = True
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._rollups_path()
+        legacy = self.directory / "rollups.json"
+        if not path.exists() and self.writer == "main" and legacy.exists():
+            path = legacy
+        if path.exists():
+            try:
+                self.days = self._read_rollups(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"Analytics rollups unreadable, rebuilding from the log: {e}")
+                self.days = {}
+        for path in self._segments(writer=self.writer):
+            day = self._segment_day(path)
+            if day in self.days and self.days[day].users is None:
+                continue
+            rollup = self.days.setdefault(day, DayRollup())
+            for _, kind, user_id, size, latency_us in read_segment(path):
+                rollup.add(kind, user_id, size, latency_us)
+        self.totals = _totals(self.days.values())
+        self._close_days()
+
+    def _close_days(self):
+        """Finishes every day before today: saved rollup, one merged segment, retention."""
+        closed = [day for day, rollup in self.days.items() if day < self.today and rollup.users is not None]
+        for day in closed:
+            self.days[day].close()
+        if closed:
+            self._save_rollups()
+            for day in closed:
+                self.compact(day)
+        cutoff = self.today - timedelta(days=self.raw_days)
+        for path in self._segments(writer=self.writer):
+            if self._segment_day(path) < cutoff:
+                path.unlink()
+
+    def _save_rollups(self):
+        closed = {day.isoformat(): rollup.to_dict() for day, rollup in sorted(self.days.items())
+                  if rollup.users is None}
+        path = self._rollups_path()
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(closed), encoding="utf-8")
+        os.replace(tmp, path)
+        legacy = self.directory / "rollups.json"
+        if self.writer == "main" and legacy.exists():
+            legacy.unlink()
+
+    def compact(self, day):
+        """Merges this writer's segments of a finished day into one file."""
+        segments = self._segments(day, self.writer)
+        if len(segments) < 2:
+            return
+        merged = self.directory / f"events-{day:%Y%m%d}-{self.writer}-0000.bin"
+        tmp = merged.with_suffix(".tmp")
+        with tmp.open("wb") as f:
+            f.write(MAGIC)
+            for path in segments:
+                f.write(path.read_bytes()[len(MAGIC):])
+        os.replace(tmp, merged)
+        for path in segments:
+            if path != merged:
+                path.unlink()
+
+    def _other_writers(self, segments):
+        """Writers other than this one, from ``{writer: segments}`` and the rollup files."""
+        writers = set(segments)
+        writers |= {path.stem[len("rollups-"):] for path in self.directory.glob("rollups-*.json")}
+        writers.discard(self.writer)
+        return writers
+
+    def _saved_days(self, writer):
+        """Another writer's saved rollups and their totals, re-read when its file changes."""
+        path = self._rollups_path(writer)
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            self._saved.pop(writer, None)
+            return {}, {}
+        cached = self._saved.get(writer)
+        if cached is None or cached[0] != mtime:
+            try:
+                days = self._read_rollups(path)
+                cached = self._saved[writer] = (mtime, days, _totals(days.values()))
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"Analytics rollups of {writer} unreadable: {e}")
+                return cached[1:] if cached else ({}, {})
+        return cached[1:]
+
+    def _refresh_others(self):
+        """Reads what the other writers appended to their open days since the last call."""
+        segments = {}  # one directory listing per call
+        for path in self._segments():
+            segments.setdefault(self._segment_writer(path), []).append(path)
+        writers = self._other_writers(segments)
+        for key in [key for key in self._open if key[0] not in writers]:
+            del self._open[key]
+        for writer in writers:
+            saved, _ = self._saved_days(writer)
+            for day in [day for open_writer, day in self._open if open_writer == writer and day in saved]:
+                # The writer closed that day since: its saved rollup replaces the segments
+                del self._open[(writer, day)]
+                prefix = f"events-{day:%Y%m%d}-"
+                for path in [p for p in self._offsets if p.name.startswith(prefix)
+                             and self._segment_writer(p) == writer]:
+                    del self._offsets[path]
+            for path in segments.get(writer, ()):
+                day = self._segment_day(path)
+                if day in saved:
+                    continue
+                offset = self._offsets.get(path, len(MAGIC))
+                try:
+                    if path.stat().st_size - offset < RECORD.size:
+                        continue
+                    with path.open("rb") as f:
+                        f.seek(offset)
+                        data = f.read()
+                except OSError:  # compacted or deleted meanwhile
+                    continue
+                data = data[:len(data) - len(data) % RECORD.size]
+                self._offsets[path] = offset + len(data)
+                rollup = self._open.setdefault((writer, day), DayRollup())
+                for _, kind, user_id, size, latency_us in RECORD.iter_unpack(data):
+                    rollup.add(kind, user_id, size, latency_us)
+
+    def _others(self, day):
+        """The other writers' rollups of ``day``; call _refresh_others() first."""
+        rollups = []
+        for writer in self._saved:
+            rollup = self._saved[writer][1].get(day)
+            if rollup is not None:
+                rollups.append(rollup)
+        rollups += [rollup for (_, open_day), rollup in self._open.items() if open_day == day]
+        return rollups
+
+    # --- recording ---
+
+    def record(self, kind, user_id, size=0, latency=None):
+        """Logs one event; ``latency`` defaults to the time the running handler has taken."""
+        if not self._loaded:
+            self.load()
+        now = time.time()
+        day = _day(now)
+        if day != self.today:
+            self.flush()
+            self.today = day
+            self._close_days()
+        if latency is None:
+            latency = metrics.elapsed()
+        latency_us = min(int(latency * 1e6), 0xFFFFFFFF)
+        size = min(size, 0xFFFFFFFF)
+        self._buffer.setdefault(day, bytearray()).extend(RECORD.pack(int(now), kind, user_id, size, latency_us))
+        self._buffered += RECORD.size
+        rollup = self.days.get(day)
+        if rollup is None:
+            rollup = self.days[day] = DayRollup()
+        rollup.add(kind, user_id, size, latency_us)
+        name = EVENT_NAMES.get(kind, str(kind))
+        self.totals[name] = self.totals.get(name, 0) + 1
+        if self._buffered >= self.flush_bytes or time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        for day, data in self._buffer.items():
+            try:
+                with self._active_segment(day).open("ab") as f:
+                    f.write(data)
+                self.written += len(data) // RECORD.size
+            except OSError as e:
+                logging.error(f"Writing analytics events failed: {e}")
+        self._buffer.clear()
+        self._buffered = 0
+        self._flushed_at = time.monotonic()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if _day(time.time()) != self.today:
+                self.flush()
+                self.today = _day(time.time())
+                self._close_days()
+            elif self._buffer:
+                self.flush()
+
+    def start(self):
+        """Loads the log and flushes every ANALYTICS_FLUSH_INTERVAL, also when no events come in."""
+        self.load()
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_periodically())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        self.flush()
+
+    # --- reports ---
+
+    def _own(self, day):
+        if not self._loaded:
+            self.load()
+        return self.days.get(day) or DayRollup()
+
+    def merged_days(self, start, end):
+        """``{day: DayRollup}`` over every writer from ``start`` to ``end`` (inclusive)."""
+        if not self._loaded:
+            self.load()
+        self._refresh_others()
+        merged = {}
+        day = start
+        while day <= end:
+            rollups = self._others(day)
+            if day in self.days:
+                rollups.append(self.days[day])
+            if rollups:
+                rollup = merged[day] = DayRollup()
+                rollup.close()
+                for other in rollups:
+                    rollup.merge(other)
+            day += timedelta(days=1)
+        return merged
+
+    def _all_time(self):
+        """Event counts over every writer and day; call _refresh_others() first."""
+        totals = dict(self.totals)
+        others = [saved[2] for saved in self._saved.values()]
+        others += [rollup.counts for rollup in self._open.values()]
+        for counts in others:
+            for name, count in counts.items():
+                totals[name] = totals.get(name, 0) + count
+        return totals
+
+    def summary(self):
+        """Admin stats text: today's rollup and running totals, no scans."""
+        days = self.merged_days(self.today - timedelta(days=1), self.today)
+        today = days.get(self.today) or DayRollup()
+        yesterday = days.get(self.today - timedelta(days=1)) or DayRollup()
+        totals = self._all_time()
+        hits, misses = today.counts.get("scan_hit", 0), today.counts.get("scan_miss", 0)
+        lines = [f"👥 Active today: {today.dau} (yesterday {yesterday.dau})"]
+        if today.counts:
+            lines.append("📅 Today: " + ", ".join(f"{name} {count}" for name, count in sorted(today.counts.items())))
+        if hits + misses:
+            lines.append(f"🔎 Scan hit rate today: {hits / (hits + misses):.0%}")
+        latencies = [f"{name} {h.quantile(0.5) * 1000:g}/{h.quantile(0.95) * 1000:g}"
+                     for name, h in sorted(today.latency.items()) if h.count]
+        if latencies:
+            lines.append("⏱ p50/p95 ms today: " + ", ".join(latencies))
+        if totals:
+            lines.append("📈 All time: " + ", ".join(f"{name} {count}" for name, count in sorted(totals.items())))
+        return "\n".join(lines)
+
+    def report_csv(self, start, end):
+        """One row per day from ``start`` to ``end`` (dates, inclusive)."""
+        names = list(EVENT_NAMES.values())
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["date", "dau"] + names
+                        + [f"{name}_{q}_ms" for name in names for q in ("p50", "p95")]
+                        + [f"{name}_bytes" for name in names])
+        days = self.merged_days(start, end)
+        day = start
+        while day <= end:
+            rollup = days.get(day) or DayRollup()
+            quantiles = []
+            for name in names:
+                h = rollup.latency.get(name)
+                quantiles += [h.quantile(0.5) * 1000, h.quantile(0.95) * 1000] if h and h.count else ["", ""]
+            writer.writerow([day.isoformat(), rollup.dau] + [rollup.counts.get(name, 0) for name in names]
+                            + quantiles + [rollup.payload_bytes.get(name, 0) for name in names])
+            day += timedelta(days=1)
+        return out.getvalue()
+
+    def stats(self):
+        """This process only, like every other /metrics collector."""
+        return {
+            "events_today": sum(self._own(self.today).counts.values()),
+            "dau": self._own(self.today).dau,
+            "written": self.written,
+            "buffered": self._buffered // RECORD.size,
+            "days": len(self.days),
+        }
+
+
+analytics = Analytics()
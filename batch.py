@@ -0,0 +1,189 @@
+import asyncio
+import csv
+import itertools
+import logging
+import os
+import re
+import time
+import zipfile
+
+from render import ECC_NAMES, ENGINES, FORMATS
+from workers import WorkerPoolBusy
+
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", 20000))
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", 5 * 1024 * 1024))
+BATCH_MAX_PAYLOAD = int(os.getenv("BATCH_MAX_PAYLOAD", 2000))
+BATCH_PROGRESS_INTERVAL = float(os.getenv("BATCH_PROGRESS_INTERVAL", 3))
+# Telegram refuses bot uploads above 50 MB
+BATCH_MAX_ZIP_BYTES = 50 * 1024 * 1024
+# How long a row keeps retrying while the worker pool is full before the batch gives up
+BATCH_BUSY_TIMEOUT = float(os.getenv("BATCH_BUSY_TIMEOUT", 60))
+
+DATA_COLUMNS = ("data", "text", "payload", "content", "url")
+NAME_COLUMNS = ("filename", "file", "name")
+BATCH_EXTENSIONS = (".csv", ".txt")
+
+
+class BatchError(Exception):
+    pass
+
+
+class BatchBusy(BatchError):
+    def __init__(self):
+        super().__init__("The bot is too busy to generate this batch right now, please retry in a few minutes.")
+
+
+def _open_text(path):
+    return open(path, "r", encoding="utf-8-sig", errors="replace", newline="")
+
+
+def _read_csv(path):
+    """Yield ``(data, filename, options)`` rows from a CSV file.
+
+    With a header row, the data column is any of DATA_COLUMNS and the optional
+    name column any of NAME_COLUMNS; ``format``, ``engine`` and ``ecc`` columns are
+    render options. Without a header the first column is the data, the second the name.
+    """
+    with _open_text(path) as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(f, dialect)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [column.strip().lower() for column in header]
+        data_col = next((columns.index(c) for c in DATA_COLUMNS if c in columns), None)
+        if data_col is None:
+            # No header: treat the first line as data too
+            name_col, fmt_col, engine_col, ecc_col = (1 if len(columns) > 1 else None), None, None, None
+            data_col = 0
+            rows = [header]
+        else:
+            name_col = next((columns.index(c) for c in NAME_COLUMNS if c in columns), None)
+            fmt_col = columns.index("format") if "format" in columns else None
+            engine_col = columns.index("engine") if "engine" in columns else None
+            ecc_col = columns.index("ecc") if "ecc" in columns else None
+            rows = []
+
+        def cell(row, index):
+            return row[index].strip() if index is not None and index < len(row) else ""
+
+        for row in itertools.chain(rows, reader):
+            data = cell(row, data_col)
+            if not data:
+                continue
+            options = {}
+            fmt, engine = cell(row, fmt_col).lower(), cell(row, engine_col).lower()
+            if fmt in FORMATS:
+                options["fmt"] = fmt
+            if engine in ENGINES:
+                options["engine"] = engine
+            ecc = cell(row, ecc_col).upper()
+            if ecc in ECC_NAMES:
+                options["ecc"] = ecc
+            yield data, cell(row, name_col), options
+
+
+def _read_lines(path):
+    with _open_text(path) as f:
+        for line in f:
+            data = line.strip()
+            if data:
+                yield data, "", {}
+
+
+def read_rows(path, file_name):
+    if file_name.lower().endswith(".csv"):
+        return _read_csv(path)
+    return _read_lines(path)
+
+
+_UNSAFE = re.compile(r"[^\w.\- ]+")
+
+
+class _Names:
+    """Safe, unique archive names."""
+
+    def __init__(self):
+        self.used = set()
+
+    def make(self, index, wanted, fmt):
+        base = _UNSAFE.sub("_", os.path.splitext(wanted)[0]).strip(" ._")[:80] or f"qr_{index:05d}"
+        name, n = f"{base}.{fmt}", 1
+        while name in self.used:
+            n += 1
+            name = f"{base}_{n}.{fmt}"
+        self.used.add(name)
+        return name
+
+
+async def build_zip(rows, zip_path, render, concurrency, progress=None):
+    """Render every row and stream the images into ``zip_path``.
+
+    At most ``concurrency`` renders are in flight, so memory stays bounded no
+    matter how many rows there are. ``render(data, fmt, engine, ecc)`` returns bytes;
+    ``progress(done, failed)`` is awaited every BATCH_PROGRESS_INTERVAL seconds.
+    Returns ``(done, failed)``.
+    """
+    names = _Names()
+    done = failed = 0
+    last_report = time.monotonic()
+    pending = set()
+
+    async def job(index, data, wanted, options):
+        fmt = options.get("fmt", "png")
+        if len(data) > BATCH_MAX_PAYLOAD:
+            raise BatchError(f"row {index}: payload longer than {BATCH_MAX_PAYLOAD} characters")
+        deadline = time.monotonic() + BATCH_BUSY_TIMEOUT
+        while True:
+            try:
+                image = await render(data, fmt, options.get("engine"), options.get("ecc"))
+                return names.make(index, wanted, fmt), image
+            except WorkerPoolBusy:
+                # Interactive users come first; wait for the pool to drain a bit
+                if time.monotonic() >= deadline:
+                    raise BatchBusy()
+                await asyncio.sleep(0.5)
+
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as archive:
+        async def drain(wait_for):
+            nonlocal done, failed
+            finished, _ = await asyncio.wait(pending, return_when=wait_for)
+            for task in finished:
+                pending.discard(task)
+                try:
+                    name, image = task.result()
+                except BatchBusy:
+                    raise
+                except Exception as e:
+                    logging.warning(f"Batch row failed: {e}")
+                    failed += 1
+                    continue
+                # PNG/WebP are already compressed, storing avoids recompressing
+                archive.writestr(name, image)
+                done += 1
+                if archive.fp.tell() > BATCH_MAX_ZIP_BYTES:
+                    raise BatchError("The ZIP is larger than 50 MB, please split the file.")
+
+        try:
+            for index, (data, wanted, options) in enumerate(rows, start=1):
+                if index > BATCH_MAX_ROWS:
+                    raise BatchError(f"Too many rows, the limit is {BATCH_MAX_ROWS}.")
+                pending.add(asyncio.ensure_future(job(index, data, wanted, options)))
+                if len(pending) >= concurrency:
+                    await drain(asyncio.FIRST_COMPLETED)
+                if progress and time.monotonic() - last_report >= BATCH_PROGRESS_INTERVAL:
+                    await progress(done, failed)
+                    last_report = time.monotonic()
+            if pending:
+                await drain(asyncio.ALL_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+            # Collects the other rows' results when a busy pool or the size limit ends the batch
+            await asyncio.gather(*pending, return_exceptions=True)
+    return done, failed
@@ -0,0 +1,157 @@
+"""Accuracy and latency of each decoder backend on a corpus of test images.
+
+    python benchmarks/decode_bench.py
+    python benchmarks/decode_bench.py --backends pyzbar,zxing --out benchmarks/results/decoders.json
+    python benchmarks/decode_bench.py --corpus path/to/photos   # labels.json: {"file.jpg": ["payload", ...]}
+
+Without --corpus a synthetic corpus is generated (seeded, so runs compare):
+small, rotated, blurred, noisy, low-contrast, inverted, skewed, JPEG-mangled
+and multi-code images. --write-corpus saves it with its labels.json.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import qrcode  # noqa: E402
+from PIL import Image, ImageFilter, ImageOps  # noqa: E402
+
+from decoders import BACKENDS, MultiDecoder  # noqa: E402
+
+
+def _code(payload, size):
+    return qrcode.make(payload, border=2).get_image().convert("L").resize((size, size), Image.NEAREST)
+
+
+def _canvas(code, size=1000, background=235):
+    canvas = Image.new("L", (size, size), background)
+    canvas.paste(code, ((size - code.width) // 2, (size - code.height) // 2))
+    return canvas
+
+
+def _jpeg(img, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue())).convert("L")
+
+
+def _noisy(img, rng, amount=40):
+    noise = Image.effect_noise(img.size, amount)
+    return Image.blend(img, noise, 0.45)
+
+
+def synthetic_corpus(per_kind=6, seed=1):
+    """Yields ``(name, gray image, [payloads])``."""
+    rng = random.Random(seed)
+    kinds = {
+        "clean": lambda c: _canvas(c),
+        "small": lambda c: _canvas(c.resize((70, 70), Image.BILINEAR), 1600),
+        "rotated": lambda c: _canvas(c).rotate(rng.uniform(10, 40), fillcolor=235),
+        "blurred": lambda c: _canvas(c).filter(ImageFilter.GaussianBlur(rng.uniform(2.5, 4.5))),
+        "noisy": lambda c: _noisy(_canvas(c), rng),
+        "low_contrast": lambda c: _canvas(c.point(lambda v: 132 if v else 150), background=150),
+        "inverted": lambda c: ImageOps.invert(_canvas(c)),
+        "skewed": lambda c: _canvas(c).transform((1000, 1000), Image.AFFINE, (1, rng.uniform(0.15, 0.3), -120, 0, 1, 0),
+                                                 fillcolor=235),
+        "jpeg_q5": lambda c: _jpeg(_canvas(c.resize((160, 160))), 5),
+    }
+    for kind, make in kinds.items():
+        for i in range(per_kind):
+            payload = f"https://example.com/{kind}/{i}/{rng.randrange(10 ** 6)}"
+            yield f"{kind}_{i}", make(_code(payload, rng.randrange(250, 450))), [payload]
+    for i in range(per_kind):
+        payloads = [f"multi-{i}-{n}" for n in range(3)]
+        canvas = Image.new("L", (1500, 600), 235)
+        for n, payload in enumerate(payloads):
+            canvas.paste(_code(payload, 300), (100 + n * 450, 150))
+        yield f"multi_{i}", canvas, payloads
+
+
+def load_corpus(directory):
+    directory = Path(directory)
+    labels = json.loads((directory / "labels.json").read_text())
+    for file_name, payloads in labels.items():
+        with Image.open(directory / file_name) as img:
+            yield file_name, img.convert("L"), payloads
+
+
+def evaluate(decoder, corpus):
+    latencies, found, expected, exact, false_positives = [], 0, 0, 0, 0
+    by_kind = {}
+    for name, gray, payloads in corpus:
+        started = time.perf_counter()
+        symbols = decoder.decode(gray)
+        latencies.append((time.perf_counter() - started) * 1000)
+        decoded = {symbol.data for symbol in symbols}
+        hits = len(decoded & set(payloads))
+        found += hits
+        expected += len(payloads)
+        exact += hits == len(payloads)
+        false_positives += len(decoded - set(payloads))
+        kind = name.rsplit("_", 1)[0]
+        ok, total = by_kind.get(kind, (0, 0))
+        by_kind[kind] = (ok + (hits == len(payloads)), total + 1)
+    return {
+        "images": len(latencies),
+        "recall": round(found / max(1, expected), 3),
+        "images_fully_decoded": exact,
+        "false_positives": false_positives,
+        "median_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(sorted(latencies)[int(0.95 * (len(latencies) - 1))], 2),
+        "by_kind": {kind: f"{ok}/{total}" for kind, (ok, total) in by_kind.items()},
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Compare decoder backends on a corpus")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="comma-separated backends to try")
+    parser.add_argument("--corpus", help="directory with images and labels.json (default: synthetic)")
+    parser.add_argument("--per-kind", type=int, default=6, help="synthetic images per distortion")
+    parser.add_argument("--write-corpus", help="save the synthetic corpus and labels.json here")
+    parser.add_argument("--out", help="write the JSON results here")
+    args = parser.parse_args()
+
+    corpus = list(load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.per_kind))
+    if args.write_corpus:
+        target = Path(args.write_corpus)
+        target.mkdir(parents=True, exist_ok=True)
+        for name, gray, _ in corpus:
+            gray.save(target / f"{name}.png")
+        (target / "labels.json").write_text(json.dumps({f"{name}.png": p for name, _, p in corpus}, indent=2))
+
+    backends = [b for b in (BACKENDS[name]() for name in args.backends.split(",")) if b.available()]
+    skipped = sorted(set(args.backends.split(",")) - {b.name for b in backends})
+    if not backends:
+        sys.exit("None of the requested backends is installed.")
+
+    results = {}
+    for backend in backends:
+        results[backend.name] = evaluate(MultiDecoder([backend]), corpus)
+    if len(backends) > 1:
+        results["sequential"] = evaluate(MultiDecoder(backends, "sequential"), corpus)
+        results["race"] = evaluate(MultiDecoder(backends, "race"), corpus)
+
+    print(f"{'backend':<12} {'recall':>7} {'full':>6} {'fp':>4} {'median_ms':>10} {'p95_ms':>8}")
+    for name, r in results.items():
+        print(f"{name:<12} {r['recall']:7.1%} {r['images_fully_decoded']:>6} {r['false_positives']:>4} "
+              f"{r['median_ms']:10.2f} {r['p95_ms']:8.2f}")
+    if skipped:
+        print(f"not installed: {', '.join(skipped)}")
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps({
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "cpus": os.cpu_count(),
+            "corpus": args.corpus or f"synthetic x{args.per_kind}", "results": results,
+        }, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,134 @@
+"""Local stand-in for the Telegram Bot API, good enough to drive the bot's handlers.
+
+    python benchmarks/fake_api.py --port 8765
+    BOT_API_SERVER=http://127.0.0.1:8765 BOT_TOKEN=123456:fake python main.py
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from itertools import count
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "QRBeam", "username": "qrbeam_bot"}
+FAKE_TOKEN = "123456:AAFakeTokenForBenchmarksOnly0000000000"
+
+
+class FakeBotAPI:
+    """Answers Bot API methods from memory and serves uploaded files back.
+
+    ``latency`` adds a fixed delay to every call, to mimic the network.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.files = {}
+        self.updates = asyncio.Queue()
+        self._ids = count(1)
+        self._runner = None
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self.app.router.add_get("/file/bot{token}/{path:.*}", self.download)
+
+    def add_file(self, data: bytes, prefix="photo"):
+        file_id = f"{prefix}-{next(self._ids)}"
+        self.files[file_id] = data
+        return file_id
+
+    def push_update(self, update: dict):
+        self.updates.put_nowait(update)
+
+    def _message(self, params, **extra):
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0) or 0), "type": "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    async def _file_param(self, value, prefix):
+        if isinstance(value, web.FileField):
+            return self.add_file(value.file.read(), prefix)
+        return value
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = dict(await request.post()) if request.can_read_body else dict(request.query)
+        result = await self.dispatch(method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def dispatch(self, method, params):
+        if method == "getme":
+            return BOT_USER
+        if method == "getupdates":
+            return await self._get_updates(params)
+        if method in ("sendmessage", "editmessagetext"):
+            return self._message(params, text=params.get("text", ""))
+        if method == "sendphoto":
+            file_id = await self._file_param(params.get("photo"), "photo")
+            size = {"file_id": file_id, "file_unique_id": file_id, "width": 290, "height": 290}
+            return self._message(params, photo=[size])
+        if method == "senddocument":
+            file_id = await self._file_param(params.get("document"), "document")
+            return self._message(params, document={"file_id": file_id, "file_unique_id": file_id})
+        if method == "getfile":
+            file_id = params.get("file_id")
+            data = self.files.get(file_id, b"")
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data),
+                    "file_path": f"files/{file_id}"}
+        # answerInlineQuery, answerCallbackQuery, deleteMessage, setMyCommands, ...
+        return True
+
+    async def _get_updates(self, params):
+        timeout = float(params.get("timeout", 0) or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout or 0.01))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(updates) < 100:
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def download(self, request: web.Request):
+        self.calls["download"] += 1
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        if file_id not in self.files:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.files[file_id])
+
+    async def start(self, host="127.0.0.1", port=8765):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    async def serve():
+        api = FakeBotAPI(args.latency)
+        print(f"Fake Bot API on {await api.start(args.host, args.port)}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            print(json.dumps(api.calls, indent=2))
+            await api.stop()
+
+    asyncio.run(serve())
@@ -0,0 +1,198 @@
+"""Replay a traffic mix against the real handlers in main.py, talking to a fake Bot API.
+
+    python benchmarks/load_test.py --updates 2000 --concurrency 64
+    python benchmarks/load_test.py --mix start=1,scan=4 --out benchmarks/results/scan_heavy.json
+
+Reports throughput and p50/p95/p99 latency per scenario, and the outbound
+queue wait per priority class. Per-user admission limits and the outbound
+rate limits are lifted unless --keep-limits is given, so handler cost is measured.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fake_api import FAKE_TOKEN, FakeBotAPI  # noqa: E402
+
+DEFAULT_MIX = "start=30,generate=25,scan=20,inline=20,wifi=5"
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(max(latencies, default=0.0), 2),
+    }
+
+
+class Traffic:
+    """Builds Update payloads for each scenario."""
+
+    def __init__(self, photo_ids, users):
+        self.photo_ids = photo_ids
+        self.users = users
+        self.update_id = 0
+        self.message_id = 0
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+    def message(self, user_id, text=None, **extra):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), **extra,
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self.update_id, "message": message}
+
+    def inline(self, user_id, query):
+        self.update_id += 1
+        return {"update_id": self.update_id, "inline_query": {
+            "id": str(self.update_id), "from": self._user(user_id), "query": query, "offset": "",
+        }}
+
+    def scenario(self, name):
+        """Updates for one scenario run; multi-step flows are sent in order."""
+        user_id = random.randint(1000, 1000 + self.users)
+        if name == "start":
+            return [self.message(user_id, "/start")]
+        if name == "generate":
+            return [self.message(user_id, f"/generate https://example.com/{random.randint(0, 500)}")]
+        if name == "scan":
+            file_id = random.choice(self.photo_ids)
+            size = {"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 800}
+            return [self.message(user_id, photo=[size])]
+        if name == "inline":
+            text = f"https://example.com/item/{random.randint(0, 200)}"
+            return [self.inline(user_id, text[:n]) for n in range(len(text) - 3, len(text) + 1)]
+        if name == "wifi":
+            return [self.message(user_id, "/wifiqr"), self.message(user_id, f"Net{user_id}"),
+                    self.message(user_id, "secret-password")]
+        raise ValueError(f"Unknown scenario: {name}")
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+async def run(args):
+    api = FakeBotAPI(latency=args.api_latency)
+    base_url = await api.start(port=args.port)
+
+    data_dir = tempfile.mkdtemp(prefix="qrbeam-bench-")
+    os.environ.update({
+        "BOT_TOKEN": FAKE_TOKEN,
+        "BOT_API_SERVER": base_url,
+        "STATS_DB": os.path.join(data_dir, "users.db"),
+        "FSM_DB": os.path.join(data_dir, "fsm.db"),
+        "FILE_IDS_FILE": os.path.join(data_dir, "file_ids.json"),
+        "FILE_IDS_DB": os.path.join(data_dir, "file_ids.db"),
+        "BROADCAST_DIR": os.path.join(data_dir, "broadcasts"),
+        "ANALYTICS_DIR": os.path.join(data_dir, "analytics"),
+        "INLINE_DEBOUNCE": "0",
+    })
+    if not args.keep_limits:
+        for kind in ("SCAN", "GENERATE", "INLINE"):
+            os.environ.setdefault(f"ADMISSION_{kind}_PER_MINUTE", "1000000")
+            os.environ.setdefault(f"ADMISSION_{kind}_BURST", "1000000")
+        for name in ("OUTBOUND_RATE", "OUTBOUND_PER_CHAT_RATE", "OUTBOUND_PER_CHAT_BURST"):
+            os.environ.setdefault(name, "1000000")
+
+    import main
+    from aiogram import Bot, Dispatcher, types
+    from render import render_qr
+
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    photo_ids = [api.add_file(render_qr(f"https://example.com/poster/{i}", "jpeg")) for i in range(20)]
+    traffic = Traffic(photo_ids, args.users)
+    weights = parse_mix(args.mix)
+    names = random.choices(list(weights), weights=list(weights.values()), k=args.updates)
+
+    latencies = {name: [] for name in weights}
+    errors = {name: 0 for name in weights}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def play(name):
+        async with semaphore:
+            for update in traffic.scenario(name):
+                started = time.perf_counter()
+                try:
+                    # Own task per update, like the executor: aiogram caches FSM state in context vars
+                    await asyncio.ensure_future(main.dp.process_update(types.Update(**update)))
+                except Exception:
+                    errors[name] += 1
+                latencies[name].append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(play(name) for name in names))
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(values) for values in latencies.values())
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {"updates": args.updates, "concurrency": args.concurrency, "mix": args.mix,
+                   "users": args.users, "api_latency": args.api_latency},
+        "elapsed_s": round(elapsed, 3),
+        "throughput_updates_per_s": round(total / elapsed, 1),
+        "handlers": {name: dict(summarize(values), errors=errors[name]) for name, values in latencies.items()},
+        "api_calls": dict(api.calls),
+        "outbound": main.bot.stats(),
+    }
+    await main.on_shutdown(main.dp)
+    await (await main.bot.get_session()).close()
+    await api.stop()
+    return report
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Load-test the bot handlers against a fake Bot API")
+    parser.add_argument("--updates", type=int, default=1000, help="scenario runs to replay")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"scenario weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--users", type=int, default=500, help="distinct simulated users")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds added to each API call")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--keep-limits", action="store_true", help="keep per-user admission and outbound rate limits")
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
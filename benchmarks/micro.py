@@ -0,0 +1,138 @@
+"""Micro-benchmarks for the hot paths: QR encoding, PNG encoding and decoding.
+
+    python benchmarks/micro.py --out benchmarks/results/micro.json
+    python benchmarks/micro.py --compare benchmarks/results/micro.json
+
+Every case is timed over ``--rounds`` runs; the median is reported in ms.
+With --compare, cases more than ``--tolerance`` slower than the saved run are
+flagged and the exit code is 1.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import qrcode  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from render import matrix_to_png, qr_matrix, render_qr  # noqa: E402
+
+PAYLOAD_SIZES = (16, 128, 512, 2048)
+IMAGE_SIZES = (400, 1200, 3000)
+
+
+def _payload(size):
+    return ("https://example.com/" + "x" * size)[:size]
+
+
+def measure(func, rounds):
+    func()  # warm-up
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - started) * 1000)
+    return {"median_ms": round(statistics.median(times), 3), "min_ms": round(min(times), 3)}
+
+
+def _photo(size):
+    """A QR code placed on a larger canvas, saved as JPEG like a phone photo."""
+    code = qrcode.make("https://example.com/poster/42").get_image().convert("L")
+    side = size // 2
+    canvas = Image.new("L", (size, size), 200)
+    canvas.paste(code.resize((side, side)), (size // 4, size // 4))
+    buffer = io.BytesIO()
+    canvas.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def cases():
+    for size in PAYLOAD_SIZES:
+        payload = _payload(size)
+        matrix = qr_matrix(payload)
+        yield f"qrcode.make/{size}", lambda payload=payload: qrcode.make(payload)
+        yield f"qr_matrix/{size}", lambda payload=payload: qr_matrix(payload)
+        yield f"qr_matrix.mask0/{size}", lambda payload=payload: qr_matrix(payload, mask=0)
+        yield f"matrix_to_png/{size}", lambda matrix=matrix: matrix_to_png(matrix)
+        yield f"render_qr.png/{size}", lambda payload=payload: render_qr(payload, "png")
+        yield f"render_qr.jpeg/{size}", lambda payload=payload: render_qr(payload, "jpeg")
+
+    try:
+        from pyzbar.pyzbar import decode
+    except ImportError as e:
+        print(f"Skipping decode benchmarks: {e}", file=sys.stderr)
+        return
+    from scanner import scan_bytes
+
+    for size in IMAGE_SIZES:
+        data = _photo(size)
+        gray = Image.open(io.BytesIO(data)).convert("L")
+        yield f"pyzbar.decode/{size}px", lambda gray=gray: decode(gray)
+        yield f"scan_bytes/{size}px", lambda data=data: scan_bytes(data)
+
+
+def run(rounds, only=None):
+    results = {}
+    for name, func in cases():
+        if only and only not in name:
+            continue
+        results[name] = measure(func, rounds)
+        print(f"{name:<28} {results[name]['median_ms']:10.3f} ms", file=sys.stderr)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "rounds": rounds,
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Returns the names of cases that got slower than ``tolerance`` allows."""
+    regressions = []
+    print(f"{'case':<28} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in report["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        change = result["median_ms"] / before["median_ms"] - 1 if before["median_ms"] else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  << slower"
+        print(f"{name:<28} {before['median_ms']:10.3f} {result['median_ms']:10.3f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for QR encoding and decoding")
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--only", help="run only cases whose name contains this")
+    parser.add_argument("--out", help="write the JSON results here")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown (default: 0.15)")
+    args = parser.parse_args()
+
+    report = run(args.rounds, args.only)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps(report, indent=2))
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+    elif not args.out:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
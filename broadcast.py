@@ -0,0 +1,253 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+
+from aiogram.utils.exceptions import (
+    BotBlocked, BotKicked, CantInitiateConversation, ChatNotFound,
+    RetryAfter, TelegramAPIError, UserDeactivated,
+)
+
+import stats
+from outbound import BULK, priority
+
+BROADCAST_DIR = Path(os.getenv("BROADCAST_DIR", "broadcasts"))
+# Sends in flight; their rate is the outbound scheduler's (bulk class)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+# Acknowledged sends between checkpoint writes: a crash re-sends at most this many
+# plus the ones in flight
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", 1))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+
+# Users that can never receive messages again are removed from the user store
+GONE_ERRORS = (BotBlocked, BotKicked, UserDeactivated, ChatNotFound, CantInitiateConversation)
+
+MEDIA_KINDS = ("photo", "video", "animation", "document", "audio", "voice")
+
+
+class UnsupportedBroadcast(ValueError):
+    def __init__(self, content_type):
+        super().__init__(f"Can't broadcast {content_type.replace('_', ' ')} messages. "
+                         f"Send text, a photo, video, animation, document, audio or voice message.")
+
+
+class BroadcastJob:
+    """A broadcast and its checkpoint.
+
+    Users are sent to in ascending id order, so ``cursor`` (the last id up to
+    which every send has finished) plus ``ahead`` (sends past it that finished
+    out of order) is enough to resume after a restart. The checkpoint is
+    deleted once the job is done.
+    """
+
+    def __init__(self, admin_chat_id, kind, text=None, file_id=None, parse_mode=None,
+                 job_id=None, cursor=0, ahead=(), sent=0, failed=0, pruned=0, total=0,
+                 status_message_id=None, created=None, done=False):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.admin_chat_id = admin_chat_id
+        self.kind = kind
+        self.text = text
+        self.file_id = file_id
+        self.parse_mode = parse_mode
+        self.cursor = cursor
+        self.ahead = list(ahead)
+        self.sent = sent
+        self.failed = failed
+        self.pruned = pruned
+        self.total = total
+        self.status_message_id = status_message_id
+        self.created = created or time.time()
+        self.done = done
+
+    @classmethod
+    def from_message(cls, message, parse_mode=None):
+        """Raises UnsupportedBroadcast for stickers, polls, video notes and the like."""
+        kind = message.content_type
+        file_id = None
+        if kind in MEDIA_KINDS:
+            content = getattr(message, kind)
+            # Media is already on Telegram's servers: every send reuses this file_id
+            file_id = content[-1].file_id if kind == "photo" else content.file_id
+        elif kind != "text":
+            raise UnsupportedBroadcast(kind)
+        return cls(message.chat.id, kind, text=message.text or message.caption,
+                   file_id=file_id, parse_mode=parse_mode)
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.pruned
+
+    def to_dict(self):
+        return {
+            "job_id": self.id, "admin_chat_id": self.admin_chat_id, "kind": self.kind,
+            "text": self.text, "file_id": self.file_id, "parse_mode": self.parse_mode,
+            "cursor": self.cursor, "ahead": self.ahead, "sent": self.sent, "failed": self.failed,
+            "pruned": self.pruned, "total": self.total,
+            "status_message_id": self.status_message_id, "created": self.created, "done": self.done,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class BroadcastManager:
+    def __init__(self, bot, directory=BROADCAST_DIR, concurrency=BROADCAST_CONCURRENCY):
+        self.bot = bot
+        self.directory = Path(directory)
+        self.concurrency = concurrency
+        self.jobs = {}
+        self._tasks = {}
+
+    def _path(self, job):
+        return self.directory / f"{job.id}.json"
+
+    def save(self, job):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(job)
+        tmp = path.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp, path)
+
+    def start(self, job):
+        self.jobs[job.id] = job
+        self.save(job)
+        # The task copies the context here, so all of its sends queue as bulk traffic
+        with priority(BULK):
+            self._tasks[job.id] = asyncio.ensure_future(self._run(job))
+        return job
+
+    def resume_all(self):
+        """Restart every unfinished job found on disk; call once on startup."""
+        if not self.directory.exists():
+            return []
+        resumed = []
+        for path in sorted(self.directory.glob("*.json")):
+            try:
+                with path.open("r", encoding="utf-8") as f:
+                    job = BroadcastJob.from_dict(json.load(f))
+            except (OSError, json.JSONDecodeError, TypeError) as e:
+                logging.error(f"Skipping broken broadcast checkpoint {path}: {e}")
+                continue
+            if job.done:  # finished before checkpoints were removed on completion
+                path.unlink(missing_ok=True)
+            elif job.id not in self._tasks:
+                logging.info(f"Resuming broadcast {job.id} after user {job.cursor}")
+                resumed.append(self.start(job))
+        return resumed
+
+    async def _send(self, job, chat_id):
+        if job.kind == "text":
+            return await self.bot.send_message(chat_id, job.text, parse_mode=job.parse_mode)
+        send = getattr(self.bot, f"send_{job.kind}")
+        return await send(chat_id, job.file_id, caption=job.text, parse_mode=job.parse_mode)
+
+    async def _deliver(self, job, user_id):
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            try:
+                await self._send(job, user_id)
+                job.sent += 1
+                return
+            except RetryAfter as e:
+                # The outbound scheduler holds this chat for e.timeout; the retry waits there
+                logging.warning(f"Broadcast {job.id}: flood control on {user_id}, retrying in {e.timeout}s")
+            except GONE_ERRORS as e:
+                logging.info(f"Broadcast {job.id}: removing user {user_id} ({e})")
+                stats.delete_user(user_id)
+                job.pruned += 1
+                return
+            except TelegramAPIError as e:
+                logging.warning(f"Failed to send to {user_id}: {e}")
+                break
+        job.failed += 1
+
+    async def _run(self, job):
+        ahead = set(job.ahead)
+        users = [user_id for user_id in stats.get_users() if user_id > job.cursor and user_id not in ahead]
+        if not job.total:
+            job.total = len(users)
+        await self._report(job)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_report = time.monotonic()
+        in_flight = collections.deque()  # (user_id, task) in id order
+        unsaved = 0
+
+        async def deliver(user_id):
+            try:
+                await self._deliver(job, user_id)
+            finally:
+                semaphore.release()
+
+        def checkpoint():
+            nonlocal unsaved
+            job.ahead = [user_id for user_id in ahead if user_id > job.cursor]
+            job.ahead += [user_id for user_id, task in in_flight if task.done() and not task.cancelled()]
+            self.save(job)
+            unsaved = 0
+
+        def advance():
+            """Moves the cursor over the sends that have finished, in id order."""
+            nonlocal unsaved
+            while in_flight and in_flight[0][1].done() and not in_flight[0][1].cancelled():
+                user_id, task = in_flight.popleft()
+                task.result()
+                job.cursor = user_id
+                unsaved += 1
+            if unsaved >= BROADCAST_CHECKPOINT_EVERY:
+                checkpoint()
+
+        try:
+            for user_id in users:
+                await semaphore.acquire()
+                in_flight.append((user_id, asyncio.ensure_future(deliver(user_id))))
+                advance()
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    await self._report(job)
+                    last_report = time.monotonic()
+            while in_flight:
+                await asyncio.wait([in_flight[0][1]])
+                advance()
+            job.done = True
+            await self._report(job)
+            self._path(job).unlink(missing_ok=True)
+        except asyncio.CancelledError:
+            for _, task in in_flight:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in in_flight), return_exceptions=True)
+            advance()
+            checkpoint()
+            raise
+        finally:
+            self._tasks.pop(job.id, None)
+
+    def progress_text(self, job):
+        state = "✅ Broadcast finished" if job.done else "📢 Broadcasting..."
+        return (
+            f"{state}\n"
+            f"Progress: {job.processed}/{job.total}\n"
+            f"Sent: {job.sent} | Failed: {job.failed} | Removed: {job.pruned}"
+        )
+
+    async def _report(self, job):
+        text = self.progress_text(job)
+        try:
+            if job.status_message_id:
+                await self.bot.edit_message_text(text, job.admin_chat_id, job.status_message_id)
+            else:
+                message = await self.bot.send_message(job.admin_chat_id, text)
+                job.status_message_id = message.message_id
+                self.save(job)
+        except TelegramAPIError as e:
+            logging.warning(f"Broadcast {job.id}: progress update failed: {e}")
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,149 @@
+import asyncio
+import csv
+import logging
+import os
+import time
+import zipfile
+
+from decoders import decode
+from lazy import lazy_import
+from workers import WorkerPoolBusy
+
+Image = lazy_import("PIL.Image")
+
+BULK_SCAN_MAX_BYTES = int(os.getenv("BULK_SCAN_MAX_BYTES", 20 * 1024 * 1024))
+BULK_SCAN_MAX_ENTRIES = int(os.getenv("BULK_SCAN_MAX_ENTRIES", 500))
+BULK_SCAN_MAX_ENTRY_BYTES = int(os.getenv("BULK_SCAN_MAX_ENTRY_BYTES", 25 * 1024 * 1024))
+BULK_SCAN_MAX_FRAMES = int(os.getenv("BULK_SCAN_MAX_FRAMES", 200))
+BULK_SCAN_MAX_PIXELS = int(os.getenv("BULK_SCAN_MAX_PIXELS", 40_000_000))
+# Frames of a TIFF/GIF decoded per worker job (a GIF can only seek by decoding the frames before)
+BULK_SCAN_FRAMES_PER_JOB = int(os.getenv("BULK_SCAN_FRAMES_PER_JOB", 4))
+# How long a scan keeps retrying while the worker pool is full before giving up
+BULK_SCAN_BUSY_TIMEOUT = float(os.getenv("BULK_SCAN_BUSY_TIMEOUT", 60))
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+MULTI_FRAME_EXTENSIONS = (".tif", ".tiff", ".gif", ".webp")
+CSV_HEADER = ("file", "frame", "type", "payload", "left", "top", "width", "height")
+
+
+class BulkScanError(Exception):
+    pass
+
+
+class BulkScanBusy(BulkScanError):
+    def __init__(self):
+        super().__init__("The bot is too busy to scan this file right now, please retry in a few minutes.")
+
+
+def _frame_count(img):
+    return min(getattr(img, "n_frames", 1), BULK_SCAN_MAX_FRAMES)
+
+
+def _scan_frames(name, img, start=0, stop=None):
+    """Decode frames ``start``..``stop`` (default: all) of an opened image; one CSV row per symbol."""
+    rows = []
+    for index in range(start, _frame_count(img) if stop is None else stop):
+        img.seek(index)
+        width, height = img.size
+        if width * height > BULK_SCAN_MAX_PIXELS:
+            raise BulkScanError(f"{name}: frame {index} is larger than {BULK_SCAN_MAX_PIXELS} pixels")
+        for symbol in decode(img.convert("L")):
+            rect = symbol.rect
+            rows.append((name, index, symbol.type, symbol.data,
+                         rect.left, rect.top, rect.width, rect.height))
+    return rows
+
+
+def scan_archive_entry(zip_path, name):
+    """Worker job: read one entry of the archive and decode it; nothing else is loaded."""
+    with zipfile.ZipFile(zip_path) as archive:
+        with archive.open(name) as f, Image.open(f) as img:
+            return _scan_frames(name, img)
+
+
+def count_frames(path):
+    """Worker job: frames of a multi-page TIFF or animated image, up to BULK_SCAN_MAX_FRAMES."""
+    with Image.open(path) as img:
+        return _frame_count(img)
+
+
+def scan_frames_file(path, name, start, stop):
+    """Worker job: decode one run of frames of a multi-page TIFF or animated image."""
+    with Image.open(path) as img:
+        return _scan_frames(name, img, start, stop)
+
+
+def archive_entries(zip_path):
+    """Image entries of the archive, after checking the count and size limits."""
+    with zipfile.ZipFile(zip_path) as archive:
+        entries = [info for info in archive.infolist()
+                   if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)]
+    if len(entries) > BULK_SCAN_MAX_ENTRIES:
+        raise BulkScanError(f"The archive has {len(entries)} images, the limit is {BULK_SCAN_MAX_ENTRIES}.")
+    too_big = next((info.filename for info in entries if info.file_size > BULK_SCAN_MAX_ENTRY_BYTES), None)
+    if too_big:
+        raise BulkScanError(f"{too_big} is larger than {BULK_SCAN_MAX_ENTRY_BYTES // (1024 * 1024)} MB.")
+    return [info.filename for info in entries]
+
+
+def is_bulk_document(file_name):
+    return file_name.lower().endswith((".zip",) + MULTI_FRAME_EXTENSIONS)
+
+
+async def scan_document(path, file_name, csv_path, run, concurrency, frames=None):
+    """Scan a ZIP of images or a multi-frame image and write the results as CSV.
+
+    ``run(func, *args)`` executes a job in the worker pool: one job per archive
+    entry, or per BULK_SCAN_FRAMES_PER_JOB frames. At most ``concurrency`` jobs
+    run at the same time; ``frames`` is the frame count when already known.
+    Returns ``(images, codes, failed)``.
+    """
+    deadline = time.monotonic() + BULK_SCAN_BUSY_TIMEOUT
+
+    async def submit(func, *args):
+        while True:
+            try:
+                return await run(func, *args)
+            except WorkerPoolBusy:
+                if time.monotonic() >= deadline:
+                    raise BulkScanBusy()
+                await asyncio.sleep(0.5)
+
+    if file_name.lower().endswith(".zip"):
+        jobs = [(1, scan_archive_entry, path, name) for name in archive_entries(path)]
+    else:
+        name = os.path.basename(file_name)
+        if frames is None:
+            frames = await submit(count_frames, path)
+        jobs = [(min(BULK_SCAN_FRAMES_PER_JOB, frames - start), scan_frames_file, path, name,
+                 start, min(start + BULK_SCAN_FRAMES_PER_JOB, frames))
+                for start in range(0, frames, BULK_SCAN_FRAMES_PER_JOB)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def scan(images, func, *args):
+        async with semaphore:
+            try:
+                return images, await submit(func, *args)
+            except BulkScanBusy:
+                raise
+            except Exception as e:
+                logging.warning(f"Bulk scan entry failed: {e}")
+                return images, None
+
+    tasks = [asyncio.ensure_future(scan(*job)) for job in jobs]
+    codes = failed = 0
+    try:
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+            for future in asyncio.as_completed(tasks):
+                images, rows = await future
+                if rows is None:
+                    failed += images
+                    continue
+                writer.writerows(rows)
+                codes += len(rows)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return sum(job[0] for job in jobs), codes, failed
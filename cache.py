@@ -0,0 +1,262 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+RENDER_CACHE_BYTES = int(os.getenv("RENDER_CACHE_BYTES", 32 * 1024 * 1024))
+# Legacy JSON map, imported into FILE_IDS_DB once
+FILE_IDS_FILE = Path(os.getenv("FILE_IDS_FILE", "qr_file_ids.json"))
+# Shared by every shard; the oldest uploads are dropped past FILE_IDS_MAX
+FILE_IDS_DB = Path(os.getenv("FILE_IDS_DB", "qr_file_ids.db"))
+FILE_IDS_MAX = int(os.getenv("FILE_IDS_MAX", 200000))
+SCAN_CACHE_SIZE = int(os.getenv("SCAN_CACHE_SIZE", 10000))
+# Seconds a decode result stays valid; 0 keeps it until evicted
+SCAN_CACHE_TTL = float(os.getenv("SCAN_CACHE_TTL", 7 * 24 * 3600))
+# Unset keeps the scan cache in memory only
+SCAN_CACHE_FILE = os.getenv("SCAN_CACHE_FILE")
+SCAN_CACHE_SAVE_INTERVAL = float(os.getenv("SCAN_CACHE_SAVE_INTERVAL", 60))
+
+
+def payload_key(payload: str, **params) -> str:
+    """Content address for a QR: hash of the payload plus its render parameters."""
+    raw = json.dumps([payload, sorted(params.items())], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """Two-level QR cache.
+
+    Level 1 is an in-memory LRU of encoded images, evicted by total size.
+    Level 2 is a persistent payload-hash -> Telegram file_id map in SQLite, so a
+    QR that was uploaded once can be re-sent without rendering or uploading
+    again, by any shard.
+    """
+
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES, file_ids_db=FILE_IDS_DB, file_ids_path=FILE_IDS_FILE,
+                 max_file_ids=FILE_IDS_MAX):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._images = OrderedDict()
+        self.max_file_ids = max_file_ids
+        self._conn = sqlite3.connect(str(file_ids_db), isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_ids (
+                key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_file_ids_created ON file_ids(created)")
+        self._migrate_json(Path(file_ids_path))
+        self._inserts = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.file_id_hits = 0
+        self.file_id_misses = 0
+
+    key = staticmethod(payload_key)
+
+    def _migrate_json(self, json_path):
+        if not json_path.exists():
+            return
+        try:
+            with json_path.open("r", encoding="utf-8") as f:
+                file_ids = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error reading {json_path} for migration: {e}")
+            return
+        now = time.time()
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR IGNORE INTO file_ids (key, file_id, created) VALUES (?, ?, ?)",
+                                   [(key, file_id, now) for key, file_id in file_ids.items()])
+        json_path.rename(json_path.with_suffix(".json.migrated"))
+        logging.info(f"Migrated {len(file_ids)} file_ids from {json_path}")
+
+    def get_image(self, key):
+        data = self._images.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._images.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put_image(self, key, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        old = self._images.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._images[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def get_file_id(self, key):
+        row = self._conn.execute("SELECT file_id FROM file_ids WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.file_id_misses += 1
+            return None
+        self.file_id_hits += 1
+        return row[0]
+
+    def has_file_id(self, key):
+        return self._conn.execute("SELECT 1 FROM file_ids WHERE key = ?", (key,)).fetchone() is not None
+
+    def set_file_id(self, key, file_id):
+        try:
+            self._conn.execute("INSERT OR REPLACE INTO file_ids (key, file_id, created) VALUES (?, ?, ?)",
+                               (key, file_id, time.time()))
+            self._inserts += 1
+            if self._inserts % 1000 == 0:
+                self._trim()
+        except sqlite3.Error as e:
+            logging.error(f"Error saving file_id: {e}")
+
+    def _trim(self):
+        extra = self.file_id_count() - self.max_file_ids
+        if extra > 0:
+            self._conn.execute("DELETE FROM file_ids WHERE key IN "
+                               "(SELECT key FROM file_ids ORDER BY created LIMIT ?)", (extra,))
+
+    def forget_file_id(self, key):
+        """Drops a file_id Telegram no longer accepts, so the QR is uploaded again."""
+        self._conn.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+
+    def file_id_count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "file_id_hits": self.file_id_hits,
+            "file_id_misses": self.file_id_misses,
+            "images": len(self._images),
+            "bytes": self.size,
+            "file_ids": self.file_id_count(),
+        }
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ScanCache:
+    """Decode results of images that were scanned before.
+
+    Looked up by Telegram's ``file_unique_id`` first, which needs no download;
+    a forwarded copy re-uploaded by someone else gets a new id, so the hash of
+    the downloaded bytes is the fallback. Both keys share one count-bounded LRU.
+    """
+
+    def __init__(self, max_entries=SCAN_CACHE_SIZE, ttl=SCAN_CACHE_TTL, path=SCAN_CACHE_FILE,
+                 save_interval=SCAN_CACHE_SAVE_INTERVAL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self.save_interval = save_interval
+        self._entries = OrderedDict()  # key -> (codes, expires or None)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self.id_hits = 0
+        self.content_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._load()
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error loading {self.path}: {e}")
+            return
+        now = time.time()
+        for key, (codes, expires) in entries[-self.max_entries:]:
+            if expires is None or expires > now:
+                self._entries[key] = (codes, expires)
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump([[key, list(entry)] for key, entry in self._entries.items()], f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error(f"Error saving {self.path}: {e}")
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        codes, expires = entry
+        if expires is not None and expires <= time.time():
+            del self._entries[key]
+            self.expired += 1
+            self._dirty = True
+            return None
+        self._entries.move_to_end(key)
+        return codes
+
+    def get(self, file_unique_id):
+        codes = self._get(f"id:{file_unique_id}")
+        if codes is not None:
+            self.id_hits += 1
+        return codes
+
+    def get_content(self, digest):
+        codes = self._get(f"sha:{digest}")
+        if codes is not None:
+            self.content_hits += 1
+        else:
+            self.misses += 1
+        return codes
+
+    def put(self, codes, file_unique_id=None, digest=None):
+        expires = time.time() + self.ttl if self.ttl else None
+        for key in (f"id:{file_unique_id}" if file_unique_id else None, f"sha:{digest}" if digest else None):
+            if key is None:
+                continue
+            self._entries[key] = (list(codes), expires)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def stats(self):
+        lookups = self.id_hits + self.content_hits + self.misses
+        return {
+            "id_hits": self.id_hits,
+            "content_hits": self.content_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.id_hits + self.content_hits) / lookups, 3) if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+        }
+
+
+render_cache = RenderCache()
+scan_cache = ScanCache()
@@ -0,0 +1,184 @@
+"""Barcode decoder backends behind one interface.
+
+pyzbar is the default; OpenCV's QRCodeDetector and zxing-cpp are used when
+installed and listed in SCAN_DECODERS. Backends are tried in that order
+("sequential") or all at once, first success wins ("race").
+"""
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from lazy import lazy_import
+
+# Loaded on first decode (pyzbar loads libzbar then); optional as long as another backend is installed
+pyzbar = lazy_import("pyzbar.pyzbar")
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+zxingcpp = lazy_import("zxingcpp")
+
+SCAN_DECODERS = [name.strip() for name in os.getenv("SCAN_DECODERS", "pyzbar").split(",") if name.strip()]
+# "sequential": next backend only if the previous found nothing; "race": all in parallel
+SCAN_DECODE_STRATEGY = os.getenv("SCAN_DECODE_STRATEGY", "sequential")
+
+Rect = namedtuple("Rect", "left top width height")
+Symbol = namedtuple("Symbol", "type data rect")
+
+
+_loads = {}
+
+
+def _really_loads(name, module):
+    """Whether a lazily imported backend loads, native library included; checked once per process.
+
+    pyzbar imports fine without libzbar and only fails when the module is executed.
+    """
+    if name not in _loads:
+        try:
+            _loads[name] = module is not None and module.__name__ == name
+        except (ImportError, OSError, AttributeError) as e:
+            logging.warning(f"Decoder module {name} can't be loaded: {e}")
+            _loads[name] = False
+    return _loads[name]
+
+
+def _rect(points):
+    xs = [int(x) for x, _ in points]
+    ys = [int(y) for _, y in points]
+    return Rect(min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+
+
+class Decoder(ABC):
+    """A backend takes a grayscale PIL image and returns Symbols."""
+
+    name = None
+
+    @abstractmethod
+    def available(self):
+        pass
+
+    @abstractmethod
+    def decode(self, gray):
+        pass
+
+
+class PyzbarDecoder(Decoder):
+    name = "pyzbar"
+
+    def available(self):
+        return _really_loads("pyzbar.pyzbar", pyzbar)
+
+    def decode(self, gray):
+        return [Symbol(s.type, s.data.decode("utf-8", errors="replace"), Rect(*s.rect))
+                for s in pyzbar.decode(gray)]
+
+
+class OpenCVDecoder(Decoder):
+    """QR codes only."""
+
+    name = "opencv"
+
+    def __init__(self):
+        self._detector = None
+
+    def available(self):
+        return _really_loads("cv2", cv2) and _really_loads("numpy", np)
+
+    def decode(self, gray):
+        if self._detector is None:
+            self._detector = cv2.QRCodeDetector()
+        found, texts, points, _ = self._detector.detectAndDecodeMulti(np.asarray(gray))
+        if not found:
+            return []
+        return [Symbol("QRCODE", text, _rect(corners)) for text, corners in zip(texts, points) if text]
+
+
+class ZXingDecoder(Decoder):
+    name = "zxing"
+
+    def available(self):
+        return _really_loads("zxingcpp", zxingcpp)
+
+    def decode(self, gray):
+        symbols = []
+        for result in zxingcpp.read_barcodes(gray):
+            p = result.position
+            corners = [(c.x, c.y) for c in (p.top_left, p.top_right, p.bottom_right, p.bottom_left)]
+            symbols.append(Symbol(result.format.name.upper(), result.text, _rect(corners)))
+        return symbols
+
+
+BACKENDS = {cls.name: cls for cls in (PyzbarDecoder, OpenCVDecoder, ZXingDecoder)}
+
+
+def load_backends(names=None):
+    """Instances of the requested backends that are installed, in order."""
+    backends = []
+    for name in names or SCAN_DECODERS:
+        cls = BACKENDS.get(name)
+        if cls is None:
+            logging.warning(f"Unknown decoder backend: {name}")
+            continue
+        backend = cls()
+        if backend.available():
+            backends.append(backend)
+        else:
+            logging.warning(f"Decoder backend {name} is not installed, skipping it")
+    if not backends:
+        # Fall back to anything that is installed rather than failing every scan
+        backends = [backend for backend in (cls() for cls in BACKENDS.values()) if backend.available()]
+    if not backends:
+        raise RuntimeError("No barcode decoder installed: pip install pyzbar (and the zbar library)")
+    return backends
+
+
+def _safe_decode(backend, gray):
+    try:
+        return backend.decode(gray)
+    except Exception as e:
+        logging.error(f"Decoder {backend.name} failed: {e}")
+        return []
+
+
+class MultiDecoder:
+    """Runs a list of backends with one of the strategies."""
+
+    def __init__(self, backends=None, strategy=SCAN_DECODE_STRATEGY):
+        self.backends = backends if backends is not None else load_backends()
+        self.strategy = strategy
+        self._executor = None
+
+    def decode(self, gray):
+        if self.strategy == "race" and len(self.backends) > 1:
+            return self._race(gray)
+        for backend in self.backends:
+            symbols = _safe_decode(backend, gray)
+            if symbols:
+                return symbols
+        return []
+
+    def _race(self, gray):
+        # The backends release the GIL in their native code, so threads run them in parallel.
+        # Losers are not interrupted; their results are dropped.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.backends), thread_name_prefix="qr-decode")
+        pending = {self._executor.submit(_safe_decode, backend, gray) for backend in self.backends}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                symbols = future.result()
+                if symbols:
+                    return symbols
+        return []
+
+
+_default = None
+
+
+def decode(gray):
+    """Decode with the configured backends and strategy (created lazily, once per process)."""
+    global _default
+    if _default is None:
+        _default = MultiDecoder()
+    return _default.decode(gray)
@@ -0,0 +1,182 @@
+"""On-demand CPU profiles and memory snapshots of the running bot.
+
+Both only look at the bot process itself; render/scan jobs in the worker pool
+show up as time spent waiting on them.
+"""
+import asyncio
+import cProfile
+import io
+import linecache
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Hard caps so a forgotten diagnostic can't slow the bot down for long
+DIAG_PROFILE_MAX_SECONDS = int(os.getenv("DIAG_PROFILE_MAX_SECONDS", 120))
+DIAG_SAMPLE_INTERVAL = float(os.getenv("DIAG_SAMPLE_INTERVAL", 0.005))
+DIAG_TRACE_FRAMES = int(os.getenv("DIAG_TRACE_FRAMES", 10))
+DIAG_TRACE_MAX_SECONDS = int(os.getenv("DIAG_TRACE_MAX_SECONDS", 1800))
+DIAG_TOP = int(os.getenv("DIAG_TOP", 40))
+
+# Innermost frames that mean the event loop had nothing to do
+_IDLE = {("selectors.py", "select"), ("selectors.py", "poll"), ("threading.py", "wait")}
+
+
+class DiagnosticsBusy(Exception):
+    def __init__(self, message="⏳ A profile is already running."):
+        super().__init__(message)
+
+
+def _where(frame):
+    code = frame.f_code
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack every ``interval`` seconds from a helper thread.
+
+    The cost is one stack walk per sample, independent of how busy the bot is.
+    """
+
+    def __init__(self, thread_id=None, interval=DIAG_SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = 0
+        self.idle = 0
+        self.own = Counter()
+        self.total = Counter()
+        self._stop = threading.Event()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        self.samples += 1
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in _IDLE:
+            self.idle += 1
+            return
+        self.own[_where(frame)] += 1
+        seen = set()
+        while frame is not None:
+            where = _where(frame)
+            if where not in seen:
+                seen.add(where)
+                self.total[where] += 1
+            frame = frame.f_back
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    async def run(self, seconds):
+        thread = threading.Thread(target=self._run, name="qr-profiler", daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self._stop.set()
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+
+    def report(self, top=DIAG_TOP):
+        busy = self.samples - self.idle
+        lines = [
+            f"{self.samples} samples every {self.interval * 1000:.0f} ms, "
+            f"event loop idle in {self.idle} ({self.idle / max(1, self.samples):.0%})",
+            "",
+            f"{'own':>7} {'own%':>6}  function (innermost frame)",
+        ]
+        lines += [f"{n:>7} {n / max(1, busy):>6.1%}  {where}" for where, n in self.own.most_common(top)]
+        lines += ["", f"{'total':>7} {'tot%':>6}  function (anywhere on the stack)"]
+        lines += [f"{n:>7} {n / max(1, busy):>6.1%}  {where}" for where, n in self.total.most_common(top)]
+        return "\n".join(lines)
+
+
+class Diagnostics:
+    def __init__(self):
+        self._profiling = False
+        self._baseline = None
+        self._trace_started = None
+        self._trace_timer = None
+
+    async def profile(self, seconds, mode="sample"):
+        """Profiles the bot for ``seconds`` (capped) and returns a text report."""
+        if self._profiling:
+            raise DiagnosticsBusy()
+        seconds = max(1, min(int(seconds), DIAG_PROFILE_MAX_SECONDS))
+        self._profiling = True
+        started = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            if mode == "cprofile":
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profiler.disable()
+                out = io.StringIO()
+                stats = pstats.Stats(profiler, stream=out)
+                stats.sort_stats("cumulative").print_stats(DIAG_TOP)
+                stats.sort_stats("tottime").print_stats(DIAG_TOP)
+                body = out.getvalue()
+            else:
+                sampler = SamplingProfiler()
+                await sampler.run(seconds)
+                body = sampler.report()
+        finally:
+            self._profiling = False
+        return f"{mode} profile, {seconds}s from {started}\n\n{body}"
+
+    # --- memory ---
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start_trace(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(DIAG_TRACE_FRAMES)
+            self._trace_started = time.monotonic()
+            # tracemalloc slows every allocation down: never leave it on for long
+            self._trace_timer = asyncio.get_running_loop().call_later(DIAG_TRACE_MAX_SECONDS, self.stop_trace)
+        self._baseline = self._snapshot()
+
+    def stop_trace(self):
+        if self._trace_timer is not None:
+            self._trace_timer.cancel()
+            self._trace_timer = None
+        self._baseline = None
+        tracemalloc.stop()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+
+    def diff(self, extra=None, top=DIAG_TOP):
+        """Diffs a new snapshot against the previous one, which it then replaces."""
+        snapshot = self._snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"traced: {current / 1024 / 1024:.1f} MiB (peak {peak / 1024 / 1024:.1f} MiB), "
+            f"tracing for {time.monotonic() - self._trace_started:.0f}s",
+        ]
+        for name, value in (extra or {}).items():
+            lines.append(f"{name}: {value}")
+        lines += ["", "Growth since the previous snapshot, by line:"]
+        lines += [str(stat) for stat in snapshot.compare_to(self._baseline, "lineno")[:top]]
+        lines += ["", "Biggest growth with its traceback:"]
+        for stat in snapshot.compare_to(self._baseline, "traceback")[:5]:
+            lines.append(f"{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} blocks")
+            lines += [f"    {line}" for line in stat.traceback.format()]
+        self._baseline = snapshot
+        return "\n".join(lines)
+
+
+diagnostics = Diagnostics()
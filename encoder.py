@@ -0,0 +1,352 @@
+"""QR encoding on top of qrcode's data model, without its pure-Python mask search.
+
+qrcode.make() lays out the symbol nine times and scores eight masks with Python
+loops. Here the data modules are placed once, all eight masks are applied and
+scored as one NumPy array, and only the winner gets its format bits. The mask
+chosen is the one qrcode would choose, so the output is identical for the same
+segments. On top of that:
+
+- ``segments="optimal"`` splits the payload into numeric/alphanumeric/byte runs
+  by dynamic programming, for fewer bits and often a smaller version;
+- ``mask`` and ``version`` can be fixed, skipping the search or the fitting.
+"""
+import os
+from bisect import bisect_left
+from functools import lru_cache
+
+from qrcode import LUT, base, constants, exceptions, util
+from qrcode.main import QRCode
+
+try:
+    import numpy as np
+except ImportError:  # optional, qrcode's own mask search is used instead
+    np = None
+
+ECC_LEVELS = {
+    "L": constants.ERROR_CORRECT_L,
+    "M": constants.ERROR_CORRECT_M,
+    "Q": constants.ERROR_CORRECT_Q,
+    "H": constants.ERROR_CORRECT_H,
+}
+RENDER_ECC = os.getenv("RENDER_ECC", "M").upper()
+# A fixed mask (0-7) skips mask scoring entirely; the symbol is valid, only less balanced
+RENDER_MASK = int(os.getenv("RENDER_MASK")) if os.getenv("RENDER_MASK") else None
+
+_MODES = (util.MODE_NUMBER, util.MODE_ALPHA_NUM, util.MODE_8BIT_BYTE)
+# Bits per character in sixths of a bit: 10/3, 11/2 and 8
+_CHAR_COST = {util.MODE_NUMBER: 20, util.MODE_ALPHA_NUM: 33, util.MODE_8BIT_BYTE: 48}
+_DIGITS = frozenset(b"0123456789")
+_ALNUM = frozenset(util.ALPHA_NUM)
+
+
+def ecc_level(ecc):
+    """``"L"/"M"/"Q"/"H"`` (any case) or None for the default, as a qrcode constant."""
+    name = (ecc or RENDER_ECC).upper()
+    if name not in ECC_LEVELS:
+        raise ValueError(f"Unknown error correction level: {ecc} (use L, M, Q or H)")
+    return ECC_LEVELS[name]
+
+
+# --- segmentation ---
+
+def _allowed(byte):
+    if byte in _DIGITS:
+        return _MODES
+    if byte in _ALNUM:
+        return _MODES[1:]
+    return _MODES[2:]
+
+
+def optimal_segments(data: bytes, version=1):
+    """Split ``data`` into (mode, bytes) runs with the fewest bits for ``version``'s count sizes."""
+    if not data:
+        return [(util.MODE_8BIT_BYTE, data)]
+    sizes = util.mode_sizes_for_version(version)
+    header = {mode: (4 + sizes[mode]) * 6 for mode in _MODES}
+    inf = float("inf")
+    # cost[mode]: cheapest encoding of the prefix so far ending in ``mode``
+    cost = {mode: header[mode] for mode in _MODES}
+    back = []
+    for byte in data:
+        allowed = _allowed(byte)
+        new_cost, step = {}, {}
+        for mode in _MODES:
+            if mode not in allowed:
+                new_cost[mode] = inf
+                continue
+            # Stay in ``mode`` or switch into it from the cheapest other mode
+            best_prev = min(_MODES, key=lambda m: cost[m] + (0 if m == mode else header[mode]))
+            new_cost[mode] = cost[best_prev] + (0 if best_prev == mode else header[mode]) + _CHAR_COST[mode]
+            step[mode] = best_prev
+        cost = new_cost
+        back.append(step)
+    mode = min(_MODES, key=lambda m: cost[m])
+    modes = []
+    for step in reversed(back):
+        modes.append(mode)
+        mode = step[mode]
+    modes.reverse()
+    segments = []
+    start = 0
+    for i in range(1, len(data) + 1):
+        if i == len(data) or modes[i] != modes[start]:
+            segments.append((modes[start], data[start:i]))
+            start = i
+    return segments
+
+
+def _payload_bits(mode, length):
+    if mode == util.MODE_NUMBER:
+        return 10 * (length // 3) + (0, 4, 7)[length % 3]
+    if mode == util.MODE_ALPHA_NUM:
+        return 11 * (length // 2) + 6 * (length % 2)
+    return 8 * length
+
+
+def _bits(data_list, version):
+    sizes = util.mode_sizes_for_version(version)
+    return sum(4 + sizes[data.mode] + _payload_bits(data.mode, len(data)) for data in data_list)
+
+
+def _fit(data_list, error_correction, start=1):
+    """Smallest version that holds ``data_list``, like QRCode.best_fit without writing the bits."""
+    limits = util.BIT_LIMIT_TABLE[constants.ERROR_CORRECT_L if error_correction is None else error_correction]
+    version = bisect_left(limits, _bits(data_list, start), start)
+    if version == 41:
+        raise exceptions.DataOverflowError()
+    if util.mode_sizes_for_version(version) is not util.mode_sizes_for_version(start):
+        return _fit(data_list, error_correction, version)
+    return version
+
+
+def _write(data, out):
+    chunk = data.data
+    if data.mode == util.MODE_NUMBER:
+        for i in range(0, len(chunk), 3):
+            digits = chunk[i:i + 3]
+            out.append(format(int(digits), f"0{util.NUMBER_LENGTH[len(digits)]}b"))
+    elif data.mode == util.MODE_ALPHA_NUM:
+        for i in range(0, len(chunk) - 1, 2):
+            out.append(format(util.ALPHA_NUM.find(chunk[i:i + 1]) * 45 + util.ALPHA_NUM.find(chunk[i + 1:i + 2]), "011b"))
+        if len(chunk) % 2:
+            out.append(format(util.ALPHA_NUM.find(chunk[-1:]), "06b"))
+    elif chunk:
+        out.append(format(int.from_bytes(chunk, "big"), f"0{8 * len(chunk)}b"))
+
+
+@lru_cache(maxsize=None)
+def _generator_log(ec_count):
+    return [base.LOG_TABLE[c] for c in LUT.rsPoly_LUT[ec_count][1:]]
+
+
+def _ec_bytes(data, ec_count):
+    """Reed-Solomon remainder of ``data`` (polynomial long division in GF(256))."""
+    generator = _generator_log(ec_count)
+    exp, log = base.EXP_TABLE, base.LOG_TABLE
+    remainder = [0] * ec_count
+    for byte in data:
+        factor = byte ^ remainder.pop(0)
+        remainder.append(0)
+        if factor:
+            shift = log[factor]
+            for i, g in enumerate(generator):
+                remainder[i] ^= exp[(g + shift) % 255]
+    return remainder
+
+
+def create_data(version, error_correction, data_list):
+    """Same codewords as qrcode.util.create_data, built from bit strings and table-driven RS."""
+    sizes = util.mode_sizes_for_version(version)
+    out = []
+    for data in data_list:
+        out.append(format(data.mode, "04b"))
+        out.append(format(len(data), f"0{sizes[data.mode]}b"))
+        _write(data, out)
+    bits = "".join(out)
+    rs_blocks = base.rs_blocks(version, error_correction)
+    bit_limit = sum(block.data_count * 8 for block in rs_blocks)
+    if len(bits) > bit_limit:
+        raise exceptions.DataOverflowError(f"Code length overflow. Data size ({len(bits)}) > size available ({bit_limit})")
+    bits += "0" * min(bit_limit - len(bits), 4)
+    bits += "0" * (-len(bits) % 8)
+    codewords = list(int(bits, 2).to_bytes(len(bits) // 8, "big")) if bits else []
+    codewords += [util.PAD0, util.PAD1] * ((bit_limit // 8 - len(codewords)) // 2 + 1)
+    codewords = codewords[:bit_limit // 8]
+
+    blocks, offset = [], 0
+    for block in rs_blocks:
+        dc = codewords[offset:offset + block.data_count]
+        offset += block.data_count
+        blocks.append((dc, _ec_bytes(dc, block.total_count - block.data_count)))
+    result = []
+    for part in (0, 1):
+        for i in range(max(len(b[part]) for b in blocks)):
+            result.extend(b[part][i] for b in blocks if i < len(b[part]))
+    return result
+
+
+def _data_list(payload: bytes, segments, version):
+    if segments != "optimal":
+        return list(util.optimal_data_chunks(payload, minimum=20))
+    # Count fields grow at versions 10 and 27: re-split once the real version is known
+    guess = version or 1
+    for _ in range(3):
+        data_list = [util.QRData(chunk, mode=mode, check_data=False)
+                     for mode, chunk in optimal_segments(payload, guess)]
+        if version:
+            return data_list
+        fitted = _fit(data_list, None)
+        if util.mode_sizes_for_version(fitted) is util.mode_sizes_for_version(guess):
+            break
+        guess = fitted
+    # Never worse than qrcode's own chunking
+    default = list(util.optimal_data_chunks(payload, minimum=20))
+    return data_list if _bits(data_list, guess) <= _bits(default, guess) else default
+
+
+# --- layout and mask scoring ---
+
+@lru_cache(maxsize=None)
+def _layout(version):
+    """Function-pattern values, data-module mask and data placement order for ``version``."""
+    qr = QRCode(version=version)
+    n = qr.modules_count = version * 4 + 17
+    qr.modules = [[None] * n for _ in range(n)]
+    qr.setup_position_probe_pattern(0, 0)
+    qr.setup_position_probe_pattern(n - 7, 0)
+    qr.setup_position_probe_pattern(0, n - 7)
+    qr.setup_position_adjust_pattern()
+    qr.setup_timing_pattern()
+    qr.setup_type_info(True, 0)
+    if version >= 7:
+        qr.setup_type_number(True)
+    is_data = np.array([[module is None for module in row] for row in qr.modules])
+    function = np.array([[bool(module) for module in row] for row in qr.modules])
+
+    # Same zigzag as QRCode.map_data
+    order = []
+    row, inc = n - 1, -1
+    for col in range(n - 1, 0, -2):
+        if col <= 6:
+            col -= 1
+        while True:
+            for c in (col, col - 1):
+                if is_data[row, c]:
+                    order.append((row, c))
+            row += inc
+            if row < 0 or row >= n:
+                row -= inc
+                inc = -inc
+                break
+    rows, cols = (np.array(axis) for axis in zip(*order))
+
+    i, j = np.indices((n, n))
+    masks = np.stack([
+        (i + j) % 2 == 0,
+        i % 2 == 0,
+        j % 3 == 0,
+        (i + j) % 3 == 0,
+        (i // 2 + j // 3) % 2 == 0,
+        (i * j) % 2 + (i * j) % 3 == 0,
+        ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+        ((i * j) % 3 + (i + j) % 2) % 2 == 0,
+    ]) & is_data
+    return function, rows, cols, masks
+
+
+_FINDER_LIKE = (
+    np.array([1, 0, 1, 1, 1, 0, 1, 0, 0, 0, 0], dtype=bool) if np is not None else None,
+    np.array([0, 0, 0, 0, 1, 0, 1, 1, 1, 0, 1], dtype=bool) if np is not None else None,
+)
+
+
+def _run_penalty(s):
+    """Rule 1 along the last axis: 3 + (length - 5) for each run of 5+ same-colour modules."""
+    eq = s[..., 1:] == s[..., :-1]
+    window = eq[..., :-3] & eq[..., 1:-2] & eq[..., 2:-1] & eq[..., 3:]
+    starts = window.copy()
+    starts[..., 1:] &= ~eq[..., :-4]
+    # A run of length L has L - 4 uniform windows of five, and L - 2 = (L - 4) + 2
+    return window.sum(axis=(-2, -1)) + 2 * starts.sum(axis=(-2, -1))
+
+
+def _finder_penalty(s):
+    width = s.shape[-1] - 10
+    total = 0
+    for pattern in _FINDER_LIKE:
+        match = np.ones(s.shape[:-1] + (width,), dtype=bool)
+        for k, dark in enumerate(pattern):
+            match &= s[..., k:k + width] == dark
+        total = total + match.sum(axis=(-2, -1))
+    return 40 * total
+
+
+def mask_penalties(stack):
+    """Penalty scores (as qrcode.util.lost_point computes them) for a (masks, n, n) bool stack."""
+    n = stack.shape[-1]
+    transposed = stack.transpose(0, 2, 1)
+    level1 = _run_penalty(stack) + _run_penalty(transposed)
+    block = stack[:, :-1, :-1]
+    level2 = 3 * (
+        (block == stack[:, :-1, 1:]) & (block == stack[:, 1:, :-1]) & (block == stack[:, 1:, 1:])
+    ).sum(axis=(1, 2))
+    level3 = _finder_penalty(stack) + _finder_penalty(transposed)
+    dark = stack.sum(axis=(1, 2))
+    level4 = [int(abs(float(d) / (n * n) * 100 - 50) / 5) * 10 for d in dark]
+    return level1 + level2 + level3 + np.array(level4)
+
+
+def _place_format(matrix, error_correction, mask, version):
+    n = matrix.shape[0]
+    bits = util.BCH_type_info((error_correction << 3) | mask)
+    for i in range(15):
+        mod = bool((bits >> i) & 1)
+        matrix[i if i < 6 else i + 1 if i < 8 else n - 15 + i, 8] = mod
+        matrix[8, n - i - 1 if i < 8 else 15 - i if i < 9 else 15 - i - 1] = mod
+    matrix[n - 8, 8] = True
+    if version >= 7:
+        bits = util.BCH_type_number(version)
+        for i in range(18):
+            mod = bool((bits >> i) & 1)
+            matrix[i // 3, i % 3 + n - 11] = mod
+            matrix[i % 3 + n - 11, i // 3] = mod
+
+
+def encode(data, ecc=None, version=None, mask=RENDER_MASK, segments="optimal", border=4):
+    """Module matrix (with ``border``) for ``data``.
+
+    A NumPy bool array when NumPy is installed, otherwise qrcode's list of lists.
+    ``version`` fixes the symbol size (ValueError if the data doesn't fit);
+    ``mask`` fixes the mask pattern instead of searching for the best one.
+    """
+    error_correction = ecc_level(ecc)
+    payload = data if isinstance(data, bytes) else data.encode("utf-8")
+    if version is not None:
+        util.check_version(version)
+    qr = QRCode(version=version, error_correction=error_correction, mask_pattern=mask, border=border)
+    try:
+        data_list = qr.data_list = _data_list(payload, segments, version)
+        if version is None:
+            qr.version = _fit(data_list, error_correction)
+        data_bytes = create_data(qr.version, error_correction, data_list)
+    except exceptions.DataOverflowError:
+        raise ValueError(f"The text does not fit a version {version or 40} QR code at level "
+                         f"{(ecc or RENDER_ECC).upper()}") from None
+
+    if np is None:
+        qr.data_cache = data_bytes
+        qr.makeImpl(False, mask if mask is not None else qr.best_mask_pattern())
+        return qr.get_matrix()
+
+    function, rows, cols, masks = _layout(qr.version)
+    placed = function.copy()
+    bits = np.unpackbits(np.frombuffer(bytes(data_bytes), dtype=np.uint8))
+    placed[rows, cols] = np.pad(bits, (0, max(0, len(rows) - len(bits))))[:len(rows)].astype(bool)
+    if mask is None:
+        candidates = placed ^ masks
+        mask = int(np.argmin(mask_penalties(candidates)))  # ties go to the lowest mask, like qrcode
+        matrix = candidates[mask]
+    else:
+        matrix = placed ^ masks[mask]
+    _place_format(matrix, error_correction, mask, qr.version)
+    return np.pad(matrix, border) if border else matrix
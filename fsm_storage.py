@@ -0,0 +1,248 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import time
+import typing
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+FSM_DB = os.getenv("FSM_DB", "fsm_states.db")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+FSM_MAX_ENTRIES = int(os.getenv("FSM_MAX_ENTRIES", 100000))
+# Seconds a conversation may sit in one state before it is dropped
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", 3600))
+FSM_EXPIRE_INTERVAL = float(os.getenv("FSM_EXPIRE_INTERVAL", 60))
+
+_EMPTY = {"state": None, "data": {}, "bucket": {}, "expires": None}
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage in SQLite with an LRU hot cache in front.
+
+    Every state gets a TTL (``ttls`` maps state names to seconds, anything else
+    uses ``default_ttl``); expired conversations are removed by a background task
+    and ignored on read. At most ``max_entries`` conversations are kept, the least
+    recently updated ones are dropped first. Conversations survive restarts.
+
+    Shard workers share the database: each sweep re-counts the rows, so the cap
+    holds across processes within one ``expire_interval``.
+    """
+
+    def __init__(self, path=FSM_DB, cache_size=FSM_CACHE_SIZE, max_entries=FSM_MAX_ENTRIES,
+                 default_ttl=FSM_STATE_TTL, ttls=None, expire_interval=FSM_EXPIRE_INTERVAL):
+        self.path = path
+        self.cache_size = cache_size
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.expire_interval = expire_interval
+        self._cache = OrderedDict()
+        self._expire_task = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                chat TEXT NOT NULL,
+                user TEXT NOT NULL,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                bucket TEXT NOT NULL DEFAULT '{}',
+                expires REAL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (chat, user)
+            );
+            CREATE INDEX IF NOT EXISTS idx_fsm_expires ON fsm(expires);
+            CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated);
+        """)
+        self._count = self._conn.execute("SELECT COUNT(*) FROM fsm").fetchone()[0]
+
+    # --- records ---
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    def _cache_put(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _load(self, key):
+        self._ensure_expiry_task()
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            row = self._conn.execute(
+                "SELECT state, data, bucket, expires FROM fsm WHERE chat = ? AND user = ?", key
+            ).fetchone()
+            if row:
+                record = {"state": row[0], "data": json.loads(row[1]),
+                          "bucket": json.loads(row[2]), "expires": row[3]}
+            else:
+                # Most users have no state: cache that too, it's the common lookup
+                record = copy.deepcopy(_EMPTY)
+            self._cache_put(key, record)
+        if record["expires"] is not None and record["expires"] <= time.time():
+            self.expired += 1
+            record = copy.deepcopy(_EMPTY)
+            self._save(key, record)
+        return record
+
+    def _ttl(self, state):
+        return self.ttls.get(state, self.default_ttl)
+
+    def _save(self, key, record):
+        self._cache_put(key, record)
+        if record["state"] is None and not record["data"] and not record["bucket"]:
+            if self._conn.execute("DELETE FROM fsm WHERE chat = ? AND user = ?", key).rowcount:
+                self._count -= 1
+            return
+        now = time.time()
+        record["expires"] = now + self._ttl(record["state"]) if record["state"] or record["data"] else None
+        exists = self._conn.execute("SELECT 1 FROM fsm WHERE chat = ? AND user = ?", key).fetchone()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO fsm (chat, user, state, data, bucket, expires, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*key, record["state"], json.dumps(record["data"]), json.dumps(record["bucket"]),
+             record["expires"], now),
+        )
+        if not exists:
+            self._count += 1
+            if self._count > self.max_entries:
+                self._evict(self._count - self.max_entries)
+
+    def _evict(self, n):
+        rows = self._conn.execute("SELECT chat, user FROM fsm ORDER BY updated LIMIT ?", (n,)).fetchall()
+        self._conn.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", rows)
+        for key in rows:
+            self._cache.pop(tuple(key), None)
+        self._count -= len(rows)
+        self.evicted += len(rows)
+
+    # --- expiry ---
+
+    def _ensure_expiry_task(self):
+        if self._expire_task is None or self._expire_task.done():
+            try:
+                self._expire_task = asyncio.get_running_loop().create_task(self._expire_loop())
+            except RuntimeError:  # no running loop (e.g. called from a sync context)
+                pass
+
+    def expire(self):
+        """Removes expired conversations and enforces ``max_entries``; returns how many expired."""
+        now = time.time()
+        rows = self._conn.execute("SELECT chat, user FROM fsm WHERE expires <= ?", (now,)).fetchall()
+        if rows:
+            self._conn.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", rows)
+            for key in rows:
+                self._cache.pop(tuple(key), None)
+            self.expired += len(rows)
+        # Other processes insert too: their rows count against the cap
+        self._count = self._conn.execute("SELECT COUNT(*) FROM fsm").fetchone()[0]
+        if self._count > self.max_entries:
+            self._evict(self._count - self.max_entries)
+        return len(rows)
+
+    async def _expire_loop(self):
+        while True:
+            await asyncio.sleep(self.expire_interval)
+            try:
+                removed = self.expire()
+                if removed:
+                    logging.info(f"Expired {removed} stale FSM conversations")
+            except sqlite3.Error as e:
+                logging.error(f"FSM expiry failed: {e}")
+
+    def stats(self):
+        return {"entries": self._count, "cached": len(self._cache), "hits": self.hits,
+                "misses": self.misses, "expired": self.expired, "evicted": self.evicted}
+
+    # --- BaseStorage ---
+
+    async def close(self):
+        if self._expire_task is not None:
+            self._expire_task.cancel()
+        self._cache.clear()
+        self._conn.close()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        state = self._load(self._key(chat, user))["state"]
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        return copy.deepcopy(self._load(self._key(chat, user))["data"])
+
+    async def set_state(self, *, chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key = self._key(chat, user)
+        record = dict(self._load(key), state=self.resolve_state(state))
+        self._save(key, record)
+
+    async def set_data(self, *, chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key = self._key(chat, user)
+        record = dict(self._load(key), data=copy.deepcopy(data or {}))
+        self._save(key, record)
+
+    async def update_data(self, *, chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key = self._key(chat, user)
+        record = self._load(key)
+        merged = dict(record["data"])
+        merged.update(data or {}, **kwargs)
+        self._save(key, dict(record, data=merged))
+
+    async def reset_state(self, *, chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key = self._key(chat, user)
+        record = dict(self._load(key), state=None)
+        if with_data:
+            record["data"] = {}
+        self._save(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        return copy.deepcopy(self._load(self._key(chat, user))["bucket"])
+
+    async def set_bucket(self, *, chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key = self._key(chat, user)
+        self._save(key, dict(self._load(key), bucket=copy.deepcopy(bucket or {})))
+
+    async def update_bucket(self, *, chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key = self._key(chat, user)
+        record = self._load(key)
+        merged = dict(record["bucket"])
+        merged.update(bucket or {}, **kwargs)
+        self._save(key, dict(record, bucket=merged))
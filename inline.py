@@ -0,0 +1,140 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+from io import BytesIO
+
+from aiogram import types
+from aiohttp import web
+
+from metrics import metrics
+from outbound import INLINE, priority
+from render import cache_params
+from singleflight import SingleFlight
+
+# Chat (usually a private channel) where inline QR images are uploaded once
+STORAGE_CHAT_ID = os.getenv("STORAGE_CHAT_ID")
+# When set, inline results point Telegram at our own HTTP endpoint instead of uploading
+INLINE_PHOTO_BASE_URL = os.getenv("INLINE_PHOTO_BASE_URL", "").rstrip("/")
+INLINE_HTTP_HOST = os.getenv("INLINE_HTTP_HOST", "0.0.0.0")
+INLINE_HTTP_PORT = int(os.getenv("INLINE_HTTP_PORT", 8081))
+# Signs photo URLs; sharding.py shares one between its workers. Set it to keep URLs valid across restarts
+INLINE_URL_SECRET = os.getenv("INLINE_URL_SECRET") or secrets.token_urlsafe(32)
+
+
+class InlinePhotoServer:
+    """Serves rendered QR images at ``/qr/<token>.jpg`` for inline ``photo_url`` results.
+
+    The token carries the payload and its signature, so any process with the
+    same INLINE_URL_SECRET can serve a URL another shard handed out.
+    """
+
+    def __init__(self, render, host=INLINE_HTTP_HOST, port=INLINE_HTTP_PORT, secret=INLINE_URL_SECRET):
+        self.render = render
+        self.host = host
+        self.port = port
+        self.secret = secret.encode()
+        self._runner = None
+        self.app = web.Application()
+        self.app.router.add_get("/qr/{token}.jpg", self.handle)
+
+    def _sign(self, data: bytes):
+        digest = hmac.new(self.secret, data, hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def token(self, payload):
+        data = payload.encode("utf-8")
+        return f"{base64.urlsafe_b64encode(data).rstrip(b'=').decode()}.{self._sign(data)}"
+
+    def payload(self, token):
+        """The payload of a token this bot signed, else None."""
+        encoded, _, signature = token.partition(".")
+        try:
+            data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        except (binascii.Error, ValueError):
+            return None
+        if not hmac.compare_digest(signature, self._sign(data)):
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    async def handle(self, request: web.Request):
+        payload = self.payload(request.match_info["token"])
+        if payload is None:
+            raise web.HTTPNotFound()
+        image = await self.render(payload)
+        return web.Response(body=image, content_type="image/jpeg",
+                            headers={"Cache-Control": "public, max-age=86400"})
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Inline photo server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class InlinePipeline:
+    """Builds inline QR results with at most one Bot API call on a warm cache.
+
+    With a base URL the answer is a ``photo_url`` result served by InlinePhotoServer;
+    otherwise the QR is uploaded once to the storage chat and answered by file_id.
+    """
+
+    def __init__(self, bot, cache, render, storage_chat_id, base_url=INLINE_PHOTO_BASE_URL):
+        self.bot = bot
+        self.cache = cache
+        self.render = render
+        self.storage_chat_id = storage_chat_id
+        self.base_url = base_url
+        self.uploads = 0
+        self.upload_flight = SingleFlight()
+        self.server = None
+        if base_url:
+            self.server = InlinePhotoServer(self.render_jpeg)
+
+    async def render_jpeg(self, payload):
+        return await self.render(payload, self.cache.key(payload, **cache_params("jpeg")), "jpeg")
+
+    async def upload(self, key, payload):
+        photo = BytesIO(await self.render(payload, key))
+        photo.name = f"{key[:16]}.png"
+        # The inline answer is waiting on this upload, so it goes out ahead of replies too
+        with metrics.phase("upload"), priority(INLINE):
+            message = await self.bot.send_photo(self.storage_chat_id, photo=photo, disable_notification=True)
+        self.uploads += 1
+        file_id = message.photo[-1].file_id
+        self.cache.set_file_id(key, file_id)
+        return file_id
+
+    async def result_for(self, payload):
+        caption = f"QR code for: {payload[:50]}..."
+        if self.server is not None:
+            key = self.cache.key(payload, **cache_params("jpeg"))
+            url = f"{self.base_url}/qr/{self.server.token(payload)}.jpg"
+            return types.InlineQueryResultPhoto(
+                id=key, photo_url=url, thumb_url=url, caption=caption,
+            )
+        key = self.cache.key(payload, **cache_params("png"))
+        file_id = self.cache.get_file_id(key)
+        if not file_id:
+            file_id = await self.upload_flight.do(key, lambda: self.upload(key, payload))
+        return types.InlineQueryResultCachedPhoto(id=key, photo_file_id=file_id, caption=caption)
+
+    def is_cached(self, payload):
+        """True when answering ``payload`` needs no render or upload."""
+        return self.server is not None or self.cache.has_file_id(self.cache.key(payload, **cache_params("png")))
+
+    async def start(self):
+        if self.server is not None:
+            await self.server.start()
+
+    async def stop(self):
+        if self.server is not None:
+            await self.server.stop()
@@ -0,0 +1,34 @@
+"""Deferred imports, so the control process doesn't load numpy, PIL or libzbar it never uses."""
+import importlib.machinery
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """``name`` as a module that is only executed on first attribute access.
+
+    Returns None when the module isn't installed, like the ``except ImportError``
+    fallbacks it replaces. A compiled top-level module can't be deferred (its
+    loader runs the extension when the module object is created), so it is
+    imported right away; None if that fails.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    try:
+        spec = importlib.util.find_spec(name)
+    except ImportError:  # the parent package is missing
+        return None
+    if spec is None:
+        return None
+    if isinstance(spec.loader, importlib.machinery.ExtensionFileLoader):
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -1,13 +1,34 @@
+from startup import timeline, import_breakdown  # first, so the timeline starts with the process
 import os
 from dotenv import load_dotenv
 import logging
 import asyncio
 asyncio.set_event_loop(asyncio.new_event_loop())
-from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from pyzbar.pyzbar import decode
-from PIL import Image
 import tempfile
+import zipfile
+import time
+from datetime import date, timedelta
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.utils.exceptions import BadRequest
+from fsm_storage import SQLiteStorage
+from io import BytesIO
+from html import escape
+from workers import pool, run_job, WorkerPoolBusy
+from throttling import AdmissionMiddleware, admission
+from render import render_qr, parse_render_options, cache_params, DOCUMENT_FORMATS, ECC_NAMES
+from scanner import scan_bytes, scan_file, scan_stats, is_image_document, ScanTooLarge
+from scanner import SCAN_MAX_DOCUMENT_BYTES, SCAN_DOCUMENT_TIMEOUT
+from bulk_scan import scan_document, is_bulk_document, count_frames, BulkScanError, BULK_SCAN_MAX_BYTES
+from bulk_scan import MULTI_FRAME_EXTENSIONS
+from cache import render_cache, scan_cache, content_key
+from singleflight import SingleFlight, LatestOnly, StaleQuery, renders_saved
+from metrics import metrics, MetricsMiddleware, METRICS_PORT
+from diagnostics import diagnostics, DiagnosticsBusy, DIAG_PROFILE_MAX_SECONDS
+from outbound import OutboundBot, PriorityMiddleware, BULK, priority
+import analytics as events
+from analytics import analytics
+timeline.mark("imports")
 
 logging.basicConfig(
     level=logging.INFO,  # Less verbose
@@ -15,15 +36,33 @@ logging.basicConfig(
 )
 load_dotenv()
 TOKEN=os.getenv("BOT_TOKEN")
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
+# Self-hosted Bot API server, or the local fake one used by the benchmarks
+BOT_API_SERVER = os.getenv("BOT_API_SERVER")
+# Every Bot API call goes through one priority scheduler: inline, then interactive, then bulk
+bot = OutboundBot(token=TOKEN, server=TelegramAPIServer.from_base(BOT_API_SERVER) if BOT_API_SERVER else TELEGRAM_PRODUCTION)
+# Abandoned admin flows expire sooner than the default FSM_STATE_TTL
+storage = SQLiteStorage(ttls={
+    "BroadcastFSM:waiting_for_message": 600,
+    "SendToUserFSM:waiting_for_user_id": 600,
+    "SendToUserFSM:waiting_for_message": 600,
+})
 dp = Dispatcher(bot, storage=storage)
 
 CLICK_CARD_NUMBER = '8800 9082 4733 6512'
+MAX_CODES_PER_REPLY = 5
 ADMIN_IDS = [7376396301]
 def is_admin(user_id):
     return user_id in ADMIN_IDS
 
+# Per-user budgets and load shedding for the handlers marked with @admission
+admission_control = AdmissionMiddleware(ADMIN_IDS, pool)
+dp.middleware.setup(admission_control)
+# Per-handler latency, errors and phase timings, exported on /metrics and /perf
+dp.middleware.setup(MetricsMiddleware(metrics))
+# Replies to admins (reports, broadcast progress) queue behind user traffic
+dp.middleware.setup(PriorityMiddleware(ADMIN_IDS))
+timeline.mark("bot, dispatcher, storage")
+
 #---STATES---
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
@@ -42,12 +81,80 @@ class WiFiQRStatesForInline(StatesGroup):
 
 class QRCodeState(StatesGroup):
     waiting_for_text = State()  # State for waiting for text to generate QR
+
+class BroadcastFSM(StatesGroup):
+    waiting_for_message = State()
+
+class BatchFSM(StatesGroup):
+    waiting_for_file = State()
 #---End STATES---
 #---MISC---
 @dp.message_handler(commands=['cancel'], state='*')
 async def cancel_handler(message: types.Message, state: FSMContext):
     await state.finish()
     await message.reply('Cancelled.')
+
+render_flight = SingleFlight()
+
+def render_key(data, fmt="png", engine=None, ecc=None):
+    return render_cache.key(data, **cache_params(fmt, engine, ecc))
+
+async def _render_and_cache(data, key, fmt, engine, ecc):
+    # Rendering runs in the worker pool so other updates keep flowing
+    image = await run_job(render_qr, data, fmt, engine, ecc)
+    render_cache.put_image(key, image)
+    return image
+
+async def render_qr_image(data, key=None, fmt="png", engine=None, ecc=None):
+    key = key or render_key(data, fmt, engine, ecc)
+    image = render_cache.get_image(key)
+    if image is None:
+        with metrics.phase("render"):
+            image = await render_flight.do(key, lambda: _render_and_cache(data, key, fmt, engine, ecc))
+    return image
+
+async def render_qr_file(data, name="qr_code", key=None, fmt="png", engine=None, ecc=None):
+    bio = BytesIO(await render_qr_image(data, key, fmt, engine, ecc))
+    bio.name = f"{name}.{fmt}"
+    return bio
+
+# How Telegram rejects a file_id it no longer accepts
+BAD_FILE_ID_ERRORS = ("file identifier", "file reference", "file_reference", "type of file mismatch")
+
+def is_bad_file_id(error: BadRequest):
+    text = str(error).lower()
+    return any(reason in text for reason in BAD_FILE_ID_ERRORS)
+
+async def send_qr(message: types.Message, data, caption, name="qr_code", reply=False, fmt="png", engine=None,
+                  ecc=None):
+    # A QR that was uploaded before is re-sent by file_id: no render, no upload
+    key = render_key(data, fmt, engine, ecc)
+    file = render_cache.get_file_id(key) or await render_qr_file(data, name, key, fmt, engine, ecc)
+    if fmt in DOCUMENT_FORMATS:
+        send = message.reply_document if reply else message.answer_document
+    else:
+        send = message.reply_photo if reply else message.answer_photo
+    with metrics.phase("upload"):
+        try:
+            sent = await send(file, caption=caption)
+        except BadRequest as e:
+            if not isinstance(file, str) or not is_bad_file_id(e):
+                raise
+            logging.warning(f"Cached file_id for {key} rejected ({e}), uploading again")
+            render_cache.forget_file_id(key)
+            file = await render_qr_file(data, name, key, fmt, engine, ecc)
+            sent = await send(file, caption=caption)
+    if not isinstance(file, str):
+        uploaded = sent.document if fmt in DOCUMENT_FORMATS else sent.photo[-1]
+        render_cache.set_file_id(key, uploaded.file_id)
+    return sent
+
+@dp.errors_handler(exception=WorkerPoolBusy)
+async def worker_busy_handler(update: types.Update, exception: WorkerPoolBusy):
+    logging.warning(f"Worker pool busy, rejected update {update.update_id}")
+    if update.message:
+        await update.message.reply(str(exception))
+    return True
 #---MISC END---
 #---PARSERS---
 import re
@@ -75,26 +182,109 @@ start_keyboard.add(
 
 #---End INLINE KEYBOARDS---
 
-from stats import add_user, get_user_by_id, get_user_count, get_users
+from batch import build_zip, read_rows, BatchError, BATCH_EXTENSIONS, BATCH_MAX_FILE_BYTES, BATCH_MAX_ZIP_BYTES
+
+@dp.message_handler(commands=['batch'])
+async def batch_cmd(message: types.Message):
+    await BatchFSM.waiting_for_file.set()
+    await message.reply(
+        "📦 Send a .csv or .txt file.\n"
+        "• .txt: one QR per line\n"
+        "• .csv: a `data` column, optional `filename` and `format` (png/svg/webp) columns\n"
+        "You'll get a ZIP with all QR codes. /cancel to stop.",
+        parse_mode="Markdown"
+    )
+
+@dp.message_handler(state=BatchFSM.waiting_for_file, content_types=['document'])
+@admission("generate")
+async def batch_file(message: types.Message, state: FSMContext):
+    document = message.document
+    file_name = document.file_name or "batch.txt"
+    if not file_name.lower().endswith(BATCH_EXTENSIONS):
+        return await message.reply("❗ Please send a .csv or .txt file.")
+    if document.file_size and document.file_size > BATCH_MAX_FILE_BYTES:
+        return await message.reply(f"❗ File is too large (max {BATCH_MAX_FILE_BYTES // (1024 * 1024)} MB).")
+    await state.finish()
+
+    status = await message.reply("⏳ Generating QR codes...")
+
+    async def progress(done, failed):
+        try:
+            await bot.send_chat_action(message.chat.id, types.ChatActions.UPLOAD_DOCUMENT)
+            await status.edit_text(f"⏳ Generated {done} QR codes ({failed} failed)...")
+        except TelegramAPIError as e:
+            logging.warning(f"Batch progress update failed: {e}")
+
+    async def render(data, fmt, engine, ecc):
+        # Straight to the worker pool: batch output would only flush the render cache
+        return await run_job(render_qr, data, fmt, engine, ecc)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = os.path.join(tmp_dir, "source")
+        archive = os.path.join(tmp_dir, "qr_codes.zip")
+        try:
+            with metrics.phase("download"):
+                await document.download(destination_file=source)
+            with metrics.phase("render"):
+                done, failed = await build_zip(read_rows(source, file_name), archive, render,
+                                               concurrency=pool.workers * 2, progress=progress)
+        except BatchError as e:
+            return await status.edit_text(f"❌ {e}")
+        except Exception as e:
+            logging.error(f"Batch generation failed for {message.from_user.id}: {e}")
+            return await status.edit_text(f"❌ Error generating batch: {e}")
+        if not done:
+            return await status.edit_text("⚠️ No rows to generate.")
+        if os.path.getsize(archive) > BATCH_MAX_ZIP_BYTES:
+            return await status.edit_text("❌ The ZIP is larger than 50 MB, please split the file.")
+        await status.edit_text(f"✅ Generated {done} QR codes ({failed} failed). Uploading...")
+        with metrics.phase("upload"):
+            await message.answer_document(types.InputFile(archive, filename="qr_codes.zip"),
+                                          caption=f"📦 {done} QR codes")
+        analytics.record(events.BATCH, message.from_user.id, document.file_size or 0)
+
+from stats import add_user, get_user_by_id, get_user_count
+from broadcast import BroadcastManager, BroadcastJob, UnsupportedBroadcast
+
+broadcasts = BroadcastManager(bot)
+
+# New users are announced to the admin in one message per NEW_USER_NOTICE_DELAY, as bulk traffic
+NEW_USER_NOTICE_DELAY = float(os.getenv("NEW_USER_NOTICE_DELAY", 5))
+NEW_USER_NOTICE_MAX = 20
+new_users = []
+
+def notify_new_user(user: types.User):
+    new_users.append(user)
+    if len(new_users) == 1:
+        with priority(BULK):
+            asyncio.ensure_future(send_new_user_notice())
+
+async def send_new_user_notice():
+    await asyncio.sleep(NEW_USER_NOTICE_DELAY)
+    users = new_users[:]
+    new_users.clear()
+    lines = [f"<b>📥 {'New User Joined!' if len(users) == 1 else f'{len(users)} New Users Joined!'}</b>"]
+    for user in users[:NEW_USER_NOTICE_MAX]:
+        lines.append(f"🆔 <code>{user.id}</code> "
+                     f"🔗 @{escape(user.username) if user.username else 'None'} "
+                     f"👤 {escape(user.full_name)}")
+    if len(users) > NEW_USER_NOTICE_MAX:
+        lines.append(f"...and {len(users) - NEW_USER_NOTICE_MAX} more")
+    lines.append(f"📊 Total users: {get_user_count()}")
+    try:
+        await bot.send_message(ADMIN_IDS[0], "\n".join(lines), parse_mode="HTML")
+    except TelegramAPIError as e:
+        logging.warning(f"New user notice failed: {e}")
 
 @dp.message_handler(commands=['start'])
 async def start_cmd(message: types.Message):
     user_id = message.from_user.id
-    username = message.from_user.username
-    full_name = message.from_user.full_name
 
+    analytics.record(events.START, user_id)
     existing_user = get_user_by_id(user_id)
     if not existing_user:
-        add_user(user_id, username)
-        await bot.send_message(
-            ADMIN_IDS[0],
-            f"**📥 New User Joined!**\n"
-            f"🆔 ID: `{user_id}`\n"
-            f"🔗 Username: @{username if username else 'None'}\n"
-            f"👤 Name: {full_name}\n"
-            f"📊 Total users: {get_user_count()}",
-            parse_mode="HTML"
-        )
+        add_user(user_id, message.from_user.username)
+        notify_new_user(message.from_user)
 
     await message.reply(
         "Hey! 👋\n"
@@ -105,62 +295,154 @@ async def start_cmd(message: types.Message):
     )
 
 @dp.message_handler(commands=['generate'])
+@admission("generate")
 async def generate_qr(message: types.Message):
     try:
-        data = message.get_args()
+        options, data = parse_render_options(message.get_args() or "")
         if not data:
-            return await message.reply("❗ Usage: /generate <text>")
-        img = qrcode.make(data)
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            img.save(tmp.name)
-            with open(tmp.name, "rb") as photo:
-                await message.reply_photo(photo, caption="✅ Your QR code!")
-        os.remove(tmp.name)
+            return await message.reply("❗ Usage: /generate [--svg|--webp] [--ecc=L|M|Q|H] <text>")
+        await send_qr(message, data, "✅ Your QR code!", reply=True, **options)
+        analytics.record(events.GENERATE, message.from_user.id, len(data.encode()))
     except Exception as e:
         await message.reply(f"Error generating QR: {e}")
 
+async def reply_scan_result(message: types.Message, qr_data):
+    # Check if it's a Wi-Fi QR
+    wifi_match = re.match(r"WIFI:T:(?P<security>[^;]*);S:(?P<ssid>[^;]*);P:(?P<password>[^;]*);", qr_data)
+    if wifi_match:
+        wifi_info = wifi_match.groupdict()
+        password_text = f"🔑 Password: `{wifi_info['password']}`" if wifi_info["password"] else "🔓 Open network"
+
+        wifi_config = f"WIFI:T:{wifi_info['security']};S:{wifi_info['ssid']};P:{wifi_info['password']};;"
+
+        keyboard = InlineKeyboardMarkup().add(
+            InlineKeyboardButton(text="📋 Copy Wi-Fi Config", switch_inline_query=wifi_config)
+        )
+
+        await message.reply(
+            f"📶 *Wi-Fi QR Code Detected:*\n\n"
+            f"🔹 SSID: `{wifi_info['ssid']}`\n"
+            f"{password_text}\n"
+            f"🔐 Security: `{wifi_info['security']}`",
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )
+    else:
+        await message.reply(f"📷 Scanned QR content:\n`{qr_data}`",parse_mode="Markdown")
+
+async def reply_scan_results(message: types.Message, codes):
+    analytics.record(events.SCAN_HIT if codes else events.SCAN_MISS, message.from_user.id,
+                     sum(len(code.encode()) for code in codes))
+    if not codes:
+        return await message.reply("⚠️ No QR code detected in the image.")
+    for qr_data in codes[:MAX_CODES_PER_REPLY]:
+        await reply_scan_result(message, qr_data)
+
 @dp.message_handler(content_types=['photo'])
+@admission("scan")
 async def scan_qr(message: types.Message):
+    photo = message.photo[-1]
     try:
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp:
-            await message.photo[-1].download(destination=tmp.name)
-            path = tmp.name
-            with Image.open(path) as img:
-                decoded = decode(img)
-        os.remove(path)
-
-        if decoded:
-            qr_data = decoded[0].data.decode('utf-8')
-
-            # Check if it's a Wi-Fi QR
-            wifi_match = re.match(r"WIFI:T:(?P<security>[^;]*);S:(?P<ssid>[^;]*);P:(?P<password>[^;]*);", qr_data)
-            if wifi_match:
-                wifi_info = wifi_match.groupdict()
-                password_text = f"🔑 Password: `{wifi_info['password']}`" if wifi_info["password"] else "🔓 Open network"
-
-                wifi_config = f"WIFI:T:{wifi_info['security']};S:{wifi_info['ssid']};P:{wifi_info['password']};;"
-
-                keyboard = InlineKeyboardMarkup().add(
-                    InlineKeyboardButton(text="📋 Copy Wi-Fi Config", switch_inline_query=wifi_config)
-                )
-
-                await message.reply(
-                    f"📶 *Wi-Fi QR Code Detected:*\n\n"
-                    f"🔹 SSID: `{wifi_info['ssid']}`\n"
-                    f"{password_text}\n"
-                    f"🔐 Security: `{wifi_info['security']}`",
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
-            else:
-                await message.reply(f"📷 Scanned QR content:\n`{qr_data}`",parse_mode="Markdown")
-        else:
-            await message.reply("⚠️ No QR code detected in the image.")
+        # Forwarded posters keep their file_unique_id: answer without downloading
+        codes = scan_cache.get(photo.file_unique_id)
+        if codes is None:
+            # Stream the photo into memory, no temp file round trip
+            buf = BytesIO()
+            with metrics.phase("download"):
+                await photo.download(destination_file=buf)
+            data = buf.getvalue()
+            digest = content_key(data)
+            codes = scan_cache.get_content(digest)
+            if codes is None:
+                with metrics.phase("decode"):
+                    result = await run_job(scan_bytes, data)
+                scan_stats.record(result)
+                codes = result["codes"]
+            scan_cache.put(codes, photo.file_unique_id, digest)
+        await reply_scan_results(message, codes)
     except Exception as e:
         await message.reply(f"Error scanning QR: {e}")
 
 
 
+@dp.message_handler(content_types=['document'])
+@admission("scan")
+async def scan_document_cmd(message: types.Message):
+    document = message.document
+    file_name = document.file_name or "document"
+    if not is_bulk_document(file_name):
+        if is_image_document(file_name, document.mime_type):
+            return await scan_image_document(message)
+        return await message.reply("⚠️ Send a photo or an image file to scan it, "
+                                   "or a .zip / .tiff / .gif file to scan many images.")
+    if document.file_size and document.file_size > BULK_SCAN_MAX_BYTES:
+        return await message.reply(f"❗ File is too large (max {BULK_SCAN_MAX_BYTES // (1024 * 1024)} MB).")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = os.path.join(tmp_dir, "source")
+        results = os.path.join(tmp_dir, "scan_results.csv")
+        try:
+            with metrics.phase("download"):
+                await document.download(destination_file=source)
+        except Exception as e:
+            logging.error(f"Bulk scan download failed for {message.from_user.id}: {e}")
+            return await message.reply(f"❌ Error downloading file: {e}")
+        frames = None
+        # A still WebP, GIF or TIFF is one picture: answer it like any image file
+        if file_name.lower().endswith(MULTI_FRAME_EXTENSIONS):
+            try:
+                frames = await run_job(count_frames, source)
+            except WorkerPoolBusy:
+                raise
+            except Exception:
+                frames = 0  # not readable as an image: the bulk scan reports the error
+            if frames == 1:
+                return await scan_image_document(message, source)
+        status = await message.reply("🔎 Scanning...")
+        try:
+            with metrics.phase("decode"):
+                images, codes, failed = await scan_document(source, file_name, results, run_job,
+                                                            concurrency=pool.workers * 2, frames=frames or None)
+        except (BulkScanError, zipfile.BadZipFile) as e:
+            return await status.edit_text(f"❌ {e}")
+        except Exception as e:
+            logging.error(f"Bulk scan failed for {message.from_user.id}: {e}")
+            return await status.edit_text(f"❌ Error scanning file: {e}")
+        await status.edit_text(f"✅ Scanned {images} images: {codes} codes found, {failed} failed.")
+        analytics.record(events.BULK_SCAN, message.from_user.id, document.file_size or 0)
+        if codes:
+            await message.answer_document(types.InputFile(results, filename="scan_results.csv"))
+
+
+async def scan_image_document(message: types.Message, source=None):
+    # Uncompressed originals: draft decode first, then tiles, in a fixed memory budget
+    document = message.document
+    if document.file_size and document.file_size > SCAN_MAX_DOCUMENT_BYTES:
+        return await message.reply(f"❗ File is too large (max {SCAN_MAX_DOCUMENT_BYTES // (1024 * 1024)} MB).")
+    codes = scan_cache.get(document.file_unique_id)
+    if codes is None:
+        await bot.send_chat_action(message.chat.id, types.ChatActions.TYPING)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            try:
+                if source is None:
+                    source = os.path.join(tmp_dir, "source")
+                    with metrics.phase("download"):
+                        await document.download(destination_file=source)
+                with metrics.phase("decode"):
+                    result = await run_job(scan_file, source, timeout=SCAN_DOCUMENT_TIMEOUT)
+            except ScanTooLarge as e:
+                return await message.reply(f"❗ {e}")
+            except WorkerPoolBusy:
+                raise
+            except Exception as e:
+                logging.error(f"Image document scan failed for {message.from_user.id}: {e}")
+                return await message.reply(f"Error scanning QR: {e}")
+        scan_stats.record(result)
+        codes = result["codes"]
+        scan_cache.put(codes, document.file_unique_id)
+    await reply_scan_results(message, codes)
+
+
 @dp.message_handler(commands=['send_to_user'])
 async def send_to_user(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
@@ -184,36 +466,124 @@ async def show_stats(message: types.Message):
         await message.reply("⚠️ You are not authorized to view the stats.")
         return
     users_count = get_user_count()
-    await message.reply(f"📊 Usage Stats:\n- Total users: {users_count}")
+    await message.reply(f"📊 Usage Stats:\n- Total users: {users_count}\n\n{analytics.summary()}")
+
+@dp.message_handler(commands=['analytics'])
+async def analytics_cmd(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    # /analytics [days] or /analytics <from YYYY-MM-DD> <to YYYY-MM-DD>
+    args = message.get_args().split()
+    try:
+        if len(args) == 2:
+            start, end = date.fromisoformat(args[0]), date.fromisoformat(args[1])
+        else:
+            end = analytics.today
+            start = end - timedelta(days=(int(args[0]) if args else 30) - 1)
+    except ValueError:
+        return await message.reply("❗ Usage: /analytics [days] or /analytics 2024-01-01 2024-01-31")
+    if (end - start).days > 3660:
+        return await message.reply("❗ The range is limited to 10 years.")
+    bio = BytesIO(analytics.report_csv(start, end).encode())
+    bio.name = f"analytics-{start}-{end}.csv"
+    await message.answer_document(bio)
+
+@dp.message_handler(commands=['perf'])
+async def show_perf(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    pool_stats = pool.stats()
+    await message.reply(
+        f"<pre>{escape(metrics.summary())}\n\n{escape(bot.scheduler.summary())}\n\n"
+        f"worker pool: {pool_stats['pending']} pending, {pool_stats['queue_depth']} queued, "
+        f"{pool_stats['rejected']} rejected</pre>",
+        parse_mode="HTML",
+    )
+
+def _report_file(text, name):
+    bio = BytesIO(text.encode())
+    bio.name = f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    return bio
+
+async def _send_profile(chat_id, seconds, mode):
+    try:
+        report = await diagnostics.profile(seconds, mode)
+    except DiagnosticsBusy as e:
+        return await bot.send_message(chat_id, str(e))
+    await bot.send_document(chat_id, _report_file(report, f"profile-{mode}"))
+
+@dp.message_handler(commands=['profile'])
+async def profile_cmd(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.get_args().split()
+    seconds = int(args[0]) if args and args[0].isdigit() else 30
+    mode = "cprofile" if "cprofile" in args else "sample"
+    seconds = min(seconds, DIAG_PROFILE_MAX_SECONDS)
+    await message.reply(f"🔬 Profiling ({mode}) for {seconds}s, the report will follow.")
+    # In the background: the handler itself shouldn't sit in the profile or hold an update slot
+    asyncio.ensure_future(_send_profile(message.chat.id, seconds, mode))
+
+def _memory_context():
+    return {
+        "message handlers": len(dp.message_handlers.handlers),
+        "callback handlers": len(dp.callback_query_handlers.handlers),
+        "asyncio tasks": len(asyncio.all_tasks()),
+        "fsm conversations": storage.stats()["entries"],
+        "render cache bytes": render_cache.stats()["bytes"],
+    }
+
+@dp.message_handler(commands=['memtrace'])
+async def memtrace_cmd(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    action = message.get_args().strip() or "diff"
+    if action == "start":
+        diagnostics.start_trace()
+        return await message.reply("🧠 tracemalloc started. Send /memtrace to diff against this snapshot, "
+                                   "/memtrace stop to turn it off.")
+    if action == "stop":
+        diagnostics.stop_trace()
+        return await message.reply("🧠 tracemalloc stopped.")
+    if not diagnostics.tracing:
+        return await message.reply("Start tracing first: /memtrace start")
+    report = diagnostics.diff(_memory_context())
+    await message.answer_document(_report_file(report, "memtrace"))
 
 @dp.message_handler(commands=['broadcast'])
-async def broadcast_cmd(message: types.Message):
+async def broadcast_cmd(message: types.Message, state: FSMContext):
     logging.debug(f"Broadcast command by user {message.from_user.id}")
     if message.from_user.id not in ADMIN_IDS:
         logging.warning(f"User {message.from_user.id} not admin")
         return await message.reply("⛔ You are not allowed to use this command.")
     logging.debug("Waiting for broadcast message")
+    await BroadcastFSM.waiting_for_message.set()
+    await state.update_data(parse_mode="HTML")
     await message.reply("Send me the broadcast message (HTML format).")
-    @dp.message_handler(lambda m: m.from_user.id == message.from_user.id)
-    async def get_broadcast_content(msg: types.Message):
-        logging.debug("Got broadcast message")
-        users = get_users()
-        logging.info(f"Users to broadcast: {users}")
-        if not users:
-            logging.warning("No users found")
-            await msg.reply("⚠️ No users to broadcast to.")
-            dp.message_handlers.unregister(get_broadcast_content)
-            return
-        success = 0
-        for user_id in users:
-            try:
-                await bot.send_message(user_id, msg.text, parse_mode="HTML")
-                success += 1
-                logging.debug(f"Sent to {user_id}")
-            except Exception as e:
-                logging.warning(f"Failed to send to {user_id}: {e}")
-        await msg.reply(f"✅ Broadcast sent to {success}/{len(users)} users.")
-        dp.message_handlers.unregister(get_broadcast_content)
+
+async def reject_command(message: types.Message, wanted="the message itself"):
+    """Admin prompts take content, not commands: a stray /stats must not be sent to users."""
+    if not message.is_command():
+        return False
+    await message.reply(f"⚠️ That's a command. Send {wanted}, or /cancel.")
+    return True
+
+@dp.message_handler(state=BroadcastFSM.waiting_for_message, content_types=types.ContentTypes.ANY)
+async def get_broadcast_content(message: types.Message, state: FSMContext):
+    if await reject_command(message):
+        return
+    data = await state.get_data()
+    try:
+        job = BroadcastJob.from_message(message, parse_mode=data.get("parse_mode"))
+    except UnsupportedBroadcast as e:
+        # Still waiting for the content: the admin can send another message or /cancel
+        return await message.reply(f"⚠️ {e}")
+    await state.finish()
+    if not get_user_count():
+        logging.warning("No users found")
+        return await message.reply("⚠️ No users to broadcast to.")
+    job = broadcasts.start(job)
+    logging.info(f"Broadcast {job.id} ({job.kind}) started by {message.from_user.id}")
 
 
 @dp.message_handler(commands=["admin"])
@@ -240,9 +610,8 @@ async def admin_panel(message: types.Message):
 @dp.callback_query_handler(lambda c: c.data == "stats")
 async def process_stats_callback(callback_query: types.CallbackQuery):
     await callback_query.message.delete()
-    users = get_users()
-    total = len(users)
-    text = f"📊 Total users: <b>{total}</b>"
+    total = get_user_count()
+    text = f"📊 Total users: <b>{total}</b>\n\n{escape(analytics.summary())}"
     await bot.answer_callback_query(callback_query.id)
     await bot.send_message(callback_query.from_user.id, text, parse_mode="HTML")
     logging.info(f"Stats shown to {callback_query.from_user.id} (@{callback_query.from_user.username})")
@@ -251,28 +620,13 @@ async def process_stats_callback(callback_query: types.CallbackQuery):
 
 # Handle /broadcast action when the button is pressed
 @dp.callback_query_handler(lambda c: c.data == "broadcast", state="*")
-async def process_broadcast_callback(callback_query: types.CallbackQuery):
+async def process_broadcast_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.message.delete()
     await callback_query.answer()
+    await BroadcastFSM.waiting_for_message.set()
+    await state.update_data(parse_mode=None)
     await bot.send_message(callback_query.from_user.id, "Send the message to broadcast:")
 
-    @dp.message_handler(lambda message: True, content_types=types.ContentTypes.TEXT)
-    async def receive_broadcast_text(message: types.Message):
-        users = get_users()
-        logging.info(f"Broadcasting to users: {users}")
-
-        count = 0
-        for user_id in users:
-            try:
-                await bot.send_message(chat_id=user_id, text=message.text)
-                count += 1
-            except Exception as e:
-                logging.warning(f"Failed to send to {user_id}: {e}")
-
-        await bot.send_message(message.from_user.id, f"✅ Broadcast message sent to {count} users.")
-        # Unregister handler so it doesn't keep triggering
-        dp.message_handlers.unregister(receive_broadcast_text)
-
 @dp.callback_query_handler(lambda c: c.data == "send_to_user")
 async def start_send_to_user(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.message.delete()
@@ -282,6 +636,8 @@ async def start_send_to_user(callback_query: types.CallbackQuery, state: FSMCont
 
 @dp.message_handler(state=SendToUserFSM.waiting_for_user_id)
 async def get_user_id(message: types.Message, state: FSMContext):
+    if await reject_command(message, "the user ID"):
+        return
     try:
         user_id = int(message.text.strip())
         await state.update_data(user_id=user_id)
@@ -292,6 +648,8 @@ async def get_user_id(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=SendToUserFSM.waiting_for_message)
 async def get_message_text(message: types.Message, state: FSMContext):
+    if await reject_command(message):
+        return
     data = await state.get_data()
     user_id = data.get("user_id")
     text = message.text
@@ -306,23 +664,40 @@ async def get_message_text(message: types.Message, state: FSMContext):
     finally:
         await state.finish()
 
+ecc_keyboard = InlineKeyboardMarkup(row_width=4).add(
+    *(InlineKeyboardButton(text=level, callback_data=f"ecc:{level}") for level in ECC_NAMES)
+)
+
 @dp.message_handler(commands=['wifiqr'])
-async def wifi_qr_start(message: types.Message):
+async def wifi_qr_start(message: types.Message, state: FSMContext):
     logging.info(f"Starting Wi-Fi QR code creation for {message.from_user.id}")
+    options, _ = parse_render_options(message.get_args() or "")
     await message.answer("📶 Send the Wi-Fi name (SSID):")
     await WiFiQRStates.waiting_for_ssid.set()
+    if options.get("ecc"):
+        await state.update_data(ecc=options["ecc"])
 
 
 @dp.message_handler(state=WiFiQRStates.waiting_for_ssid)
 async def wifi_get_ssid(message: types.Message, state: FSMContext):
     logging.info(f"Received Wi-Fi name (SSID) from {message.from_user.id}: {message.text}")
     await state.update_data(ssid=message.text)
-    await message.answer("🔒 Now send the Wi-Fi password:")
+    await message.answer("🔒 Now send the Wi-Fi password:\n"
+                         "Optionally pick an error correction level first (H survives printing and damage best).",
+                         reply_markup=ecc_keyboard)
     await WiFiQRStates.waiting_for_password.set()
 
-import qrcode
+@dp.callback_query_handler(lambda c: c.data.startswith("ecc:"),
+                           state=[WiFiQRStates.waiting_for_password, WiFiQRStatesForInline.waiting_for_password])
+async def wifi_ecc_callback(call: types.CallbackQuery, state: FSMContext):
+    ecc = call.data.split(":", 1)[1]
+    if ecc not in ECC_NAMES:
+        return await call.answer()
+    await state.update_data(ecc=ecc)
+    await call.answer(f"Error correction: {ecc}")
 
 @dp.message_handler(state=WiFiQRStates.waiting_for_password)
+@admission("generate")
 async def wifi_get_password(message: types.Message, state: FSMContext):
     data = await state.get_data()
     ssid = data['ssid']
@@ -331,26 +706,32 @@ async def wifi_get_password(message: types.Message, state: FSMContext):
     logging.info(f"Received Wi-Fi password from {message.from_user.id}")
 
     qr_data = f"WIFI:T:WPA;S:{ssid};P:{password};;"
-    img = qrcode.make(qr_data)
-    bio = BytesIO()
-    bio.name = "wifi_qr.png"
-    img.save(bio, 'PNG')
-    bio.seek(0)
-
-    await bot.send_photo(message.chat.id, photo=bio, caption="📡 Your Wi-Fi QR Code is ready!")
+    await send_qr(message, qr_data, "📡 Your Wi-Fi QR Code is ready!", "wifi_qr", ecc=data.get("ecc"))
+    analytics.record(events.WIFI, message.from_user.id, len(qr_data.encode()))
     logging.info(f"Sent Wi-Fi QR code to {message.from_user.id}")
     await state.finish()
 
-cached_file_ids = {}
-
-from io import BytesIO
 
-import hashlib
-from aiogram.types import InlineQueryResultPhoto, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.exceptions import TelegramAPIError
+from inline import InlinePipeline, STORAGE_CHAT_ID
+
+if not STORAGE_CHAT_ID:
+    logging.warning("STORAGE_CHAT_ID is not set, inline QR uploads go to the first admin")
+inline_pipeline = InlinePipeline(bot, render_cache, render_qr_image, STORAGE_CHAT_ID or ADMIN_IDS[0])
+# Cold inline answers wait on uploads to this one chat: hold them to the global rate only
+bot.scheduler.exempt(inline_pipeline.storage_chat_id)
+# One live inline query per user: older keystrokes are dropped while debouncing
+inline_latest = LatestOnly()
+
+def inline_stats():
+    return {
+        "renders_saved": renders_saved(render_flight, inline_pipeline.upload_flight, latest=inline_latest),
+        **inline_latest.stats(),
+    }
 
 
 @dp.inline_handler()
+@admission("inline")
 async def inline_qr_handler(inline_query: types.InlineQuery):
     qr_text = inline_query.query.strip()
 
@@ -365,37 +746,18 @@ async def inline_qr_handler(inline_query: types.InlineQuery):
                     switch_pm_parameter="error"
                 )
                 return
-            img = qrcode.make(qr_text)
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-                img.save(tmp.name)
-                path = tmp.name
-            with open(path, "rb") as photo:
-                # Send to admin chat and delete immediately
-                message = await bot.send_photo(
-                    chat_id=ADMIN_IDS[0],  # Your admin ID (7376396301)
-                    photo=types.InputFile(path),
-                    caption="Temporary QR code upload"
-                )
-                file_id = message.photo[-1].file_id
-                # Delete the message to avoid clutter
-                await bot.delete_message(
-                    chat_id=ADMIN_IDS[0],
-                    message_id=message.message_id
-                )
-            os.remove(path)
-            result_id = hashlib.md5(qr_text.encode()).hexdigest()
-            await bot.answer_inline_query(
-                inline_query.id,
-                results=[
-                    InlineQueryResultPhoto(
-                        id=result_id,
-                        photo_url=file_id,
-                        thumb_url=f"https://api.telegram.org/file/bot{TOKEN}/{file_id}",
-                        caption=f"QR code for: {qr_text[:50]}...",
-                    )
-                ],
-                cache_time=60
+            # Warm results skip the debounce window
+            debounce = 0 if inline_pipeline.is_cached(qr_text) else None
+            result = await inline_latest.run(
+                inline_query.from_user.id,
+                lambda: inline_pipeline.result_for(qr_text),
+                debounce=debounce,
             )
+            await bot.answer_inline_query(inline_query.id, results=[result], cache_time=60)
+            analytics.record(events.INLINE, inline_query.from_user.id, len(qr_text.encode()))
+        except StaleQuery:
+            # A newer query from this user replaced this one
+            return
         except TelegramAPIError as e:
             logging.error(f"Telegram API error in inline QR: {e}")
             await bot.answer_inline_query(inline_query.id, results=[], cache_time=1)
@@ -420,10 +782,14 @@ async def help_command(message: types.Message):
         "🔹 /start - Start the bot\n"
         "🔹 /help - Show this help message\n"
         "🔹 /generate `<text>` - Generate a QR code from text. You can also put links here\n"
+        "🔹 /generate `--svg <text>` or `--webp <text>` - Get the QR as an SVG or WebP file\n"
+        "🔹 /generate `--ecc=H <text>` - Error correction L, M (default), Q or H; H survives logos and damage\n"
         "🔹 /wifiqr - Create a Wi-Fi QR code\n"
+        "🔹 /batch - Generate many QR codes from a .csv or .txt file\n"
         "💡 *Tips:*\n"
         "- You can also use inline mode: type `@qrbeam_bot <text>` to generate a QR anywhere!\n"
         "- To scan QR code, send it as photo.\n"
+        "- To scan many QR codes at once, send a .zip of images or a multi-page .tiff as a file.\n"
         "- For Wi-Fi QR codes, use `/wifiqr` and follow the steps.\n\n"
         "📬 Need help? Contact the developer: @troubl_e"
     )
@@ -439,10 +805,13 @@ async def wifi_qr_callback(call: types.CallbackQuery):
 @dp.message_handler(state=WiFiQRStatesForInline.waiting_for_ssid)
 async def process_ssid(message: types.Message, state: FSMContext):
     await state.update_data(ssid=message.text)
-    await message.answer("🔒 Enter your Wi-Fi password:")
+    await message.answer("🔒 Enter your Wi-Fi password:\n"
+                         "Optionally pick an error correction level first (H survives printing and damage best).",
+                         reply_markup=ecc_keyboard)
     await WiFiQRStatesForInline.waiting_for_password.set()
 
 @dp.message_handler(state=WiFiQRStatesForInline.waiting_for_password)
+@admission("generate")
 async def process_password(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     ssid = user_data["ssid"]
@@ -451,17 +820,8 @@ async def process_password(message: types.Message, state: FSMContext):
 
     qr_text = f"WIFI:T:{encryption};S:{ssid};P:{password};;"
 
-    # generate QR image
-    import qrcode
-    from io import BytesIO
-
-    qr = qrcode.make(qr_text)
-    img = BytesIO()
-    img.name = "wifi_qr.png"
-    qr.save(img, "PNG")
-    img.seek(0)
-
-    await message.answer_photo(photo=img, caption="📲 Scan this QR to connect to Wi-Fi!")
+    await send_qr(message, qr_text, "📲 Scan this QR to connect to Wi-Fi!", "wifi_qr", ecc=user_data.get("ecc"))
+    analytics.record(events.WIFI, message.from_user.id, len(qr_text.encode()))
     await state.finish()
 
 
@@ -477,21 +837,13 @@ async def generate_qr(callback_query: types.CallbackQuery):
     await QRCodeState.waiting_for_text.set()
 
 @dp.message_handler(state=QRCodeState.waiting_for_text)
+@admission("generate")
 async def process_qr_text(message: types.Message, state: FSMContext):
     text = message.text
 
-    # Generate the QR code
-    import qrcode
-    from io import BytesIO
-
-    qr = qrcode.make(text)
-    img = BytesIO()
-    img.name = "qr_code.png"
-    qr.save(img, "PNG")
-    img.seek(0)
-
-    # Send the QR code back to the user
-    await message.answer_photo(photo=img, caption="📲 Here's your QR code!")
+    # Generate the QR code and send it back to the user
+    await send_qr(message, text, "📲 Here's your QR code!")
+    analytics.record(events.GENERATE, message.from_user.id, len(text.encode()))
     await state.finish()
 @dp.callback_query_handler(lambda c: c.data == "about_bot")
 async def on_about(callback_query: types.CallbackQuery):
@@ -524,23 +876,98 @@ async def on_about(callback_query: types.CallbackQuery):
 #     )
 
 #---BOT START---
+timeline.mark("handlers and late imports")
+metrics.register("worker_pool", pool.stats)
+metrics.register("render_cache", render_cache.stats)
+metrics.register("scan", scan_stats.stats)
+metrics.register("scan_cache", scan_cache.stats)
+metrics.register("inline", inline_stats)
+metrics.register("admission", admission_control.stats)
+metrics.register("fsm", storage.stats)
+metrics.register("outbound", bot.stats)
+metrics.register("analytics", analytics.stats)
+
 async def set_default_commands(dp):
     await dp.bot.set_my_commands([
         types.BotCommand("start", "Start the bot"),
         types.BotCommand("help", "Show help message"),
         types.BotCommand("generate", "Generate QR code"),
         types.BotCommand("wifiqr", "Create Wi-Fi QR code"),
+        types.BotCommand("batch", "Generate QR codes from a file"),
         types.BotCommand("cancel", "Cancel current operation"),
     ])
 
-async def on_startup(dp):
+async def _start_local(shard=0):
+    """What handlers need before the first update; nothing here talks to Telegram.
+
+    Sharded, every worker serves /metrics on METRICS_PORT + its index and shard 0
+    runs the inline photo server.
+    """
+    services = [metrics.start(port=METRICS_PORT + shard if METRICS_PORT else 0)]
+    if shard == 0:
+        services.append(inline_pipeline.start())
+    await asyncio.gather(*services)
+    analytics.start()
+    timeline.mark("local services")
+
+async def _warm_workers():
+    seconds = await pool.prewarm()
+    timeline.background_done("worker warm-up", seconds)
+    logging.info(f"Workers warmed up in {seconds:.2f}s")
+
+async def _start_background(once=True):
+    """Runs while updates are already being handled; ``once``: the steps one shard does for all."""
+    steps = {"worker warm-up": _warm_workers()}
+    if once:
+        steps.update({"admin notice": bot.send_message(ADMIN_IDS[0], "Bot started!"),
+                      "bot commands": set_default_commands(dp)})
+    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    for step, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logging.error(f"Startup step '{step}' failed: {result}")
+
+async def on_startup(dp, shard=0):
     logging.info("Starting bot...")
-    await bot.send_message(ADMIN_IDS[0], "Bot started!")
-    await set_default_commands(dp)
+    await _start_local(shard)
+    timeline.ready()
+    if shard == 0:
+        broadcasts.resume_all()
+    asyncio.ensure_future(_start_background(once=shard == 0))
+
+async def on_shutdown(dp):
+    await broadcasts.stop()
+    await inline_pipeline.stop()
+    await metrics.stop()
+    await bot.scheduler.stop()
+    await analytics.stop()
+    scan_cache.save()
+    pool.shutdown()
 
 if __name__ == "__main__":
-    from aiogram import executor
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
+    import argparse
+    parser = argparse.ArgumentParser(description="QRBeam bot")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.getenv("BOT_MODE", "polling"),
+                        help="how to receive updates (default: $BOT_MODE or polling)")
+    parser.add_argument("--measure-startup", action="store_true",
+                        help="start the local services, print where the startup time went and exit "
+                             "(1 when over $STARTUP_BUDGET); doesn't contact Telegram")
+    args = parser.parse_args()
+    if args.measure_startup:
+        async def measure():
+            await _start_local()
+            timeline.ready()
+            await _warm_workers()
+            await asyncio.gather(metrics.stop(), inline_pipeline.stop(), analytics.stop())
+            pool.shutdown()
+        asyncio.get_event_loop().run_until_complete(measure())
+        print(timeline.report(import_breakdown()))
+        raise SystemExit(1 if timeline.ready_after > timeline.budget else 0)
+    if args.mode == "webhook":
+        from webhook import start_webhook
+        start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        from aiogram import executor
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True)
 
 #---BOT END---
 
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 turns the /metrics endpoint off
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9102))
+METRICS_LAG_INTERVAL = float(os.getenv("METRICS_LAG_INTERVAL", 0.5))
+
+# Upper bounds in seconds, Prometheus style
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+# (handler name, started) of the handler running in the current update's task
+_current = ContextVar("metrics_handler", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (an estimate)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def exposition(self, name, labels=""):
+        sep = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum:.6f}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+class _Phase:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        current = _current.get()
+        handler = current[0] if current else "other"
+        self.metrics.observe_phase(handler, self.name, time.perf_counter() - self.started)
+
+
+class Metrics:
+    """In-process counters and histograms, exported in the Prometheus text format.
+
+    Recording is a couple of dict lookups and a bisect, cheap enough for every
+    update; everything else (the collectors, formatting) happens on scrape.
+    """
+
+    def __init__(self, lag_interval=METRICS_LAG_INTERVAL):
+        self.lag_interval = lag_interval
+        self.calls = {}
+        self.errors = {}
+        self.latency = {}
+        self.phases = {}
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.started = time.time()
+        self._collectors = {}
+        self._lag_task = None
+        self._runner = None
+
+    # --- recording ---
+
+    def observe_handler(self, handler, seconds):
+        self.calls[handler] = self.calls.get(handler, 0) + 1
+        histogram = self.latency.get(handler)
+        if histogram is None:
+            histogram = self.latency[handler] = Histogram()
+        histogram.observe(seconds)
+
+    def error(self, handler):
+        self.errors[handler] = self.errors.get(handler, 0) + 1
+
+    def observe_phase(self, handler, phase, seconds):
+        histogram = self.phases.get((handler, phase))
+        if histogram is None:
+            histogram = self.phases[(handler, phase)] = Histogram()
+        histogram.observe(seconds)
+
+    def phase(self, name):
+        """``with metrics.phase("download"):`` times one step of the running handler."""
+        return _Phase(self, name)
+
+    def elapsed(self):
+        """Seconds since the running handler started (0 outside a handler)."""
+        current = _current.get()
+        return time.perf_counter() - current[1] if current else 0.0
+
+    def register(self, name, collector):
+        """Adds a ``stats()``-style callable, exported as gauges on every scrape."""
+        self._collectors[name] = collector
+
+    # --- event loop lag ---
+
+    async def _watch_loop(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, time.perf_counter() - started - self.lag_interval)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.loop_lag.observe(lag)
+
+    # --- export ---
+
+    def collect(self):
+        values = {}
+        for name, collector in self._collectors.items():
+            try:
+                values[name] = collector()
+            except Exception as e:
+                logging.error(f"Metrics collector {name} failed: {e}")
+        return values
+
+    def exposition(self):
+        lines = [
+            "# TYPE qrbeam_uptime_seconds gauge",
+            f"qrbeam_uptime_seconds {time.time() - self.started:.0f}",
+            "# TYPE qrbeam_handler_calls_total counter",
+        ]
+        lines += [f'qrbeam_handler_calls_total{{handler="{h}"}} {n}' for h, n in self.calls.items()]
+        lines.append("# TYPE qrbeam_handler_errors_total counter")
+        lines += [f'qrbeam_handler_errors_total{{handler="{h}"}} {n}' for h, n in self.errors.items()]
+        lines.append("# TYPE qrbeam_handler_seconds histogram")
+        for handler, histogram in self.latency.items():
+            lines += histogram.exposition("qrbeam_handler_seconds", f'handler="{handler}"')
+        lines.append("# TYPE qrbeam_phase_seconds histogram")
+        for (handler, phase), histogram in self.phases.items():
+            lines += histogram.exposition("qrbeam_phase_seconds", f'handler="{handler}",phase="{phase}"')
+        lines.append("# TYPE qrbeam_event_loop_lag_seconds histogram")
+        lines += self.loop_lag.exposition("qrbeam_event_loop_lag_seconds")
+        lines.append(f"qrbeam_event_loop_lag_max_seconds {self.max_lag:.6f}")
+        for name, values in self.collect().items():
+            lines += _gauges(f"qrbeam_{name}", values)
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Plain-text report for the /perf admin command."""
+        lines = [f"{'handler':<34} {'calls':>6} {'err':>4} {'p50':>6} {'p95':>6} {'p99':>6}"]
+        for handler in sorted(self.latency, key=lambda h: -self.calls.get(h, 0)):
+            histogram = self.latency[handler]
+            lines.append(
+                f"{handler[:34]:<34} {self.calls.get(handler, 0):>6} {self.errors.get(handler, 0):>4} "
+                f"{_ms(histogram.quantile(0.5)):>6} {_ms(histogram.quantile(0.95)):>6} "
+                f"{_ms(histogram.quantile(0.99)):>6}"
+            )
+        if self.phases:
+            lines += ["", f"{'handler / phase':<44} {'count':>6} {'avg_ms':>8}"]
+            for (handler, phase), histogram in sorted(self.phases.items()):
+                avg = histogram.sum / histogram.count * 1000
+                lines.append(f"{(handler + ' / ' + phase)[:44]:<44} {histogram.count:>6} {avg:8.1f}")
+        lines += ["", f"loop lag: last {self.last_lag * 1000:.1f} ms, "
+                      f"p99 {_ms(self.loop_lag.quantile(0.99))} ms, max {self.max_lag * 1000:.1f} ms"]
+        return "\n".join(lines)
+
+    async def handle(self, request: web.Request):
+        return web.Response(text=self.exposition(), content_type="text/plain", charset="utf-8")
+
+    async def start(self, host=METRICS_HOST, port=METRICS_PORT):
+        if self._lag_task is None:
+            self._lag_task = asyncio.ensure_future(self._watch_loop())
+        if not port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, host, port).start()
+            logging.info(f"Metrics on http://{host}:{port}/metrics")
+        except OSError as e:
+            logging.error(f"Could not start the metrics endpoint on {host}:{port}: {e}")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def _ms(seconds):
+    return "inf" if seconds == float("inf") else f"{seconds * 1000:.0f}"
+
+
+def _gauges(prefix, values):
+    """Flattens a stats() dict; one level of nesting becomes a ``key`` label."""
+    lines = []
+    for key, value in values.items():
+        if isinstance(value, dict):
+            lines += [f'{prefix}_{key}{{key="{k}"}} {v}' for k, v in value.items()
+                      if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{prefix}_{key} {value}")
+    return lines
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Times every handler that runs and counts the ones that raise.
+
+    Set it up after AdmissionMiddleware, so throttled updates aren't timed.
+    """
+
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def _start(self, kind, data):
+        handler = current_handler.get()
+        name = f"{kind}:{getattr(handler, '__name__', 'unknown')}"
+        data["_metrics"] = current = (name, time.perf_counter())
+        _current.set(current)
+
+    def _finish(self, data):
+        current = data.pop("_metrics", None)
+        if current is not None:
+            self.metrics.observe_handler(current[0], time.perf_counter() - current[1])
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start("message", data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finish(data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self._start("callback_query", data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._finish(data)
+
+    async def on_process_inline_query(self, inline_query: types.InlineQuery, data: dict):
+        self._start("inline_query", data)
+
+    async def on_post_process_inline_query(self, inline_query: types.InlineQuery, results, data: dict):
+        self._finish(data)
+
+    async def on_pre_process_error(self, update: types.Update, exception, data: dict):
+        current = _current.get()
+        self.metrics.error(current[0] if current else "unknown")
+
+
+metrics = Metrics()
@@ -0,0 +1,277 @@
+"""One queue in front of the Bot API for every outgoing call.
+
+Handlers keep calling ``bot.send_message``, ``message.reply_photo`` and so on;
+OutboundBot.request waits for a slot from the scheduler first. Slots go to
+inline answers, then interactive replies, then admin and bulk traffic, within
+a global and a per-chat rate, so a broadcast never delays a user's reply and
+bursts don't run into flood control together.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import aiohttp
+from aiogram import Bot, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import RetryAfter
+
+from metrics import Histogram
+from ratelimit import KeyedBuckets, TokenBucket
+
+# Bot API allows ~30 messages/s overall and ~1 message/s per chat (short bursts are tolerated).
+# Both are enforced per process; sharding.py divides OUTBOUND_RATE between its workers.
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", 30))
+OUTBOUND_PER_CHAT_RATE = float(os.getenv("OUTBOUND_PER_CHAT_RATE", 1))
+OUTBOUND_PER_CHAT_BURST = float(os.getenv("OUTBOUND_PER_CHAT_BURST", 3))
+OUTBOUND_CONNECTIONS = int(os.getenv("OUTBOUND_CONNECTIONS", 100))
+OUTBOUND_KEEPALIVE = float(os.getenv("OUTBOUND_KEEPALIVE", 60))
+# Queued requests looked at per class when the first ones wait on their chat's limit
+OUTBOUND_SCAN_DEPTH = int(os.getenv("OUTBOUND_SCAN_DEPTH", 64))
+# A chat action shows for ~5 s, repeating it sooner changes nothing
+OUTBOUND_ACTION_TTL = float(os.getenv("OUTBOUND_ACTION_TTL", 4.5))
+
+INLINE, INTERACTIVE, BULK = 0, 1, 2
+CLASS_NAMES = ("inline", "interactive", "bulk")
+
+# Methods that are scheduled; getUpdates, getFile, setWebhook... go straight through
+SCHEDULED_PREFIXES = ("send", "forward", "copy", "edit", "answer", "delete")
+INLINE_METHODS = {"answerInlineQuery", "answerCallbackQuery"}
+
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_priority = ContextVar("outbound_priority", default=None)
+
+
+@contextmanager
+def priority(level):
+    """``with priority(BULK):`` schedules every Bot API call made inside at ``level``.
+
+    Tasks started inside the block inherit it, since they copy the context.
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Ticket:
+    __slots__ = ("chat_id", "enqueued", "future")
+
+    def __init__(self, chat_id, future):
+        self.chat_id = chat_id
+        self.enqueued = time.perf_counter()
+        self.future = future
+
+
+class OutboundScheduler:
+    """Hands out send slots by priority class within the global and per-chat rates.
+
+    Within a class requests are served in order, except that one waiting on its
+    chat's limit doesn't hold up the chats behind it.
+    """
+
+    def __init__(self, rate=OUTBOUND_RATE, per_chat_rate=OUTBOUND_PER_CHAT_RATE,
+                 per_chat_burst=OUTBOUND_PER_CHAT_BURST, scan_depth=OUTBOUND_SCAN_DEPTH):
+        self.bucket = TokenBucket(rate)
+        self.chat_buckets = KeyedBuckets(per_chat_rate, per_chat_burst)
+        self.scan_depth = scan_depth
+        self.exempt_chats = set()
+        self.queues = [deque() for _ in CLASS_NAMES]
+        self.waits = [Histogram(WAIT_BUCKETS) for _ in CLASS_NAMES]
+        self.max_wait = [0.0] * len(CLASS_NAMES)
+        self.flood_waits = 0
+        self._wake = None
+        self._task = None
+
+    def exempt(self, chat_id):
+        """Sends to ``chat_id`` (e.g. the inline storage channel) only count against the global rate."""
+        self.exempt_chats.add(str(chat_id))
+
+    def _limited(self, chat_id):
+        return chat_id is not None and str(chat_id) not in self.exempt_chats
+
+    def _chat_delay(self, chat_id):
+        return self.chat_buckets.get(chat_id).delay() if self._limited(chat_id) else 0.0
+
+    def _grant(self, level, ticket):
+        self.bucket.try_acquire()
+        if self._limited(ticket.chat_id):
+            self.chat_buckets.try_acquire(ticket.chat_id)
+        waited = time.perf_counter() - ticket.enqueued
+        self.waits[level].observe(waited)
+        self.max_wait[level] = max(self.max_wait[level], waited)
+        ticket.future.set_result(None)
+
+    async def acquire(self, level, chat_id=None):
+        """Waits until a request of class ``level`` to ``chat_id`` may be sent."""
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        # Fast path: nothing as urgent is waiting and both buckets have a token
+        if not any(self.queues[:level + 1]) and not self._chat_delay(chat_id) and not self.bucket.delay():
+            self._grant(level, _Ticket(chat_id, asyncio.get_running_loop().create_future()))
+            return
+        ticket = _Ticket(chat_id, asyncio.get_running_loop().create_future())
+        self.queues[level].append(ticket)
+        self._wake.set()
+        await ticket.future
+
+    def _pick(self):
+        """``(level, ticket, delay)``: the request to let through now, else how long to wait.
+
+        A delay of None means the queues are empty: wait for the next request.
+        """
+        if not any(self.queues):
+            return None, None, None
+        delay = self.bucket.delay()
+        if delay:
+            return None, None, delay
+        soonest = None
+        for level, queue in enumerate(self.queues):
+            for index, ticket in enumerate(itertools.islice(queue, self.scan_depth)):
+                if ticket.future.done():  # the caller was cancelled
+                    del queue[index]
+                    return None, None, 0
+                wait = self._chat_delay(ticket.chat_id)
+                if not wait:
+                    del queue[index]
+                    return level, ticket, 0
+                soonest = wait if soonest is None else min(soonest, wait)
+        return None, None, soonest
+
+    async def _run(self):
+        while True:
+            level, ticket, delay = self._pick()
+            if ticket is not None:
+                self._grant(level, ticket)
+                continue
+            if delay == 0:
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def flood_wait(self, chat_id, seconds):
+        """Telegram answered RetryAfter: hold that chat, or everything for a chat without its own limit."""
+        self.flood_waits += 1
+        if not self._limited(chat_id):
+            self.bucket.pause(seconds)
+        else:
+            self.chat_buckets.get(chat_id).pause(seconds)
+
+    def _quantile_ms(self, q):
+        return {name: h.quantile(q) * 1000 for name, h in zip(CLASS_NAMES, self.waits)}
+
+    def stats(self):
+        return {
+            "queued": {name: len(queue) for name, queue in zip(CLASS_NAMES, self.queues)},
+            "sent": {name: histogram.count for name, histogram in zip(CLASS_NAMES, self.waits)},
+            # Bucket upper bounds, like the handler percentiles on /metrics
+            "wait_p50_ms": self._quantile_ms(0.5),
+            "wait_p99_ms": self._quantile_ms(0.99),
+            "wait_max_ms": {name: round(wait * 1000, 1) for name, wait in zip(CLASS_NAMES, self.max_wait)},
+            "flood_waits": self.flood_waits,
+            "chats": len(self.chat_buckets),
+        }
+
+    def summary(self):
+        """Plain-text report for the /perf admin command."""
+        stats = self.stats()
+        lines = [f"{'outbound wait':<14} {'queued':>6} {'sent':>7} {'p50':>6} {'p99':>6} {'max_ms':>8}"]
+        for name in CLASS_NAMES:
+            lines.append(f"{name:<14} {stats['queued'][name]:>6} {stats['sent'][name]:>7} "
+                         f"{stats['wait_p50_ms'][name]:>6g} {stats['wait_p99_ms'][name]:>6g} "
+                         f"{stats['wait_max_ms'][name]:>8}")
+        return "\n".join(lines)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class OutboundBot(Bot):
+    """A Bot whose API calls go through an OutboundScheduler.
+
+    The class of a call is the ``priority()`` in effect, else INLINE for inline
+    and callback answers and INTERACTIVE for everything else.
+    """
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        kwargs.setdefault("connections_limit", OUTBOUND_CONNECTIONS)
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or OutboundScheduler()
+        self.coalesced_actions = 0
+        self._actions = {}
+        if self._connector_class is aiohttp.TCPConnector:
+            # aiogram already keeps one session; keep its connections (and DNS answers) alive longer
+            self._connector_init.update(keepalive_timeout=OUTBOUND_KEEPALIVE, ttl_dns_cache=300)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if not method.startswith(SCHEDULED_PREFIXES):
+            return await super().request(method, data, files, **kwargs)
+        chat_id = data.get("chat_id") if data else None
+        if method == "sendChatAction":
+            key = (chat_id, data.get("action"))
+            now = time.monotonic()
+            if now - self._actions.get(key, -OUTBOUND_ACTION_TTL) < OUTBOUND_ACTION_TTL:
+                self.coalesced_actions += 1
+                return True
+            self._actions[key] = now
+            if len(self._actions) > 10000:
+                self._actions = {k: t for k, t in self._actions.items() if now - t < OUTBOUND_ACTION_TTL}
+        level = _priority.get()
+        if level is None:
+            level = INLINE if method in INLINE_METHODS else INTERACTIVE
+        await self.scheduler.acquire(level, chat_id)
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except RetryAfter as e:
+            logging.warning(f"Flood control on {method} to {chat_id}: retry in {e.timeout}s")
+            self.scheduler.flood_wait(chat_id, e.timeout)
+            raise
+
+    def stats(self):
+        return dict(self.scheduler.stats(), coalesced_actions=self.coalesced_actions)
+
+    async def close(self):
+        await self.scheduler.stop()
+        await super().close()
+
+
+class PriorityMiddleware(BaseMiddleware):
+    """Sends everything done on behalf of an admin (broadcasts, reports) as BULK."""
+
+    def __init__(self, admin_ids):
+        super().__init__()
+        self.admin_ids = set(admin_ids)
+
+    def _set(self, user, data):
+        if user is not None and user.id in self.admin_ids:
+            data["_outbound_priority"] = _priority.set(BULK)
+
+    def _reset(self, data):
+        token = data.pop("_outbound_priority", None)
+        if token is not None:
+            _priority.reset(token)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        self._set(message.from_user, data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._reset(data)
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self._set(callback_query.from_user, data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._reset(data)
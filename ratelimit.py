@@ -0,0 +1,73 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, bursts up to ``capacity``."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """Seconds until ``tokens`` would be available."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+    def pause(self, seconds):
+        """Block the bucket, e.g. after Telegram answered with RetryAfter."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class KeyedBuckets:
+    """One TokenBucket per key (chat, user...), keeping at most ``max_keys`` of them."""
+
+    def __init__(self, rate, capacity=None, max_keys=100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def get(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def try_acquire(self, key, tokens=1):
+        return self.get(key).try_acquire(tokens)
+
+    async def acquire(self, key, tokens=1):
+        await self.get(key).acquire(tokens)
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,238 @@
+import os
+import re
+import struct
+import zlib
+from io import BytesIO
+
+from lazy import lazy_import
+
+# Loaded on first render, in the worker that renders
+qrcode = lazy_import("qrcode")
+Image = lazy_import("PIL.Image")
+features = lazy_import("PIL.features")
+encoder = lazy_import("encoder")
+np = lazy_import("numpy")  # optional, the bytes-level path is used instead
+
+# "fast" builds the bitmap from the module matrix, "legacy" is qrcode.make().save()
+RENDER_ENGINE = os.getenv("RENDER_ENGINE", "fast")
+BOX_SIZE = 10
+BORDER = 4
+
+ENGINES = ("fast", "legacy")
+FORMATS = ("png", "jpeg", "svg", "webp")
+# Telegram shows these as documents rather than photos
+DOCUMENT_FORMATS = ("svg", "webp")
+# encoder.ECC_LEVELS names, without importing qrcode for option parsing
+ECC_NAMES = ("L", "M", "Q", "H")
+# encoder.RENDER_ECC, likewise read here so cache keys don't load the encoder
+RENDER_ECC = os.getenv("RENDER_ECC", "M").upper()
+
+# 1-bit palette: index 0 is white, 1 is black
+_PALETTE = b"\xff\xff\xff\x00\x00\x00"
+
+
+def qr_matrix(data: str, border=BORDER, ecc=None, **params):
+    """Module matrix from the fast encoder; ``params`` go to encoder.encode (version, mask)."""
+    return encoder.encode(data, ecc=ecc, border=border, **params)
+
+
+def _chunk(tag, body):
+    return struct.pack(">I", len(body)) + tag + body + struct.pack(">I", zlib.crc32(tag + body))
+
+
+def _scanlines(matrix, box_size):
+    """Filter-type-0 PNG scanlines of the scaled 1-bit bitmap."""
+    if np is not None:
+        modules = np.asarray(matrix, dtype=np.uint8)
+        rows = np.packbits(np.repeat(modules, box_size, axis=1), axis=1)
+        rows = np.hstack([np.zeros((rows.shape[0], 1), dtype=np.uint8), rows])
+        return np.repeat(rows, box_size, axis=0).tobytes()
+    width = len(matrix[0]) * box_size
+    pad = -width % 8
+    on, off = "1" * box_size, "0" * box_size
+    lines = []
+    for row in matrix:
+        bits = "".join(on if module else off for module in row) + "0" * pad
+        line = b"\x00" + int(bits, 2).to_bytes((width + pad) // 8, "big")
+        lines.append(line * box_size)
+    return b"".join(lines)
+
+
+def matrix_to_png(matrix, box_size=BOX_SIZE) -> bytes:
+    """Encode a module matrix straight to a 1-bit palette PNG."""
+    size = len(matrix) * box_size
+    header = struct.pack(">IIBBBBB", size, size, 1, 3, 0, 0, 0)
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        _chunk(b"IHDR", header),
+        _chunk(b"PLTE", _PALETTE),
+        _chunk(b"IDAT", zlib.compress(_scanlines(matrix, box_size), 9)),
+        _chunk(b"IEND", b""),
+    ))
+
+
+def matrix_to_svg(matrix, box_size=BOX_SIZE) -> bytes:
+    """SVG with one path; horizontal runs of dark modules are merged."""
+    if np is not None and isinstance(matrix, np.ndarray):
+        matrix = matrix.tolist()
+    size = len(matrix)
+    parts = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < size and row[x]:
+                x += 1
+            parts.append(f"M{start} {y}h{x - start}v1h{start - x}z")
+    pixels = size * box_size
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{pixels}" height="{pixels}" '
+        f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<rect width="100%" height="100%" fill="#fff"/>'
+        f'<path d="{"".join(parts)}" fill="#000"/></svg>'
+    ).encode("utf-8")
+
+
+def _save(img, fmt):
+    bio = BytesIO()
+    if fmt == "jpeg":
+        img.convert("L").save(bio, "JPEG", quality=90)
+    elif fmt == "webp":
+        if not features.check("webp"):
+            raise ValueError("WebP output is not available in this Pillow build")
+        img.convert("L").save(bio, "WEBP", lossless=True)
+    else:
+        img.save(bio, "PNG")
+    return bio.getvalue()
+
+
+def render_legacy(data: str, fmt: str = "png", ecc: str = None) -> bytes:
+    """The original qrcode.make() path, kept for comparison."""
+    qr = qrcode.QRCode(error_correction=encoder.ecc_level(ecc), border=BORDER)
+    qr.add_data(data)
+    qr.make(fit=True)
+    if fmt == "svg":
+        return matrix_to_svg(qr.get_matrix())
+    return _save(qr.make_image().get_image(), fmt)
+
+
+def render_fast(data: str, fmt: str = "png", ecc: str = None) -> bytes:
+    matrix = qr_matrix(data, ecc=ecc)
+    if fmt == "png":
+        return matrix_to_png(matrix)
+    if fmt == "svg":
+        return matrix_to_svg(matrix)
+    return _save(Image.open(BytesIO(matrix_to_png(matrix))), fmt)
+
+
+def render_png(data: str) -> bytes:
+    """Render ``data`` as a QR code and return the encoded PNG bytes."""
+    return render_qr(data, "png")
+
+
+def render_jpeg(data: str) -> bytes:
+    """JPEG variant, for Telegram fields that only take JPEG (inline photo_url)."""
+    return render_qr(data, "jpeg")
+
+
+def render_qr(data: str, fmt: str = "png", engine: str = None, ecc: str = None) -> bytes:
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    if (engine or RENDER_ENGINE) == "legacy":
+        return render_legacy(data, fmt, ecc)
+    return render_fast(data, fmt, ecc)
+
+
+def cache_params(fmt="png", engine=None, ecc=None):
+    """Render cache key parameters for RenderCache.key.
+
+    Everything that changes the image goes in, except what matches the keys made
+    before render options existed (RENDER_ENGINE, ECC M), so those file_ids still hit.
+    """
+    params = {"fmt": fmt}
+    if engine and engine != RENDER_ENGINE:
+        params["engine"] = engine
+    ecc = (ecc or RENDER_ECC).upper()
+    if ecc != "M":
+        params["ecc"] = ecc
+    return params
+
+
+_OPTION = re.compile(r"--(\w+)(?:=(\S+))?(?:\s+|$)")
+
+
+def parse_render_options(args: str):
+    """Split leading ``--svg``/``--webp``/``--legacy``/``--format=..``/``--ecc=..`` flags from the text.
+
+    Returns ``(options, text)``; unknown flags are left in the text.
+    """
+    options = {}
+    while True:
+        match = _OPTION.match(args)
+        if not match:
+            break
+        key, value = match.group(1).lower(), (match.group(2) or "").lower()
+        if key in FORMATS and not value:
+            options["fmt"] = key
+        elif key in ENGINES and not value:
+            options["engine"] = key
+        elif key == "format" and value in FORMATS:
+            options["fmt"] = value
+        elif key == "engine" and value in ENGINES:
+            options["engine"] = value
+        elif key == "ecc" and value.upper() in ECC_NAMES:
+            options["ecc"] = value.upper()
+        else:
+            break
+        args = args[match.end():]
+    return options, args
+
+
+def benchmark(rounds=10):
+    """Compare the legacy and fast paths per payload size; run ``python render.py``.
+
+    ``encode_ms`` is text -> module matrix (qrcode's fit + mask search vs the
+    encoder), ``total_ms`` the whole PNG render; ``fast+mask`` fixes mask 0.
+    """
+    import timeit
+
+    payloads = {
+        "16": "https://t.me/qrb",
+        "wifi": "WIFI:T:WPA;S:HomeNetwork;P:correct horse battery staple;;",
+        "100": "https://example.com/" + "a1b2c3d4" * 10,
+        "300": "https://example.com/" + "a1b2c3d4" * 35,
+        "1000": "x" * 1000,
+        "num1000": "1234567890" * 100,
+    }
+
+    def legacy_matrix(payload):
+        qr = qrcode.QRCode(border=BORDER)
+        qr.add_data(payload)
+        qr.make(fit=True)
+        return qr.get_matrix()
+
+    cases = {
+        "legacy": (legacy_matrix, lambda p: render_qr(p, "png", "legacy")),
+        "fast": (lambda p: qr_matrix(p, mask=None), lambda p: render_qr(p, "png", "fast")),
+        "fast+mask": (lambda p: qr_matrix(p, mask=0), lambda p: matrix_to_png(qr_matrix(p, mask=0))),
+    }
+    rows = []
+    for name, payload in payloads.items():
+        baseline = None
+        for engine, (to_matrix, render) in cases.items():
+            encode_ms = timeit.timeit(lambda: to_matrix(payload), number=rounds) / rounds * 1000
+            total_ms = timeit.timeit(lambda: render(payload), number=rounds) / rounds * 1000
+            baseline = baseline or total_ms
+            rows.append((name, engine, encode_ms, total_ms, baseline / total_ms,
+                         len(to_matrix(payload)) - 2 * BORDER, len(render(payload))))
+    return rows
+
+
+if __name__ == "__main__":
+    print(f"numpy: {'yes' if np is not None else 'no'}")
+    print(f"{'payload':<8} {'engine':<10} {'encode_ms':>9} {'total_ms':>9} {'speedup':>8} {'modules':>8} {'bytes':>7}")
+    for name, engine, encode_ms, total_ms, speedup, modules, size in benchmark():
+        print(f"{name:<8} {engine:<10} {encode_ms:9.2f} {total_ms:9.2f} {speedup:7.1f}x {modules:8d} {size:7d}")
@@ -0,0 +1,200 @@
+import os
+import time
+from io import BytesIO
+
+from decoders import decode
+from lazy import lazy_import
+
+Image = lazy_import("PIL.Image")
+ImageChops = lazy_import("PIL.ImageChops")
+ImageFilter = lazy_import("PIL.ImageFilter")
+ImageOps = lazy_import("PIL.ImageOps")
+
+# Longest side of the cheap first pass
+SCAN_DOWNSCALE = int(os.getenv("SCAN_DOWNSCALE", 800))
+# Box-blur radius and offset for the adaptive threshold pass
+SCAN_THRESHOLD_RADIUS = int(os.getenv("SCAN_THRESHOLD_RADIUS", 15))
+SCAN_THRESHOLD_OFFSET = int(os.getenv("SCAN_THRESHOLD_OFFSET", 8))
+SCAN_ROTATIONS = (15, 30, 45)
+
+# Image documents (uncompressed originals): limits and the tiling pass
+SCAN_MAX_DOCUMENT_BYTES = int(os.getenv("SCAN_MAX_DOCUMENT_BYTES", 20 * 1024 * 1024))
+# Largest image accepted at all, judged from the header before decoding
+SCAN_MAX_PIXELS = int(os.getenv("SCAN_MAX_PIXELS", 100_000_000))
+# Largest image ever held decoded in a worker; JPEGs are decoded at a reduced scale to fit
+SCAN_MAX_DECODE_PIXELS = int(os.getenv("SCAN_MAX_DECODE_PIXELS", 16_000_000))
+# Longest side of the draft-mode first pass
+SCAN_DRAFT_SIZE = int(os.getenv("SCAN_DRAFT_SIZE", 1600))
+SCAN_TILE_SIZE = int(os.getenv("SCAN_TILE_SIZE", 1024))
+SCAN_TILE_OVERLAP = float(os.getenv("SCAN_TILE_OVERLAP", 0.25))
+SCAN_TILE_SCALES = tuple(float(s) for s in os.getenv("SCAN_TILE_SCALES", "1,0.5").split(","))
+SCAN_DOCUMENT_TIMEOUT = float(os.getenv("SCAN_DOCUMENT_TIMEOUT", 60))
+DOCUMENT_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+class ScanTooLarge(ValueError):
+    pass
+
+
+def _downscaled(gray):
+    if max(gray.size) <= SCAN_DOWNSCALE:
+        return None
+    small = gray.copy()
+    small.thumbnail((SCAN_DOWNSCALE, SCAN_DOWNSCALE), Image.BILINEAR)
+    return small
+
+
+def adaptive_threshold(gray, radius=SCAN_THRESHOLD_RADIUS, offset=SCAN_THRESHOLD_OFFSET):
+    """Binarize against the local mean, which copes with shadows and glare."""
+    local_mean = gray.filter(ImageFilter.BoxBlur(radius))
+    diff = ImageChops.subtract(gray, local_mean, offset=128)
+    return diff.point(lambda v: 255 if v >= 128 - offset else 0)
+
+
+def _stages(gray):
+    """Decode passes from cheapest to most expensive; None means "skip"."""
+    yield "downscaled", lambda: _downscaled(gray)
+    yield "full", lambda: gray
+    yield "adaptive", lambda: adaptive_threshold(gray)
+    yield "inverted", lambda: ImageOps.invert(gray)
+    for angle in SCAN_ROTATIONS:
+        yield f"rotated_{angle}", lambda angle=angle: gray.rotate(angle, expand=True, fillcolor=255)
+
+
+def _symbols(decoded):
+    return [(symbol.type, symbol.data) for symbol in decoded]
+
+
+def scan_image(img) -> dict:
+    """Run the decode cascade on a PIL image, stopping at the first stage that finds codes.
+
+    Returns ``{"codes": [payload, ...], "symbols": [(type, payload), ...],
+    "stage": name or None, "timings": {stage: ms}}``.
+    """
+    timings = {}
+    started = time.perf_counter()
+    gray = img.convert("L")
+    timings["grayscale"] = (time.perf_counter() - started) * 1000
+    for name, prepare in _stages(gray):
+        started = time.perf_counter()
+        candidate = prepare()
+        if candidate is None:
+            continue
+        symbols = list(dict.fromkeys(_symbols(decode(candidate))))
+        timings[name] = (time.perf_counter() - started) * 1000
+        if symbols:
+            return {"codes": [data for _, data in symbols], "symbols": symbols, "stage": name, "timings": timings}
+    return {"codes": [], "symbols": [], "stage": None, "timings": timings}
+
+
+def scan_bytes(data: bytes) -> dict:
+    """Decode an encoded image held in memory (worker pool entry point)."""
+    with Image.open(BytesIO(data)) as img:
+        return scan_image(img)
+
+
+def is_image_document(file_name, mime_type=None):
+    return (file_name or "").lower().endswith(DOCUMENT_IMAGE_EXTENSIONS) or (mime_type or "").startswith("image/")
+
+
+def _open_reduced(path, max_pixels, max_side=None):
+    """Open ``path`` as grayscale, at the largest JPEG DCT scale (1, 1/2, 1/4, 1/8) within the limits.
+
+    Draft mode makes libjpeg decode straight to the reduced size, so the full
+    image is never in memory. Other formats have no such shortcut and must fit
+    ``max_pixels`` as they are.
+    """
+    img = Image.open(path)
+    width, height = img.size
+    if img.format == "JPEG":
+        for scale in (1, 2, 4, 8):
+            w, h = -(-width // scale), -(-height // scale)
+            if w * h <= max_pixels and (max_side is None or max(w, h) <= max_side or scale == 8):
+                break
+        img.draft("L", (w, h))
+    elif width * height > max_pixels:
+        img.close()
+        raise ScanTooLarge(f"{width}x{height} is too large to decode, send it as a JPEG or scale it down.")
+    with img:
+        return img.convert("L"), width / img.size[0]
+
+
+def _tiles(gray, size, overlap):
+    width, height = gray.size
+    stride = max(1, int(size * (1 - overlap)))
+    for top in range(0, max(1, height - size + stride), stride):
+        for left in range(0, max(1, width - size + stride), stride):
+            yield gray.crop((left, top, min(left + size, width), min(top + size, height)))
+
+
+def scan_file(path) -> dict:
+    """Scan a large image file within a fixed memory budget (worker pool entry point).
+
+    First a cheap pass on a draft-decoded copy (finds codes that fill a good part
+    of the picture), then overlapping tiles at a few scales of the largest copy
+    that fits SCAN_MAX_DECODE_PIXELS, for small codes and several codes.
+    """
+    size = os.path.getsize(path)
+    if size > SCAN_MAX_DOCUMENT_BYTES:
+        raise ScanTooLarge(f"The file is larger than {SCAN_MAX_DOCUMENT_BYTES // (1024 * 1024)} MB.")
+    with Image.open(path) as img:
+        width, height = img.size
+    if width * height > SCAN_MAX_PIXELS:
+        raise ScanTooLarge(f"{width}x{height} is more than {SCAN_MAX_PIXELS // 1_000_000} megapixels.")
+
+    started = time.perf_counter()
+    draft, reduction = _open_reduced(path, SCAN_MAX_DECODE_PIXELS, SCAN_DRAFT_SIZE)
+    timings = {"draft_decode": (time.perf_counter() - started) * 1000}
+    result = scan_image(draft)
+    timings.update({f"draft_{name}": ms for name, ms in result["timings"].items()})
+    stage = f"draft_1/{reduction:.0f}:{result['stage']}" if result["codes"] else None
+    if reduction == 1:
+        # The draft was the whole picture already, the cascade has seen everything
+        return dict(result, stage=stage, timings=timings)
+    del draft
+
+    # Small codes got lost in the reduction: look again, tile by tile
+    started = time.perf_counter()
+    gray, reduction = _open_reduced(path, SCAN_MAX_DECODE_PIXELS)
+    timings["decode"] = (time.perf_counter() - started) * 1000
+    symbols = dict.fromkeys(result["symbols"])
+    for scale in SCAN_TILE_SCALES:
+        started = time.perf_counter()
+        scaled = gray if scale == 1 else gray.resize(
+            (max(1, int(gray.width * scale)), max(1, int(gray.height * scale))), Image.BILINEAR)
+        found = len(symbols)
+        for tile in _tiles(scaled, SCAN_TILE_SIZE, SCAN_TILE_OVERLAP):
+            symbols.update(dict.fromkeys(_symbols(decode(tile))))
+        timings[f"tiles_x{scale:g}"] = (time.perf_counter() - started) * 1000
+        if len(symbols) > found and stage is None:
+            stage = f"tiles_1/{reduction:.0f}_x{scale:g}"
+    symbols = list(symbols)
+    return {"codes": [data for _, data in symbols], "symbols": symbols, "stage": stage, "timings": timings}
+
+
+class ScanStats:
+    """Aggregated per-stage timings and hit counts, kept in the bot process."""
+
+    def __init__(self):
+        self.scans = 0
+        self.hits = {}
+        self.total_ms = {}
+        self.runs = {}
+
+    def record(self, result):
+        self.scans += 1
+        stage = result["stage"] or "miss"
+        self.hits[stage] = self.hits.get(stage, 0) + 1
+        for name, ms in result["timings"].items():
+            self.total_ms[name] = self.total_ms.get(name, 0.0) + ms
+            self.runs[name] = self.runs.get(name, 0) + 1
+
+    def stats(self):
+        return {
+            "scans": self.scans,
+            "hits_by_stage": dict(self.hits),
+            "avg_ms_by_stage": {name: self.total_ms[name] / self.runs[name] for name in self.runs},
+        }
+
+
+scan_stats = ScanStats()
@@ -0,0 +1,309 @@
+"""Sharded deployment: one front process, N dispatcher worker processes.
+
+The front receives updates (polling or webhook) and routes each one to a worker
+by user id, so a user's FSM conversation always lives in the same worker.
+Users, FSM state and file_ids are in SQLite files all workers share; worker N
+serves /metrics on METRICS_PORT + N.
+
+    python sharding.py --workers 4 [--mode polling|webhook]
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing as mp
+import os
+import queue
+import secrets
+import signal
+import time
+
+from dotenv import load_dotenv
+
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", os.cpu_count() or 2))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 1000))
+SHARD_WORKER_CONCURRENCY = int(os.getenv("SHARD_WORKER_CONCURRENCY", 64))
+SHARD_HEALTH_INTERVAL = float(os.getenv("SHARD_HEALTH_INTERVAL", 2))
+# A worker whose heartbeat is older than this, or that has not finished an update
+# for this long while updates wait in its queue, is considered hung and restarted
+SHARD_HEALTH_TIMEOUT = float(os.getenv("SHARD_HEALTH_TIMEOUT", 30))
+SHARD_STATS_INTERVAL = float(os.getenv("SHARD_STATS_INTERVAL", 60))
+
+# Update fields that carry the user who caused the update
+USER_FIELDS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+    "chat_join_request", "channel_post", "edited_channel_post",
+)
+
+_ctx = mp.get_context("spawn")
+
+
+def update_user_id(update: dict):
+    for field in USER_FIELDS:
+        obj = update.get(field)
+        if obj:
+            user = obj.get("from") or obj.get("user") or obj.get("chat") or {}
+            return user.get("id")
+    return None
+
+
+def _worker(index, updates, heartbeat, done):
+    """Worker process: runs the real Dispatcher from main.py on routed updates."""
+    # Each worker appends to its own analytics files; reports merge them
+    os.environ["ANALYTICS_WRITER"] = f"shard{index}"
+    import main
+    from aiogram import Bot, Dispatcher, types
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        Bot.set_current(main.bot)
+        Dispatcher.set_current(main.dp)
+        semaphore = asyncio.Semaphore(SHARD_WORKER_CONCURRENCY)
+        tasks = set()
+
+        async def beat():
+            while True:
+                heartbeat.value = time.time()
+                await asyncio.sleep(1)
+
+        async def process(data):
+            async with semaphore:
+                try:
+                    await main.dp.process_update(types.Update(**data))
+                except Exception as e:
+                    logging.error(f"Worker {index}: error processing update {data.get('update_id')}: {e}")
+                finally:
+                    with done.get_lock():
+                        done.value += 1
+
+        beat_task = asyncio.ensure_future(beat())
+        # Every worker starts its local services; startup messages, bot commands,
+        # broadcast resume and the inline photo server are worker 0's
+        await main.on_startup(main.dp, shard=index)
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            task = asyncio.ensure_future(process(data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+        beat_task.cancel()
+        await main.on_shutdown(main.dp)
+        session = await main.bot.get_session()
+        await session.close()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the front decides when to stop
+    asyncio.run(run())
+
+
+class Shard:
+    def __init__(self, index):
+        self.index = index
+        self.updates = _ctx.Queue(SHARD_QUEUE_SIZE)
+        self.heartbeat = _ctx.Value("d", time.time())
+        self.done = _ctx.Value("q", 0)
+        self.sent = 0
+        self.restarts = 0
+        self.process = None
+        self._last_done = 0
+        self._progress_at = time.time()
+
+    def start(self):
+        self.heartbeat.value = time.time()
+        self._progress_at = time.time()
+        self.process = _ctx.Process(
+            target=_worker, args=(self.index, self.updates, self.heartbeat, self.done),
+            # Not a daemon: workers own their own render/scan process pools
+            name=f"qr-shard-{self.index}",
+        )
+        self.process.start()
+        logging.info(f"Started shard worker {self.index} (pid {self.process.pid})")
+
+    @property
+    def queue_depth(self):
+        return self.sent - self.done.value
+
+    def _waiting(self):
+        """Updates the worker has not picked up yet."""
+        try:
+            return self.updates.qsize()
+        except NotImplementedError:  # macOS: in-flight updates count too
+            return self.queue_depth
+
+    def healthy(self):
+        if not self.process.is_alive() or time.time() - self.heartbeat.value >= SHARD_HEALTH_TIMEOUT:
+            return False
+        # A live heartbeat is not enough: the reader thread can be stuck while the
+        # event loop still ticks, so updates pile up and nothing gets processed
+        done = self.done.value
+        if done != self._last_done or self._waiting() <= 0:
+            self._last_done, self._progress_at = done, time.time()
+        return time.time() - self._progress_at < SHARD_HEALTH_TIMEOUT
+
+    def _replace_queue(self):
+        """Give the new worker a fresh queue and move the queued updates over.
+
+        The killed worker may have died holding the old queue's read lock (its
+        reader thread sits in get()), so the old pipe is read directly.
+        """
+        old, self.updates = self.updates, _ctx.Queue(SHARD_QUEUE_SIZE)
+        moved = 0
+        try:
+            while old._reader.poll(0.2):
+                self.updates.put_nowait(old._reader.recv())
+                moved += 1
+        except Exception as e:  # a message the dead worker was halfway through reading
+            logging.warning(f"Shard {self.index}: stopped moving queued updates after {moved}: {e}")
+        old.cancel_join_thread()
+        old.close()
+        return moved
+
+    def restart(self):
+        logging.warning(f"Restarting shard worker {self.index} (exit code {self.process.exitcode})")
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(5)
+        # Queued updates move to the new queue; the ones it was handling are lost
+        self.sent = self.done.value + self._replace_queue()
+        self._last_done = self.done.value
+        self.restarts += 1
+        self.start()
+
+    def stats(self):
+        return {
+            "pid": self.process.pid if self.process else None,
+            "alive": bool(self.process and self.process.is_alive()),
+            "queue_depth": self.queue_depth,
+            "processed": self.done.value,
+            "restarts": self.restarts,
+            "heartbeat_age": round(time.time() - self.heartbeat.value, 1),
+        }
+
+
+class ShardRouter:
+    """Front-process side: routes updates to workers and keeps them healthy."""
+
+    def __init__(self, workers=SHARD_WORKERS):
+        self.shards = [Shard(index) for index in range(max(1, workers))]
+        self.unrouted = 0
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def shard_for(self, update: dict):
+        user_id = update_user_id(update)
+        if user_id is None:
+            self.unrouted += 1
+            user_id = update.get("update_id", 0)
+        return self.shards[user_id % len(self.shards)]
+
+    async def route(self, update: dict):
+        shard = self.shard_for(update)
+        while True:
+            try:
+                shard.updates.put_nowait(update)
+                break
+            except queue.Full:
+                # Back-pressure: wait for the worker to catch up. Polls rather than
+                # blocking in put(), since a restart swaps the shard's queue.
+                await asyncio.sleep(0.05)
+        shard.sent += 1
+
+    async def route_update(self, update):
+        await self.route(update.to_python())
+
+    async def monitor(self):
+        last_stats = time.monotonic()
+        while True:
+            await asyncio.sleep(SHARD_HEALTH_INTERVAL)
+            for shard in self.shards:
+                if not shard.healthy():
+                    shard.restart()
+            if time.monotonic() - last_stats >= SHARD_STATS_INTERVAL:
+                logging.info(f"Shard stats: {self.stats()}")
+                last_stats = time.monotonic()
+
+    def stats(self):
+        return {"unrouted": self.unrouted, "workers": [shard.stats() for shard in self.shards]}
+
+    def stop(self, timeout=30):
+        for shard in self.shards:
+            shard.updates.put(None)
+        deadline = time.monotonic() + timeout
+        for shard in self.shards:
+            shard.process.join(max(0.0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                shard.process.terminate()
+
+
+async def _poll(bot, router, stop):
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20)
+        except Exception as e:
+            logging.error(f"getUpdates failed: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await router.route(update.to_python())
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Run the bot as a front process plus N dispatcher workers")
+    parser.add_argument("--workers", type=int, default=SHARD_WORKERS)
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.getenv("BOT_MODE", "polling"))
+    args = parser.parse_args()
+
+    # Split the render/scan pool between the shards unless it was sized explicitly
+    os.environ.setdefault("WORKER_COUNT", str(max(1, (os.cpu_count() or 2) // args.workers)))
+    # OUTBOUND_RATE is one process's budget; Telegram's limit is per bot, so the
+    # workers share it (per-chat limits stay as they are: a user sticks to one worker)
+    os.environ["OUTBOUND_RATE"] = str(float(os.getenv("OUTBOUND_RATE", 30)) / args.workers)
+    # Inline photo URLs handed out by any worker are served by worker 0
+    os.environ.setdefault("INLINE_URL_SECRET", secrets.token_urlsafe(32))
+
+    from aiogram import Bot
+    from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
+    # The same Bot API server as the workers (main.py), e.g. benchmarks/fake_api.py
+    api_server = os.getenv("BOT_API_SERVER")
+    bot = Bot(token=os.getenv("BOT_TOKEN"),
+              server=TelegramAPIServer.from_base(api_server) if api_server else TELEGRAM_PRODUCTION)
+    router = ShardRouter(args.workers)
+
+    async def run():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        router.start()
+        monitor = asyncio.ensure_future(router.monitor())
+        if args.mode == "webhook":
+            from webhook import WebhookServer, WEBHOOK_URL
+            server = WebhookServer(None, process=router.route_update)
+            await server.start()
+            await bot.set_webhook(WEBHOOK_URL + server.path, secret_token=server.secret)
+            await stop.wait()
+            await server.shutdown()
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.ensure_future(_poll(bot, router, stop))
+            await stop.wait()
+            poller.cancel()
+        monitor.cancel()
+        logging.info("Stopping shard workers...")
+        await loop.run_in_executor(None, router.stop)
+        session = await bot.get_session()
+        await session.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import asyncio
+import os
+
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", 0.25))
+
+
+class StaleQuery(Exception):
+    """Raised for a request superseded by a newer one from the same user."""
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one in-flight future."""
+
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, func):
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(func())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        # Shielded so one waiter going away doesn't cancel the work for the others
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._calls)}
+
+
+class LatestOnly:
+    """Keeps only the newest request per user alive.
+
+    Each request waits ``debounce`` seconds before doing any work; a newer request
+    from the same user cancels the older one, which then raises StaleQuery.
+    """
+
+    def __init__(self, debounce=INLINE_DEBOUNCE):
+        self.debounce = debounce
+        self._tasks = {}
+        self.superseded = 0
+        self.dropped_in_debounce = 0
+
+    async def _delayed(self, func, debounce):
+        if debounce > 0:
+            try:
+                await asyncio.sleep(debounce)
+            except asyncio.CancelledError:
+                self.dropped_in_debounce += 1
+                raise
+        return await func()
+
+    async def run(self, user_id, func, debounce=None):
+        previous = self._tasks.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.superseded += 1
+        task = asyncio.ensure_future(self._delayed(func, self.debounce if debounce is None else debounce))
+        self._tasks[user_id] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled() and self._tasks.get(user_id) is not task:
+                raise StaleQuery() from None
+            raise
+        finally:
+            if self._tasks.get(user_id) is task:
+                del self._tasks[user_id]
+
+    def stats(self):
+        return {"superseded": self.superseded, "dropped_in_debounce": self.dropped_in_debounce}
+
+
+def renders_saved(*flights, latest=None):
+    """Renders/uploads avoided by single-flight sharing and stale-query drops."""
+    saved = sum(flight.shared for flight in flights)
+    if latest is not None:
+        saved += latest.dropped_in_debounce
+    return saved
@@ -0,0 +1,81 @@
+"""Startup timeline: where the time goes before the bot accepts its first update.
+
+main.py imports this first and marks each step; ``python main.py
+--measure-startup`` prints the marks plus a per-module import breakdown
+(from ``python -X importtime``) and exits 1 when STARTUP_BUDGET is exceeded.
+"""
+import logging
+import os
+import subprocess
+import sys
+import time
+
+# Seconds from the first line of main.py until updates are accepted
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", 2.0))
+
+
+class StartupTimeline:
+    def __init__(self, budget=STARTUP_BUDGET):
+        self.budget = budget
+        self.started = time.perf_counter()
+        self.marks = []
+        self.background = []
+        self.ready_after = None
+        self._last = self.started
+
+    def mark(self, step):
+        """Ends ``step``: it took the time since the previous mark."""
+        now = time.perf_counter()
+        self.marks.append((step, now - self._last))
+        self._last = now
+
+    def ready(self):
+        """Everything updates depend on is up; logs a warning past the budget."""
+        self.ready_after = time.perf_counter() - self.started
+        if self.ready_after > self.budget:
+            logging.warning(f"Startup took {self.ready_after:.2f}s, over the {self.budget:.1f}s budget")
+        else:
+            logging.info(f"Ready to accept updates after {self.ready_after:.2f}s")
+
+    def background_done(self, step, seconds):
+        """Work started at startup that updates don't wait for, e.g. worker warm-up."""
+        self.background.append((step, seconds))
+
+    def report(self, imports=None):
+        lines = [f"{'step':<36} {'ms':>9}"]
+        for step, seconds in self.marks:
+            lines.append(f"{step:<36} {seconds * 1000:9.1f}")
+            if step == "imports" and imports:
+                lines += [f"  {name:<34} {ms:9.1f}" for name, ms in imports]
+        if self.ready_after is not None:
+            verdict = "within" if self.ready_after <= self.budget else "OVER"
+            lines.append(f"{'ready to accept updates':<36} {self.ready_after * 1000:9.1f}  "
+                         f"({verdict} the {self.budget:.1f}s budget)")
+        for step, seconds in self.background:
+            lines.append(f"{step + ' (background)':<36} {seconds * 1000:9.1f}")
+        return "\n".join(lines)
+
+
+def import_breakdown(module="main", top=12):
+    """``[(name, ms)]`` of the slowest direct imports of ``module``, measured in a fresh interpreter."""
+    # From the bot's directory, so ``module`` is found wherever the bot was started from
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    children, found = [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # the header line
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            children.append((name.strip(), int(cumulative) / 1000))
+        elif depth == 0:
+            if name.strip() == module:
+                found = children
+            children = []
+    return sorted(found, key=lambda item: -item[1])[:top]
+
+
+timeline = StartupTimeline()
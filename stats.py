@@ -1,70 +1,214 @@
+import atexit
 import json
 import logging
 import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
 from pathlib import Path
 
+# Legacy JSON store, imported into the database once
 STATS_FILE = Path("user_stats.json")
+STATS_DB = Path(os.getenv("STATS_DB", "user_stats.db"))
+WRITE_BATCH_SIZE = int(os.getenv("STATS_WRITE_BATCH_SIZE", 50))
+WRITE_BATCH_DELAY = float(os.getenv("STATS_WRITE_BATCH_DELAY", 1.0))
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
 
-def load_stats():
-    if not os.path.exists(STATS_FILE) or os.stat(STATS_FILE).st_size == 0:
-        with open(STATS_FILE, "w") as f:
-            json.dump({"users": []}, f)
-    with open(STATS_FILE, "r") as f:
+class UserStore(ABC):
+    """Storage backend interface for bot users."""
+
+    @abstractmethod
+    def add_user(self, user_id, username=None):
+        pass
+
+    @abstractmethod
+    def delete_user(self, user_id):
+        pass
+
+    @abstractmethod
+    def get_user_by_id(self, user_id):
+        pass
+
+    @abstractmethod
+    def get_user_by_username(self, username):
+        pass
+
+    @abstractmethod
+    def get_user_count(self):
+        pass
+
+    @abstractmethod
+    def get_users(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class SQLiteUserStore(UserStore):
+    """SQLite (WAL) user store.
+
+    New users are buffered and written in batches of WRITE_BATCH_SIZE, or once the
+    oldest buffered user is WRITE_BATCH_DELAY seconds old (a background thread
+    checks that, so a quiet bot that gets killed loses at most that much); reads
+    see the buffer.
+    The user count is kept up to date by triggers, so it never needs a table scan
+    and every shard sees the same number.
+    """
+
+    def __init__(self, path=STATS_DB, json_path=STATS_FILE,
+                 batch_size=WRITE_BATCH_SIZE, batch_delay=WRITE_BATCH_DELAY):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._pending = {}
+        self._pending_since = None
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("INSERT OR IGNORE INTO counters (name, value) SELECT 'users', COUNT(*) FROM users")
+            self._conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS users_counted AFTER INSERT ON users
+                BEGIN UPDATE counters SET value = value + 1 WHERE name = 'users'; END
+            """)
+            self._conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS users_uncounted AFTER DELETE ON users
+                BEGIN UPDATE counters SET value = value - 1 WHERE name = 'users'; END
+            """)
+        self._migrate_json(Path(json_path))
+        self._closed = threading.Event()
+        threading.Thread(target=self._flush_periodically, name="user-store-flush", daemon=True).start()
+
+    def _migrate_json(self, json_path):
+        done = self._conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if done or not json_path.exists() or json_path.stat().st_size == 0:
+            return
         try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            with open(STATS_FILE, "w") as f_reset:
-                json.dump({"users": []}, f_reset)
-            return {"users": []}
+            with json_path.open("r", encoding="utf-8") as f:
+                users = json.load(f).get("users", [])
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error reading {json_path} for migration: {e}")
+            return
+        rows = [(u["id"], u.get("username") or "") for u in users if isinstance(u.get("id"), int)]
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)", rows)
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(time.time()),))
+        logging.info(f"Migrated {len(rows)} users from {json_path} to {self.path}")
+
+    def _maybe_flush(self):
+        if not self._pending:
+            return
+        if len(self._pending) >= self.batch_size or time.monotonic() - self._pending_since >= self.batch_delay:
+            self.flush()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.batch_delay):
+            try:
+                with self._lock:
+                    if not self._closed.is_set():
+                        self._maybe_flush()
+            except sqlite3.Error as e:
+                logging.error(f"Error flushing new users to {self.path}: {e}")
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            rows = list(self._pending.items())
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)", rows)
+            self._pending.clear()
+            self._pending_since = None
+
+    def _select_one(self, sql, args):
+        row = self._conn.execute(sql, args).fetchone()
+        return {"id": row[0], "username": row[1]} if row else None
+
+    def add_user(self, user_id, username=None):
+        with self._lock:
+            if user_id in self._pending or self._select_one("SELECT id, username FROM users WHERE id = ?", (user_id,)):
+                return
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending[user_id] = username or ""
+            self._maybe_flush()
+
+    def delete_user(self, user_id):
+        with self._lock:
+            if self._pending.pop(user_id, None) is None:
+                self._conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+
+    def get_user_by_id(self, user_id):
+        with self._lock:
+            self._maybe_flush()
+            if user_id in self._pending:
+                return {"id": user_id, "username": self._pending[user_id]}
+            return self._select_one("SELECT id, username FROM users WHERE id = ?", (user_id,))
+
+    def get_user_by_username(self, username):
+        with self._lock:
+            self.flush()
+            return self._select_one("SELECT id, username FROM users WHERE username = ? LIMIT 1", (username,))
+
+    def get_user_count(self):
+        with self._lock:
+            stored = self._conn.execute("SELECT value FROM counters WHERE name = 'users'").fetchone()[0]
+            return stored + len(self._pending)
+
+    def get_users(self):
+        with self._lock:
+            self.flush()
+            return [row[0] for row in self._conn.execute("SELECT id FROM users ORDER BY id")]
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self.flush()
+            self._conn.close()
+
+
+store = SQLiteUserStore()
+atexit.register(store.close)
 
-def save_stats(data):
-    with open(STATS_FILE, "w") as f:
-        json.dump(data, f, indent=2)
 
 def add_user(user_id, username=None):
-    stats = load_stats()
-    if not any(user["id"] == user_id for user in stats["users"]):
-        stats["users"].append({
-            "id": user_id,
-            "username": username or ""
-        })
-        save_stats(stats)
+    store.add_user(user_id, username)
 
 def delete_user(user_id):
-    stats = load_stats()
-    stats["users"] = [u for u in stats["users"] if u["id"] != user_id]
-    save_stats(stats)
+    store.delete_user(user_id)
 
 def get_user_by_id(user_id):
-    stats = load_stats()
-    return next((u for u in stats["users"] if u["id"] == user_id), None)
+    return store.get_user_by_id(user_id)
 
 def get_user_by_username(username):
-    stats = load_stats()
-    return next((u for u in stats["users"] if u["username"] == username), None)
+    return store.get_user_by_username(username)
 
 def get_user_count():
-    stats = load_stats()
-    return len(stats["users"])
+    return store.get_user_count()
 
 def get_users():
-    logging.debug(f"Checking {STATS_FILE.resolve()}")
-    if STATS_FILE.exists():
-        logging.debug(f"Found {STATS_FILE}")
-        try:
-            with STATS_FILE.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-                logging.debug(f"Loaded JSON: {data}")
-                users = [user["id"] for user in data.get("users", []) if isinstance(user.get("id"), int)]
-                logging.debug(f"User IDs: {users}")
-                return users
-        except Exception as e:
-            logging.error(f"Error loading users: {e}")
-            return []
-    logging.warning(f"{STATS_FILE} not found")
-    return []
+    return store.get_users()
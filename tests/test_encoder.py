@@ -0,0 +1,92 @@
+"""The fast encoder against qrcode's own output, and round trips through a decoder."""
+import random
+import string
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+import qrcode
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import decoders  # noqa: E402
+import encoder  # noqa: E402
+from render import matrix_to_png  # noqa: E402
+
+ALPHABETS = (string.digits, string.digits + string.ascii_uppercase + " $%*+-./:",
+             string.printable.strip(), "äöü€日本語🙂" + string.ascii_letters)
+
+
+def _payloads(count, seed):
+    """Numeric, alphanumeric, ASCII and mixed runs, from one character to a few hundred."""
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(count):
+        runs = [rng.choice(ALPHABETS) for _ in range(rng.randint(1, 4))]
+        payloads.append("".join("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 80)))
+                                for alphabet in runs))
+    return payloads
+
+
+def _qrcode_matrix(data, ecc, version=None):
+    qr = qrcode.QRCode(version=version, error_correction=encoder.ECC_LEVELS[ecc], border=4)
+    qr.add_data(data)
+    qr.make(fit=version is None)
+    return qr.get_matrix()
+
+
+def _rows(matrix):
+    return [[bool(module) for module in row] for row in matrix]
+
+
+@pytest.mark.parametrize("ecc", list(encoder.ECC_LEVELS))
+def test_default_segments_match_qrcode(ecc):
+    for data in _payloads(75, seed=ecc):
+        expected = _qrcode_matrix(data, ecc)
+        assert _rows(encoder.encode(data, ecc=ecc, mask=None, segments="default")) == _rows(expected), data
+
+
+@pytest.mark.parametrize("version", [1, 2, 5, 9, 10, 17, 26, 27, 40])
+def test_fixed_version_matches_qrcode(version):
+    data = "HELLO 12345 world"
+    expected = _qrcode_matrix(data, "L", version)
+    assert len(expected) == 17 + 4 * version + 8
+    assert _rows(encoder.encode(data, ecc="L", version=version, mask=None, segments="default")) == _rows(expected)
+
+
+def test_without_numpy_matches_qrcode(monkeypatch):
+    monkeypatch.setattr(encoder, "np", None)
+    for data in _payloads(10, seed="no numpy"):
+        assert _rows(encoder.encode(data, ecc="M", mask=None, segments="default")) == _rows(_qrcode_matrix(data, "M"))
+
+
+def test_optimal_segments_never_need_a_larger_symbol():
+    for data in _payloads(100, seed="size"):
+        default = encoder.encode(data, ecc="Q", mask=None, segments="default")
+        assert len(encoder.encode(data, ecc="Q", mask=None)) <= len(default), data
+
+
+def test_too_long_raises_value_error():
+    with pytest.raises(ValueError):
+        encoder.encode("x" * 3000, ecc="H")
+
+
+def _decoder():
+    try:
+        return decoders.MultiDecoder(decoders.load_backends(list(decoders.BACKENDS)))
+    except RuntimeError:
+        return None
+
+
+@pytest.mark.parametrize("ecc", list(encoder.ECC_LEVELS))
+def test_optimal_segments_round_trip(ecc):
+    decoder = _decoder()
+    if decoder is None:
+        pytest.skip("no barcode decoder installed")
+    from PIL import Image
+    for data in _payloads(20, seed=f"round trip {ecc}") + ["0" * 50 + "ABC" * 10 + "mixed tail"]:
+        for mask in (None, 3):
+            image = Image.open(BytesIO(matrix_to_png(encoder.encode(data, ecc=ecc, mask=mask), box_size=4)))
+            symbols = decoder.decode(image.convert("L"))
+            assert [symbol.data for symbol in symbols] == [data], (data, mask)
@@ -0,0 +1,127 @@
+"""SQLiteStorage: the FSM state store behind the dispatcher."""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fsm_storage import SQLiteStorage  # noqa: E402
+
+
+def _storage(tmp_path, **kwargs):
+    return SQLiteStorage(str(tmp_path / "fsm.db"), **kwargs)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_set_get_reset(tmp_path):
+    storage = _storage(tmp_path)
+
+    async def test():
+        assert await storage.get_state(chat=1, user=1) is None
+        await storage.set_state(chat=1, user=1, state="Form:name")
+        await storage.update_data(chat=1, user=1, data={"a": 1}, b=2)
+        assert await storage.get_state(chat=1, user=1) == "Form:name"
+        assert await storage.get_data(chat=1, user=1) == {"a": 1, "b": 2}
+        await storage.reset_state(chat=1, user=1)
+        assert await storage.get_state(chat=1, user=1) is None
+        assert await storage.get_data(chat=1, user=1) == {}
+        assert storage.stats()["entries"] == 0
+        await storage.close()
+
+    _run(test())
+
+
+def test_survives_restart(tmp_path):
+    async def write():
+        storage = _storage(tmp_path)
+        await storage.set_state(chat=1, user=2, state="Form:age")
+        await storage.set_data(chat=1, user=2, data={"x": [1, 2]})
+        await storage.close()
+
+    async def read():
+        storage = _storage(tmp_path)
+        assert await storage.get_state(chat=1, user=2) == "Form:age"
+        assert await storage.get_data(chat=1, user=2) == {"x": [1, 2]}
+        await storage.close()
+
+    _run(write())
+    _run(read())
+
+
+def test_ttl_expiry(tmp_path, monkeypatch):
+    storage = _storage(tmp_path, default_ttl=60, ttls={"Admin:broadcast": 5})
+    now = time.time()
+
+    async def test():
+        await storage.set_state(chat=1, user=1, state="Admin:broadcast")
+        await storage.set_state(chat=2, user=2, state="Form:name")
+        monkeypatch.setattr(time, "time", lambda: now + 10)
+        # Ignored on read before the sweep gets to it...
+        assert await storage.get_state(chat=1, user=1) is None
+        assert await storage.get_state(chat=2, user=2) == "Form:name"
+        await storage.set_state(chat=3, user=3, state="Admin:broadcast")
+        monkeypatch.setattr(time, "time", lambda: now + 20)
+        # ...and removed by it
+        assert storage.expire() == 1
+        assert storage.stats()["entries"] == 1
+        await storage.close()
+
+    _run(test())
+
+
+def test_hot_cache_is_lru(tmp_path):
+    storage = _storage(tmp_path, cache_size=2)
+
+    async def test():
+        for user in (1, 2):
+            await storage.set_state(chat=user, user=user, state="S")
+        await storage.get_state(chat=1, user=1)  # 1 is now the most recent
+        await storage.set_state(chat=3, user=3, state="S")  # pushes out 2
+        assert list(storage._cache) == [("1", "1"), ("3", "3")]
+        misses = storage.misses
+        assert await storage.get_state(chat=2, user=2) == "S"
+        assert storage.misses == misses + 1
+        await storage.close()
+
+    _run(test())
+
+
+def test_max_entries_drops_least_recently_updated(tmp_path):
+    storage = _storage(tmp_path, max_entries=3)
+
+    async def test():
+        for user in range(1, 5):
+            await storage.set_state(chat=user, user=user, state="S")
+            time.sleep(0.01)
+        assert storage.stats()["entries"] == 3
+        assert storage.stats()["evicted"] == 1
+        assert await storage.get_state(chat=1, user=1) is None
+        assert await storage.get_state(chat=4, user=4) == "S"
+        await storage.close()
+
+    _run(test())
+
+
+def test_max_entries_counts_other_processes(tmp_path):
+    first = _storage(tmp_path, max_entries=4)
+    second = _storage(tmp_path, max_entries=4)
+
+    async def test():
+        for user in range(1, 4):
+            await first.set_state(chat=user, user=user, state="S")
+            time.sleep(0.01)
+        for user in range(4, 7):
+            await second.set_state(chat=user, user=user, state="S")
+            time.sleep(0.01)
+        # Each one has seen only its own three inserts; the sweep counts the table
+        first.expire()
+        assert first.stats()["entries"] == 4
+        assert first.stats()["evicted"] == 2
+        await first.close()
+        await second.close()
+
+    _run(test())
@@ -0,0 +1,92 @@
+"""Webhook mode against the fake Bot API from benchmarks/."""
+import asyncio
+import sys
+from pathlib import Path
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+from fake_api import FAKE_TOKEN, FakeBotAPI  # noqa: E402
+from webhook import SECRET_HEADER, WebhookServer, run_webhook  # noqa: E402
+
+SECRET = "test-secret"
+
+
+def _update(update_id, text="/ping"):
+    user = {"id": 42, "is_bot": False, "first_name": "Test"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text, "from": user,
+        "chat": {"id": 42, "type": "private"},
+    }}
+
+
+async def _with_bot(test):
+    api = FakeBotAPI()
+    api_server = TestServer(api.app)
+    await api_server.start_server()
+    bot = Bot(token=FAKE_TOKEN, server=TelegramAPIServer.from_base(str(api_server.make_url("")).rstrip("/")))
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+
+    @dp.message_handler(commands=["ping"])
+    async def ping(message: types.Message):
+        await message.answer("pong")
+
+    try:
+        await test(api, dp)
+    finally:
+        await (await bot.get_session()).close()
+        await api_server.close()
+
+
+def test_secret_header_is_required():
+    async def test(api, dp):
+        server = WebhookServer(dp, secret=SECRET)
+        async with TestClient(TestServer(server.app)) as client:
+            response = await client.post(server.path, json=_update(1))
+            assert response.status == 401
+            response = await client.post(server.path, json=_update(2), headers={SECRET_HEADER: "wrong"})
+            assert response.status == 401
+            response = await client.post(server.path, json=_update(3), headers={SECRET_HEADER: SECRET})
+            assert response.status == 200
+            await asyncio.wait(set(server.tasks), timeout=5)
+        assert server.received == 1
+        assert api.calls["sendmessage"] == 1
+
+    asyncio.run(_with_bot(test))
+
+
+def test_draining_server_asks_telegram_to_retry():
+    async def test(api, dp):
+        server = WebhookServer(dp, secret=SECRET)
+        async with TestClient(TestServer(server.app)) as client:
+            server.accepting = False
+            response = await client.post(server.path, json=_update(1), headers={SECRET_HEADER: SECRET})
+            assert response.status == 503
+        assert server.rejected == 1
+        assert api.calls["sendmessage"] == 0
+
+    asyncio.run(_with_bot(test))
+
+
+def test_webhook_is_set_after_startup():
+    async def test(api, dp):
+        stop = asyncio.Event()
+        seen = {}
+
+        async def on_startup(dp):
+            seen["setwebhook"] = api.calls["setwebhook"]
+            stop.set()
+
+        await run_webhook(dp, stop, on_startup=on_startup, url="https://bot.example.com",
+                          host="127.0.0.1", port=0, server=WebhookServer(dp, secret=SECRET))
+        assert seen["setwebhook"] == 0
+        assert api.calls["setwebhook"] == 1
+
+    asyncio.run(_with_bot(test))
@@ -0,0 +1,104 @@
+import os
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from ratelimit import KeyedBuckets
+
+
+def _limit(kind, per_minute, burst):
+    return (
+        float(os.getenv(f"ADMISSION_{kind.upper()}_PER_MINUTE", per_minute)) / 60,
+        float(os.getenv(f"ADMISSION_{kind.upper()}_BURST", burst)),
+    )
+
+
+# (tokens per second, burst) for each kind of expensive handler
+ADMISSION_LIMITS = {
+    "scan": _limit("scan", 12, 5),
+    "generate": _limit("generate", 30, 10),
+    "inline": _limit("inline", 120, 30),
+}
+# Shed new work once this share of the worker pool's capacity is taken
+ADMISSION_SHED_RATIO = float(os.getenv("ADMISSION_SHED_RATIO", 0.8))
+# Tell a throttled user at most once per this many seconds
+ADMISSION_WARN_INTERVAL = float(os.getenv("ADMISSION_WARN_INTERVAL", 10))
+
+BUSY_TEXT = "⏳ The bot is busy right now, please retry in a few seconds."
+SLOW_DOWN_TEXT = "🐢 Too many requests, please slow down a bit."
+
+
+def admission(kind):
+    """Mark a handler as expensive; AdmissionMiddleware budgets it under ``kind``."""
+    def decorator(func):
+        setattr(func, "admission_kind", kind)
+        return func
+    return decorator
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """Per-user token buckets plus load shedding for handlers marked with @admission.
+
+    Admins are never limited.
+    """
+
+    def __init__(self, admin_ids, pool, limits=None, shed_ratio=ADMISSION_SHED_RATIO):
+        super().__init__()
+        self.admin_ids = set(admin_ids)
+        self.pool = pool
+        self.shed_ratio = shed_ratio
+        self.buckets = {
+            kind: KeyedBuckets(rate, burst)
+            for kind, (rate, burst) in (limits or ADMISSION_LIMITS).items()
+        }
+        self.rejected = {kind: 0 for kind in self.buckets}
+        self.shed = {kind: 0 for kind in self.buckets}
+        self._warned = {}
+
+    def overloaded(self):
+        return self.pool.pending >= self.pool.capacity * self.shed_ratio
+
+    def _admit(self, user_id):
+        """Returns None if admitted, otherwise "shed" or "rejected"."""
+        kind = getattr(current_handler.get(), "admission_kind", None)
+        if kind is None or user_id in self.admin_ids:
+            return None
+        if self.overloaded():
+            self.shed[kind] += 1
+            return "shed"
+        if not self.buckets[kind].try_acquire(user_id):
+            self.rejected[kind] += 1
+            return "rejected"
+        return None
+
+    def _should_warn(self, user_id):
+        now = time.monotonic()
+        if now - self._warned.get(user_id, 0) < ADMISSION_WARN_INTERVAL:
+            return False
+        self._warned[user_id] = now
+        if len(self._warned) > 10000:
+            self._warned.clear()
+        return True
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        outcome = self._admit(message.from_user.id)
+        if outcome is None:
+            return
+        if self._should_warn(message.from_user.id):
+            await message.reply(BUSY_TEXT if outcome == "shed" else SLOW_DOWN_TEXT)
+        raise CancelHandler()
+
+    async def on_process_inline_query(self, inline_query: types.InlineQuery, data: dict):
+        outcome = self._admit(inline_query.from_user.id)
+        if outcome is None:
+            return
+        if outcome == "shed":
+            await inline_query.answer([], cache_time=1, switch_pm_text="⏳ Busy, try again in a moment",
+                                      switch_pm_parameter="busy")
+        # Rate-limited keystrokes are dropped without an answer: the next one will do
+        raise CancelHandler()
+
+    def stats(self):
+        return {"rejected": dict(self.rejected), "shed": dict(self.shed)}
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+import secrets
+import signal
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # public https base, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 64))
+# Above this many accepted-but-unfinished updates Telegram is told to retry later
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", 1000))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", 30))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Receives updates over HTTP, acks them at once and processes them concurrently."""
+
+    def __init__(self, dp: Dispatcher, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 concurrency=WEBHOOK_CONCURRENCY, max_pending=WEBHOOK_MAX_PENDING, process=None):
+        self.dp = dp
+        # Defaults to handling the update here; the sharded front routes it instead
+        self.process = process or dp.process_update
+        self.path = path
+        self.secret = secret
+        self.max_pending = max_pending
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        self.accepting = True
+        self.received = 0
+        self.rejected = 0
+        self._runner = None
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle)
+
+    async def handle(self, request: web.Request):
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            raise web.HTTPUnauthorized()
+        if not self.accepting or len(self.tasks) >= self.max_pending:
+            # Not acked, so Telegram delivers it again later
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable()
+        update = types.Update(**await request.json())
+        self.received += 1
+        task = asyncio.ensure_future(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        async with self.semaphore:
+            try:
+                await self.process(update)
+            except Exception as e:
+                logging.error(f"Error processing update {update.update_id}: {e}")
+
+    async def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Webhook server listening on {host}:{port}{self.path}")
+
+    async def shutdown(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Stop taking updates and wait for in-flight handlers to finish."""
+        self.accepting = False
+        if self.tasks:
+            logging.info(f"Draining {len(self.tasks)} in-flight updates")
+            _, unfinished = await asyncio.wait(set(self.tasks), timeout=timeout)
+            for task in unfinished:
+                task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def run_webhook(dp: Dispatcher, stop: asyncio.Event, on_startup=None, on_shutdown=None, url=WEBHOOK_URL,
+                      host=WEBHOOK_HOST, port=WEBHOOK_PORT, server=None):
+    """Serve updates until ``stop`` is set.
+
+    Local services start first and the webhook is registered last, so Telegram
+    never delivers an update the handlers aren't ready for.
+    """
+    server = server or WebhookServer(dp)
+    if on_startup:
+        await on_startup(dp)
+    await server.start(host, port)
+    await dp.bot.set_webhook(url + server.path, secret_token=server.secret,
+                             drop_pending_updates=False)
+    await stop.wait()
+    logging.info("Shutting down webhook server...")
+    await server.shutdown()
+    if on_shutdown:
+        await on_shutdown(dp)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    session = await dp.bot.get_session()
+    await session.close()
+
+
+def start_webhook(dp: Dispatcher, on_startup=None, on_shutdown=None, url=WEBHOOK_URL,
+                  host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """Run the bot in webhook mode until SIGINT/SIGTERM."""
+    if not url:
+        raise RuntimeError("WEBHOOK_URL is not set")
+    loop = asyncio.get_event_loop()
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    async def run():
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await run_webhook(dp, stop, on_startup, on_shutdown, url, host, port)
+
+    loop.run_until_complete(run())
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# "process" scales with cores, "thread" is cheaper to start and fine for I/O heavy hosts
+WORKER_MODE = os.getenv("WORKER_MODE", "process")
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", os.cpu_count() or 2))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 32))
+WORKER_TIMEOUT = float(os.getenv("WORKER_TIMEOUT", 15))
+# 1: every worker loads the encoder, PIL and libzbar when it starts, not on its first job
+WORKER_PREWARM = int(os.getenv("WORKER_PREWARM", 1))
+
+
+def warm_up():
+    """Worker initializer: import and exercise the render and decode paths once.
+
+    Must not raise, a failing initializer breaks the whole pool.
+    """
+    try:
+        from PIL import Image
+
+        from decoders import decode
+        from render import render_qr
+
+        render_qr("warm-up", "png")
+        render_qr("warm-up", "jpeg")
+        decode(Image.new("L", (64, 64), 255))
+    except Exception as e:
+        logging.warning(f"Worker warm-up failed: {e}")
+
+
+def _noop():
+    pass
+
+
+class WorkerPoolBusy(Exception):
+    def __init__(self):
+        super().__init__("Bot is busy right now, please retry in a few seconds.")
+
+
+class WorkerPool:
+    """Runs CPU-bound render/scan jobs off the event loop.
+
+    At most ``workers + queue_size`` jobs are accepted at once; anything past that
+    is rejected with WorkerPoolBusy instead of piling up behind a slow scan. A job
+    that timed out still counts until its worker is actually free again.
+    """
+
+    def __init__(self, mode=WORKER_MODE, workers=WORKER_COUNT,
+                 queue_size=WORKER_QUEUE_SIZE, timeout=WORKER_TIMEOUT,
+                 initializer=warm_up if WORKER_PREWARM else None):
+        self.mode = mode
+        self.initializer = initializer
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.timeout = timeout
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.restarts = 0
+        self._executor = None
+
+    @property
+    def capacity(self):
+        return self.workers + self.queue_size
+
+    @property
+    def queue_depth(self):
+        """Jobs waiting for a free worker (not counting the ones running)."""
+        return max(0, self.pending - self.workers)
+
+    def start(self):
+        if self._executor is None:
+            if self.mode == "thread":
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr-worker",
+                                                    initializer=self.initializer)
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=self.initializer)
+            logging.info(f"Started {self.mode} worker pool with {self.workers} workers")
+        return self._executor
+
+    async def prewarm(self):
+        """Starts every worker now (running the initializer) instead of on the first jobs.
+
+        Returns the seconds it took; meant to run in the background at startup.
+        """
+        started = time.perf_counter()
+        executor = self.start()
+        await asyncio.gather(*(asyncio.wrap_future(executor.submit(_noop)) for _ in range(self.workers)))
+        return time.perf_counter() - started
+
+    def _restart(self, executor):
+        """Drops a pool whose worker died; the next job starts a fresh one."""
+        if executor is not None and self._executor is executor:
+            self._executor = None
+            self.restarts += 1
+            logging.error("A worker process died, restarting the worker pool")
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, func, *args):
+        executor = self.start()
+        try:
+            return executor, executor.submit(func, *args)
+        except BrokenProcessPool:
+            # Broken by an earlier job: this one never ran, so it gets a new pool
+            self._restart(executor)
+            executor = self.start()
+            return executor, executor.submit(func, *args)
+
+    def _release(self, job):
+        self.pending -= 1
+        if not job.cancelled():
+            job.exception()  # retrieved, so a late failure isn't logged as unhandled
+
+    async def run(self, func, *args, timeout=None):
+        if self.pending >= self.capacity:
+            self.rejected += 1
+            raise WorkerPoolBusy()
+        self.pending += 1
+        executor = future = job = None
+        try:
+            executor, future = self._submit(func, *args)
+            job = asyncio.wrap_future(future)
+            result = await asyncio.wait_for(asyncio.shield(job), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            logging.warning(f"Worker job {getattr(func, '__name__', func)} timed out")
+            raise
+        except BrokenProcessPool:
+            self.failed += 1
+            self._restart(executor)
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+            return result
+        finally:
+            if job is None or job.done():
+                self.pending -= 1
+            else:
+                # Timed out or the caller went away: a queued job is dropped here,
+                # a running one keeps its worker (and its slot) until it finishes.
+                future.cancel()
+                job.add_done_callback(self._release)
+
+    def stats(self):
+        return {"workers": self.workers, "pending": self.pending, "queue_depth": self.queue_depth,
+                "completed": self.completed, "failed": self.failed, "rejected": self.rejected,
+                "timed_out": self.timed_out, "restarts": self.restarts}
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
+pool = WorkerPool()
+
+
+async def run_job(func, *args, timeout=None):
+    return await pool.run(func, *args, timeout=timeout)